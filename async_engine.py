@@ -0,0 +1,368 @@
+import os
+import time
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+from protocol import fragment, FRAG_BURST, FRAG_GAP, encode_reply, decode_request, format_reply
+from sessions import RecentReplies
+from transfer import FRAME, END_FRAME, MAX_LINE, LEGACY_WAIT, TOKEN_PREFIX, FrameReader, pack_frame
+from logger import log
+
+DEFAULT_WORKERS = 8
+
+
+# 一个UDP客户端的会话（对应线程模式下的ProcessClient）
+class Session:
+    def __init__(self, addr):
+        self.addr = addr
+        self.messages = asyncio.Queue()
+        self.current_user = None
+        self.caps = set()
+        self.reply_id = 0
+        self.replies = RecentReplies()
+        self.last_active = 0
+        self.task = None
+        self.loop = asyncio.get_running_loop()
+
+    # 会话空闲超时（由回收线程调用）：唤醒会话协程让它退出
+    def evict(self):
+        self.loop.call_soon_threadsafe(self.messages.put_nowait, None)
+
+
+# 接收UDP数据报，交给对应的会话
+class CommandProtocol(asyncio.DatagramProtocol):
+    def __init__(self, engine):
+        self.engine = engine
+
+    def connection_made(self, transport):
+        self.engine.transport = transport
+
+    def datagram_received(self, data, addr):
+        self.engine.dispatch(data, addr)
+
+    def error_received(self, exc):
+        log.error("AsyncEngine", f"UDP error: {exc}", event="error")
+
+
+# asyncio引擎：一个事件循环处理所有客户端，阻塞的存储操作交给有界线程池
+# 命令处理仍然是ForumServer.request_process，协议与线程模式完全相同
+class AsyncEngine:
+    def __init__(self, server, workers=DEFAULT_WORKERS):
+        self.server = server
+        self.workers = workers
+        self.transport = None
+        self.executor = None
+        self.slots = None               # 限制同时提交到线程池的任务数
+        self.sessions = server.client_threads
+
+    def run(self):
+        asyncio.run(self.main())
+
+    async def main(self):
+        loop = asyncio.get_running_loop()
+        self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="storage")
+        self.slots = asyncio.Semaphore(self.workers * 4)
+
+        await loop.create_datagram_endpoint(
+            lambda: CommandProtocol(self), local_addr=("127.0.0.1", self.server.server_port))
+        log.info("AsyncEngine", f"UDP port {self.server.server_port} is open, waiting for client messages...")
+
+        tcp_server = await asyncio.start_server(self.handle_transfer, "127.0.0.1", self.server.server_port,
+                                                reuse_address=True)
+        log.info("AsyncEngine", f"TCP port {self.server.server_port} is open.")
+        log.info("AsyncEngine", f"The server is ready, storage work runs on {self.workers} worker threads.")
+
+        async with tcp_server:
+            await tcp_server.serve_forever()
+
+    # 在线程池中执行阻塞调用
+    async def call(self, func, *args):
+        async with self.slots:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.executor, functools.partial(func, *args))
+
+    # 分片每FRAG_BURST个推迟FRAG_GAP秒发送，重传的请求沿用缓存回复的分片编号
+    def send(self, session, reply, req_id=None, binary=False, reply_id=None):
+        if isinstance(reply, str):
+            reply = format_reply(req_id, reply, binary)
+        if reply_id is None:
+            session.reply_id += 1
+            reply_id = session.reply_id
+            session.replies.put(req_id, reply, reply_id)
+        for seq, datagram in enumerate(fragment(encode_reply(reply, session.caps), reply_id)):
+            delay = seq // FRAG_BURST * FRAG_GAP
+            if delay:
+                session.loop.call_later(delay, self.transport.sendto, datagram, session.addr)
+            else:
+                self.transport.sendto(datagram, session.addr)
+
+    def dispatch(self, data, addr):
+        session = self.sessions.touch(addr)
+        if session is None:                 # 说明是新client，创建一个新的会话
+            session = Session(addr)
+            if not self.sessions.add(addr, session):
+                log.warning("AsyncEngine", f"Too many sessions, rejecting {addr}.", event="session")
+                self.transport.sendto("SERVER_BUSY".encode("utf-8"), addr)
+                return
+            log.info("AsyncEngine", f"New client address detected: {addr}, create session...", event="session")
+            session.task = asyncio.get_running_loop().create_task(self.serve(session))
+        session.messages.put_nowait(data)
+
+    # 主题命令直接等待分片线程的结果，不占用存储线程；其他命令（LST、BATCH）在存储线程中执行
+    async def execute(self, command, args, username, addr):
+        key = self.server.shard_key(command, args)
+        if key is None:
+            return await self.call(self.server.request_process, command, args, username, addr)
+        future = self.server.shards.submit(key, self.server.request_process, command, args, username, addr)
+        return await asyncio.wrap_future(future)
+
+    # 一个会话：先身份验证，再按顺序处理命令
+    async def serve(self, session):
+        pending = None
+        try:
+            while True:
+                data = await session.messages.get()
+                if data is None:            # 空闲超时被回收
+                    break
+                request = decode_request(data)
+                if request is None:
+                    continue
+                req_id, binary, command, args = request
+
+                # 重传的请求：直接返回上次的回复
+                cached = session.replies.get(req_id)
+                if cached is not None:
+                    self.send(session, cached[1], reply_id=cached[0])
+                    continue
+
+                if session.current_user is None:
+                    reply, pending, username = await self.call(self.server.identity_step, pending, command, args)
+                    if reply is not None:
+                        self.send(session, reply, req_id, binary)
+                    if username is not None:
+                        session.current_user = username
+                        session.caps = self.server.negotiated.pop(username, set())
+                    continue
+
+                response = await self.execute(command, args, session.current_user, session.addr)
+                self.send(session, response, req_id, binary)
+
+                if command == "XIT":
+                    break
+
+        except Exception as e:
+            log.error("AsyncEngine", f"{session.addr} an error occurred: {e}", event="error")
+
+        finally:
+            self.server.active_users.discard(session.current_user)
+            self.sessions.remove(session.addr, session)
+            log.info("AsyncEngine", f"Client session {session.addr} has finished.", event="session")
+
+    # TCP文件传输（对应线程模式下的FileTransfer）：一条连接可以依次完成多个传输
+    async def handle_transfer(self, reader, writer):
+        addr = writer.get_extra_info("peername")
+        log.info("AsyncEngine", f"Start processing file transfers from {addr}...", event="transfer")
+        current = None
+
+        try:
+            head = b""
+            if addr[0] in self.server.legacy_transfers:
+                try:
+                    head = await asyncio.wait_for(reader.readexactly(len(TOKEN_PREFIX)), LEGACY_WAIT)
+                except (asyncio.TimeoutError, asyncio.IncompleteReadError) as e:
+                    head = getattr(e, "partial", b"")
+                if head != TOKEN_PREFIX:
+                    await self.legacy_transfer(reader, writer, addr, head)
+                    return
+
+            while True:
+                line = await self.read_request(reader, self.sessions.idle_timeout)
+                if line is None:
+                    break
+                if head:
+                    line, head = head.decode("utf-8", errors="ignore") + line, b""
+                p = line.split()
+                if line == "DONE":              # 客户端在这条连接上的这个传输已经完成
+                    await self.finish_transfer(current)
+                    current = None
+                    continue
+                if len(p) == 2 and p[0] == "TRANSFER":
+                    await self.finish_transfer(current)
+                    current = self.server.claim_transfer(p[1])
+                    if current[0] is None:
+                        log.warning("AsyncEngine", f"invalid or expired transfer token from {addr}.", event="transfer")
+                        await self.write_line(writer, "ERROR BAD_TOKEN")
+                    else:
+                        await self.write_line(writer, "READY")
+                    continue
+
+                transfer_info = current[0] if current else None
+                if transfer_info is None:
+                    await self.write_line(writer, "ERROR BAD_TOKEN")
+                    break
+                if transfer_info["mode"] == "upload":
+                    if not await self.upload_range(reader, writer, transfer_info, line):
+                        break
+                elif not await self.download_range(writer, transfer_info, line):
+                    break
+
+            await self.finish_transfer(current)
+
+        except Exception as e:
+            log.error("AsyncEngine", f"Transfer error: {e}", event="error")
+
+        finally:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except Exception:
+                pass
+            log.info("AsyncEngine", f"Finish file transfer with {addr}.", event="transfer")
+
+    # 旧格式：连接上直接是整个文件的内容（head是判断格式时已经读出的数据）
+    async def legacy_transfer(self, reader, writer, addr, head):
+        transfer_info, _ = self.server.claim_legacy_transfer(addr[0])
+        if not transfer_info:
+            log.warning("AsyncEngine", "No pending transfer information.", event="transfer")
+            return
+
+        threadtitle = transfer_info["threadtitle"]
+        filename = transfer_info["filename"]
+        username = transfer_info["username"]
+
+        started = time.perf_counter()
+        if transfer_info["mode"] == "upload":
+            partial = self.server.legacy_partial_path(threadtitle, filename)
+            f = await self.call(open, partial, "wb", 0)
+            received = 0
+            try:
+                chunk = head
+                while chunk:
+                    await self.call(f.write, chunk)
+                    received += len(chunk)
+                    chunk = await reader.read(self.server.chunk_size)
+            finally:
+                await self.call(f.close)
+            self.server.metrics.transfer("upload", received, time.perf_counter() - started)
+
+            if not await self.call(self.server.commit_legacy_upload, transfer_info, partial):
+                log.warning("AsyncEngine", f"{username} uploaded {threadtitle}-{filename}, but the filename "
+                                           f"has already been uploaded to the thread.", event="transfer")
+                return
+            log.info("AsyncEngine", f"{username} has uploaded {threadtitle}-{filename} successfully.", event="transfer")
+
+        else:
+            # 零拷贝发送（loop.sendfile在支持的平台上使用os.sendfile）
+            f = await self.call(open, self.server.blobs.path(transfer_info["sha256"]), "rb")
+            try:
+                await writer.drain()
+                sent = await asyncio.get_running_loop().sendfile(writer.transport, f)
+            finally:
+                await self.call(f.close)
+            self.server.metrics.transfer("download", sent, time.perf_counter() - started)
+
+            await self.call(self.server.record_transfer, threadtitle, username, filename, "downloaded")
+            log.info("AsyncEngine", f"{username} has downloaded {threadtitle}-{filename} successfully.",
+                     event="transfer")
+
+    # 一个传输在这条连接上结束：并行下载由最后一条连接在主题中记录一次下载
+    async def finish_transfer(self, current):
+        if current is None:
+            return
+        transfer_info, last = current
+        if transfer_info is not None and transfer_info["mode"] == "download" and last:
+            await self.call(self.server.record_transfer, transfer_info["threadtitle"], transfer_info["username"],
+                            transfer_info["filename"], "downloaded")
+            log.info("AsyncEngine", f"{transfer_info['username']} has downloaded "
+                                    f"{transfer_info['threadtitle']}-{transfer_info['filename']}.", event="transfer")
+
+    # 读取一行请求，连接关闭、超时或行太长返回None
+    async def read_request(self, reader, timeout=None):
+        try:
+            line = await asyncio.wait_for(reader.readuntil(b"\n"), timeout)
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError):
+            return None
+        if len(line) > MAX_LINE:
+            return None
+        return line.decode("utf-8", errors="ignore").strip()
+
+    async def write_line(self, writer, line):
+        writer.write((line + "\n").encode("utf-8"))
+        await writer.drain()
+
+    # 接收一个区间的帧并用pwrite写入，返回 (写入的字节数, 状态)；帧的校验和解压在transfer.FrameReader中，
+    # 与线程模式的transfer.recv_frames相同，这里只负责读连接、在存储线程中解压和写文件
+    async def recv_frames(self, reader, fd, offset, limit, hasher):
+        frames = FrameReader(offset, self.server.chunk_size, limit, hasher)
+        while frames.status is None:
+            try:
+                length = frames.header(await reader.readexactly(FRAME.size))
+                if not length:
+                    break
+                chunk = await reader.readexactly(length)
+            except asyncio.IncompleteReadError:
+                return frames.total, "INCOMPLETE"
+            write = await self.call(frames.payload, chunk)
+            if write is not None:
+                await self.call(os.pwrite, fd, write[1], write[0])
+        return frames.total, frames.status
+
+    # 上传一个区间（请求解析和提交与FileTransfer.upload_range共用ForumServer中的方法），返回False时关闭连接
+    async def upload_range(self, reader, writer, transfer_info, line):
+        request = self.server.upload_request(transfer_info, line)
+        if request is None:
+            await self.write_line(writer, "ERROR BAD_REQUEST 0")
+            return False
+
+        partial, start, end, hasher = request
+        started = time.perf_counter()
+        fd = await self.call(os.open, partial, os.O_WRONLY | os.O_CREAT, 0o644)
+        try:
+            received, status = await self.recv_frames(reader, fd, start, end - start, hasher)
+        finally:
+            await self.call(os.close, fd)
+        result, keep = await self.call(self.server.upload_result, transfer_info, partial, start, received, status,
+                                       hasher, time.perf_counter() - started, "AsyncEngine")
+        await self.write_line(writer, result)
+        return keep
+
+    # 下载一个区间（与FileTransfer.download_range相同）
+    async def download_range(self, writer, transfer_info, line):
+        request = self.server.download_request(transfer_info, line)
+        if request is None:
+            log.warning("AsyncEngine", f"bad download request {line!r}.", event="transfer")
+            return False
+
+        server_side_file, start, end, compressed = request
+        started = time.perf_counter()
+        if compressed:
+            await self.send_frames(writer, server_side_file, start, end)
+        elif end > start:
+            f = await self.call(open, server_side_file, "rb")
+            try:
+                await asyncio.get_running_loop().sendfile(writer.transport, f, start, end - start)
+            finally:
+                await self.call(f.close)
+        self.server.metrics.transfer("download", end - start, time.perf_counter() - started)
+        return True
+
+    # 按帧发送 [start, end)，能压缩的块压缩（帧的编码与transfer.send_frames共用pack_frame）
+    async def send_frames(self, writer, path, start, end):
+        fd = await self.call(os.open, path, os.O_RDONLY)
+        compress = True
+        try:
+            pos = start
+            while pos < end:
+                chunk = await self.call(os.pread, fd, min(self.server.chunk_size, end - pos), pos)
+                if not chunk:
+                    break
+                header, payload, compress = await self.call(pack_frame, chunk, compress)
+                writer.write(header)
+                writer.write(payload)
+                await writer.drain()
+                pos += len(chunk)
+            writer.write(END_FRAME)
+            await writer.drain()
+        finally:
+            await self.call(os.close, fd)
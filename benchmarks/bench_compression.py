@@ -0,0 +1,189 @@
+# 协商压缩的效果：同一个服务器上，登录时请求压缩 vs 不请求压缩
+#   RDT：读取一个有很多消息的主题，报告延迟和收到的UDP字节数
+#   文件：上传/下载一个文本文件和一个随机内容的文件，报告耗时和TCP上传输的字节数
+#
+#   python benchmarks/bench_compression.py --messages 500 --size-mb 32 --engine threads
+
+import os
+import sys
+import io
+import json
+import time
+import socket
+import shutil
+import argparse
+import tempfile
+import contextlib
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+import client
+from protocol import Reassembler, add_request_id, split_request_id, decode_reply
+from bench_streams import start_server, first_user, timed
+
+
+# 统计收发字节数的socket
+class CountingSocket:
+    def __init__(self, sock, counter):
+        self.sock = sock
+        self.counter = counter
+
+    def sendall(self, data):
+        self.counter["sent"] += len(data)
+        return self.sock.sendall(data)
+
+    def recv(self, n):
+        data = self.sock.recv(n)
+        self.counter["received"] += len(data)
+        return data
+
+    def recv_into(self, buf, n=0):
+        got = self.sock.recv_into(buf, n)
+        self.counter["received"] += got
+        return got
+
+    def __getattr__(self, name):
+        return getattr(self.sock, name)
+
+
+class CountingConnections(client.TransferConnections):
+    def __init__(self):
+        super().__init__()
+        self.counter = {"sent": 0, "received": 0}
+
+    def acquire(self, server_addr):
+        sock, reused = super().acquire(server_addr)
+        return (sock if reused else CountingSocket(sock, self.counter)), reused
+
+    def reset(self):
+        self.counter["sent"] = self.counter["received"] = 0
+
+
+def login(udp_sock, server_addr, username, password, compress):
+    # 服务器回复XIT_OK之后才结束上一个会话，稍等一下再重新登录
+    time.sleep(0.2)
+    client.COMPRESSION = compress
+    with contextlib.redirect_stdout(io.StringIO()):
+        if not client.login(udp_sock, server_addr, username, password):
+            raise SystemExit("login failed")
+
+
+# 发送一次RDT并收齐回复，返回 (耗时, 收到的UDP字节数)
+def read_thread(udp_sock, server_addr, username, req_id):
+    reassembler = Reassembler()
+    received = 0
+    started = time.perf_counter()
+    udp_sock.sendto(add_request_id(str(req_id), f"RDT bench {username}").encode("utf-8"), server_addr)
+    while True:
+        datagram, _ = udp_sock.recvfrom(65535)
+        received += len(datagram)
+        data = reassembler.feed(datagram)
+        if data is not None and split_request_id(decode_reply(data))[0] == str(req_id):
+            return time.perf_counter() - started, received
+
+
+def bench_rdt(udp_sock, server_addr, username, repeat):
+    times, size = [], 0
+    for i in range(repeat):
+        elapsed, size = read_thread(udp_sock, server_addr, username, i)
+        times.append(elapsed)
+    times.sort()
+    return {"median_ms": times[len(times) // 2] * 1000, "bytes": size}
+
+
+def bench_file(udp_sock, server_addr, username, name, repeat):
+    up, down = [], []
+    for _ in range(repeat):
+        client.connections.reset()
+        elapsed, log = timed(client.upload_command, udp_sock, server_addr, ["UPD", "files", name], username)
+        assert "uploaded" in log, log
+        up.append(elapsed)
+        up_bytes = client.connections.counter["sent"]
+
+        os.rename(name, name + ".src")
+        client.connections.reset()
+        elapsed, log = timed(client.download_command, udp_sock, server_addr, ["DWN", "files", name], username)
+        assert os.path.getsize(name) == os.path.getsize(name + ".src"), log
+        down.append(elapsed)
+        down_bytes = client.connections.counter["received"]
+        os.remove(name)
+        os.rename(name + ".src", name)
+        # 删除附件，下一次上传不会因为内容已经存在而跳过传输
+        client.udp_msg_process(udp_sock, server_addr, f"RMV files {username}")
+        client.udp_msg_process(udp_sock, server_addr, f"CRT files {username}")
+    return {"upload_s": min(up), "upload_bytes": up_bytes, "download_s": min(down), "download_bytes": down_bytes}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=500, help="messages in the thread read by RDT")
+    parser.add_argument("--size-mb", type=int, default=32)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--engine", choices=["threads", "asyncio"], default="threads")
+    parser.add_argument("--port", type=int, default=47998)
+    parser.add_argument("--json", metavar="FILE", help="also write the results to FILE")
+    args = parser.parse_args()
+
+    username, password = first_user()
+    tmp = tempfile.mkdtemp()
+    workdir = os.path.join(tmp, "client")
+    os.makedirs(workdir)
+    proc = start_server(tmp, args.port, args.engine)
+    cwd = os.getcwd()
+    client.connections = CountingConnections()
+    results = {}
+    try:
+        os.chdir(workdir)
+        udp_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        udp_sock.settimeout(client.TIMEOUT)
+        server_addr = ("127.0.0.1", args.port)
+
+        with open("text.txt", "w", encoding="utf-8") as f:
+            line = 0
+            while f.tell() < args.size_mb * 1024 * 1024:
+                f.write(f"{line:08d} the quick brown fox jumps over the lazy dog\n")
+                line += 1
+        with open("random.bin", "wb") as f:
+            for _ in range(args.size_mb):
+                f.write(os.urandom(1024 * 1024))
+
+        login(udp_sock, server_addr, username, password, False)
+        client.udp_msg_process(udp_sock, server_addr, f"CRT bench {username}")
+        client.udp_msg_process(udp_sock, server_addr, f"CRT files {username}")
+        for i in range(args.messages):
+            client.udp_msg_process(udp_sock, server_addr, f"MSG bench message {i} about the forum benchmark {username}")
+        client.udp_msg_process(udp_sock, server_addr, f"XIT {username}")
+
+        for compress in (False, True):
+            login(udp_sock, server_addr, username, password, compress)
+            label = "zlib" if compress else "none"
+            results[label] = {"rdt": bench_rdt(udp_sock, server_addr, username, args.repeat * 10)}
+            for name in ("text.txt", "random.bin"):
+                results[label][name] = bench_file(udp_sock, server_addr, username, name, args.repeat)
+            client.udp_msg_process(udp_sock, server_addr, f"XIT {username}")
+            print(f"{label}: done", flush=True)
+    finally:
+        os.chdir(cwd)
+        proc.kill()
+        shutil.rmtree(tmp, ignore_errors=True)
+
+    print(f"\nRDT of {args.messages} messages and {args.size_mb} MB files over loopback, {args.engine} engine, "
+          f"best of {args.repeat}")
+    print(f"{'':<10}{'RDT ms':>10}{'RDT bytes':>12}")
+    for label, r in results.items():
+        print(f"{label:<10}{r['rdt']['median_ms']:>10.2f}{r['rdt']['bytes']:>12}")
+    print(f"\n{'':<10}{'file':<12}{'upload s':>10}{'upload MB':>11}{'download s':>12}{'download MB':>13}")
+    for label, r in results.items():
+        for name in ("text.txt", "random.bin"):
+            f = r[name]
+            print(f"{label:<10}{name:<12}{f['upload_s']:>10.3f}{f['upload_bytes'] / 2**20:>11.1f}"
+                  f"{f['download_s']:>12.3f}{f['download_bytes'] / 2**20:>13.1f}")
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"messages": args.messages, "size_mb": args.size_mb, "engine": args.engine,
+                       "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,373 @@
+# 协议层的负载测试：在临时目录里启动一个真正的服务器，模拟N个并发客户端
+# 每个客户端先LOGIN/PWD（新用户，包含注册），都登录之后再按权重随机执行 CRT/MSG/RDT/LST/EDT/DLT 和 UPD/DWN，直到时间用完
+# 报告吞吐量、每种命令的延迟分位数、错误/超时次数和服务器的内存占用（RSS），--json 保存结果便于在不同提交之间对比
+#
+#   python benchmarks/bench_load.py --clients 1 8 32 --duration 10 --mix MSG=10,RDT=5,LST=1,EDT=2,DLT=1,CRT=1
+#   python benchmarks/bench_load.py --clients 16 --mix MSG=4,RDT=4,UPD=1,DWN=1 --file-kb 256 --engine asyncio
+#   python benchmarks/bench_load.py --clients 16 --server-args "--storage sqlite --log-level warning"
+#   python benchmarks/bench_load.py --clients 8 --protocol binary      # 登录时协商二进制请求，与文本命令对比
+
+import os
+import sys
+import io
+import json
+import time
+import shlex
+import random
+import socket
+import shutil
+import argparse
+import tempfile
+import threading
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+import client
+from protocol import Reassembler, encode_request, read_reply, split_fields, typed_fields, format_caps
+
+DEFAULT_MIX = "CRT=1,MSG=10,RDT=5,LST=1,EDT=2,DLT=1,UPD=1,DWN=1"   # 默认也包含文件传输；只测命令时在--mix中去掉UPD和DWN
+OPERATIONS = ("CRT", "MSG", "RDT", "LST", "EDT", "DLT", "UPD", "DWN")
+TIMEOUT = 1.0                   # 等待一次回复的时间（秒），超时后重发
+RETRIES = 5
+SHARED_THREADS = 8              # 所有客户端共同发消息、读取的主题数
+
+
+# 解析命令权重 "MSG=10,RDT=5"
+def parse_mix(text):
+    mix = {}
+    for part in filter(None, text.split(",")):
+        op, _, weight = part.partition("=")
+        op = op.strip().upper()
+        if op not in OPERATIONS:
+            raise SystemExit(f"unknown operation {op!r} in --mix, expected one of {', '.join(OPERATIONS)}")
+        mix[op] = float(weight)
+    return {op: w for op, w in mix.items() if w > 0}
+
+
+# 每个线程各自的标准输出：client.py的上传/下载函数用print报告结果，按线程分开收集
+class ThreadOutput:
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
+
+    def capture(self):
+        self.local.buffer = io.StringIO()
+        return self.local.buffer
+
+    def write(self, text):
+        buffer = getattr(self.local, "buffer", None)
+        return (buffer or self.stream).write(text)
+
+    def flush(self):
+        self.stream.flush()
+
+
+def start_server(tmp, port, engine, server_args):
+    shutil.copy(os.path.join(ROOT, "credentials.txt"), tmp)
+    proc = subprocess.Popen([sys.executable, os.path.join(ROOT, "server.py"), str(port), "--engine", engine,
+                             *server_args],
+                            cwd=tmp, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    # 等到UDP端口有回应（首次启动要导入credentials.txt中的账号）
+    probe = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    probe.settimeout(0.2)
+    for _ in range(100):
+        try:
+            probe.sendto(b"XIT", ("127.0.0.1", port))
+            probe.recvfrom(65535)
+            break
+        except OSError:
+            if proc.poll() is not None:
+                raise SystemExit("the server exited during startup")
+    probe.close()
+    return proc
+
+
+# 服务器进程的常驻内存（KB），只支持Linux的/proc，其他平台返回None
+def read_rss(pid, field="VmRSS"):
+    try:
+        with open(f"/proc/{pid}/status", "r", encoding="ascii") as f:
+            for line in f:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+
+# 一个模拟的客户端：自己的UDP socket、自己的主题（EDT/DLT只改自己的消息），共享主题用来制造竞争
+class LoadClient:
+    def __init__(self, index, server_addr, mix, file_kb, stats, output, binary=False):
+        self.index = index
+        self.server_addr = server_addr
+        self.username = f"load{index}"
+        self.own = f"own{index}"
+        self.ops = list(mix)
+        self.weights = [mix[op] for op in self.ops]
+        self.file_kb = file_kb
+        self.stats = stats
+        self.output = output
+        self.binary = binary            # 登录时协商caps=bin，之后的命令按二进制请求发送
+        self.random = random.Random(index)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.req_ids = iter(range(1, 1 << 62))
+        self.messages = 0               # 自己主题中的消息数
+        self.created = 0
+        self.uploads = []               # 已经上传的文件名，DWN从中选择
+
+    # 发送一条命令并等待对应的回复，超时重发（编号不变，服务器不会重复执行）；返回回复，失败返回None
+    def request(self, msg):
+        req_id = f"{next(self.req_ids):x}"
+        reassembler = Reassembler()
+        self.sock.settimeout(TIMEOUT)
+        for _ in range(RETRIES):
+            self.sock.sendto(encode_request(req_id, msg), self.server_addr)
+            try:
+                while True:
+                    datagram, _ = self.sock.recvfrom(65535)
+                    data = reassembler.feed(datagram)
+                    if data is None:
+                        continue
+                    reply_id, reply = read_reply(data)
+                    if reply_id is None or reply_id == req_id:
+                        return reply
+            except socket.timeout:
+                self.stats.timeout()
+        return None
+
+    def timed(self, op, func, *args):
+        started = time.perf_counter()
+        ok = func(*args)
+        self.stats.record(op, time.perf_counter() - started, ok)
+
+    def login(self):
+        def step():
+            reply = self.request(f"LOGIN {self.username}" + format_caps({"bin"} if self.binary else set()))
+            return (reply in ("EXISTING_USER", "NEW_USER")
+                    and (self.request("PWD load") or "").startswith("LOGIN_SUCCESS"))
+        started = time.perf_counter()
+        ok = step()
+        self.stats.record("LOGIN", time.perf_counter() - started, ok)
+        if ok:
+            self.command(f"CRT {self.own}")
+        return ok
+
+    def command(self, msg):
+        if self.binary:
+            cmd, _, rest = msg.partition(" ")
+            reply = self.request((cmd, typed_fields(cmd, split_fields(cmd, rest))))
+        else:
+            reply = self.request(f"{msg} {self.username}")
+        return reply is not None and not reply.startswith("ERROR")
+
+    def shared(self):
+        return f"shared{self.random.randrange(SHARED_THREADS)}"
+
+    def run_op(self, op):
+        if op == "CRT":
+            self.created += 1
+            self.timed(op, self.command, f"CRT c{self.index}-{self.created}")
+        elif op == "MSG":
+            # 一半发到共享主题，一半发到自己的主题（供EDT/DLT使用）
+            if self.random.random() < 0.5:
+                self.timed(op, self.command, f"MSG {self.shared()} load message from {self.username}")
+            else:
+                self.messages += 1
+                self.timed(op, self.command, f"MSG {self.own} message {self.messages} from {self.username}")
+        elif op == "RDT":
+            self.timed(op, self.command, f"RDT {self.shared()}")
+        elif op == "LST":
+            self.timed(op, self.command, "LST")
+        elif op == "EDT":
+            if not self.messages:
+                return self.run_op("MSG")
+            self.timed(op, self.command, f"EDT {self.own} {self.random.randint(1, self.messages)} edited")
+        elif op == "DLT":
+            if not self.messages:
+                return self.run_op("MSG")
+            self.timed(op, self.command, f"DLT {self.own} {self.messages}")
+            self.messages -= 1
+        elif op == "UPD":
+            self.timed(op, self.upload)
+        elif op == "DWN":
+            if not self.uploads:
+                return self.run_op("UPD")
+            self.timed(op, self.download, self.random.choice(self.uploads))
+
+    # 上传一个新生成的文件（内容随机，不会被服务器按内容去重）
+    def upload(self):
+        name = f"u{self.index}-{len(self.uploads)}.bin"
+        with open(name, "wb") as f:
+            f.write(os.urandom(self.file_kb * 1024))
+        buffer = self.output.capture()
+        client.upload_command(self.sock, self.server_addr, ["UPD", self.own, name], self.username)
+        os.remove(name)
+        if "uploaded" not in buffer.getvalue():
+            return False
+        self.uploads.append(name)
+        return True
+
+    def download(self, name):
+        buffer = self.output.capture()
+        client.download_command(self.sock, self.server_addr, ["DWN", self.own, name], self.username)
+        ok = "download completed" in buffer.getvalue()
+        if os.path.exists(name):
+            os.remove(name)
+        return ok
+
+    # 所有客户端都登录之后（barrier）才开始计时，登录（注册时计算密码哈希）单独统计
+    def run(self, barrier, clock):
+        logged_in = self.login()
+        barrier.wait()
+        if not logged_in:
+            return
+        while time.monotonic() < clock["deadline"]:
+            self.run_op(self.random.choices(self.ops, self.weights)[0])
+        self.request(f"XIT {self.username}")
+        self.sock.close()
+
+
+# 所有客户端共用的统计
+class LoadStats:
+    def __init__(self):
+        self.latencies = {}             # {命令: [秒]}
+        self.errors = {}
+        self.timeouts = 0
+        self.lock = threading.Lock()
+
+    def record(self, op, seconds, ok):
+        with self.lock:
+            self.latencies.setdefault(op, []).append(seconds)
+            if not ok:
+                self.errors[op] = self.errors.get(op, 0) + 1
+
+    def timeout(self):
+        with self.lock:
+            self.timeouts += 1
+
+
+def run(clients, args, mix, port):
+    tmp = tempfile.mkdtemp()
+    workdir = os.path.join(tmp, "client")
+    os.makedirs(workdir)
+    proc = start_server(tmp, port, args.engine, shlex.split(args.server_args))
+    binary = args.protocol == "binary"
+    cwd = os.getcwd()
+    stats = LoadStats()
+    rss = {"start": read_rss(proc.pid), "peak": read_rss(proc.pid)}
+    try:
+        os.chdir(workdir)
+        server_addr = ("127.0.0.1", port)
+        setup = LoadClient(-1, server_addr, mix, args.file_kb, LoadStats(), sys.stdout, binary)
+        setup.login()
+        for i in range(SHARED_THREADS):
+            setup.command(f"CRT shared{i}")
+            setup.command(f"MSG shared{i} first message")
+
+        output = ThreadOutput(sys.stdout)
+        sys.stdout = output
+        done = threading.Event()
+
+        def sample_rss():
+            while not done.wait(0.2):
+                value = read_rss(proc.pid)
+                if value is not None:
+                    rss["peak"] = max(rss["peak"] or 0, value)
+
+        sampler = threading.Thread(target=sample_rss, daemon=True)
+        sampler.start()
+        clock = {}
+
+        def begin():
+            clock["started"] = time.perf_counter()
+            clock["deadline"] = time.monotonic() + args.duration
+
+        barrier = threading.Barrier(clients, action=begin)
+        workers = [LoadClient(i, server_addr, mix, args.file_kb, stats, output, binary) for i in range(clients)]
+        threads = [threading.Thread(target=w.run, args=(barrier, clock)) for w in workers]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.perf_counter() - clock["started"]
+        done.set()
+        sys.stdout = output.stream
+        rss["end"] = read_rss(proc.pid)
+        rss["hwm"] = read_rss(proc.pid, "VmHWM")
+    finally:
+        sys.stdout = sys.__stdout__
+        os.chdir(cwd)
+        proc.kill()
+        proc.wait()
+        shutil.rmtree(tmp, ignore_errors=True)
+
+    operations = {}
+    for op, values in sorted(stats.latencies.items()):
+        values.sort()
+        operations[op] = {"count": len(values), "errors": stats.errors.get(op, 0),
+                          "p50_ms": percentile(values, 0.50) * 1000, "p95_ms": percentile(values, 0.95) * 1000,
+                          "p99_ms": percentile(values, 0.99) * 1000, "max_ms": values[-1] * 1000}
+    total = sum(o["count"] for op, o in operations.items() if op != "LOGIN")
+    return {"clients": clients, "seconds": elapsed, "operations_total": total, "ops_per_s": total / elapsed,
+            "errors": sum(stats.errors.values()), "timeouts": stats.timeouts, "rss_kb": rss,
+            "operations": operations}
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True,
+                              timeout=10).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--clients", type=int, nargs="+", default=[1, 8, 32])
+    parser.add_argument("--duration", type=float, default=10, help="seconds each run sends commands")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="operation weights, e.g. MSG=10,RDT=5,UPD=1")
+    parser.add_argument("--file-kb", type=int, default=64, help="size of the files sent by UPD")
+    parser.add_argument("--engine", choices=["threads", "asyncio"], default="threads")
+    parser.add_argument("--server-args", default="", help="extra options passed to server.py")
+    parser.add_argument("--protocol", choices=["text", "binary"], default="text",
+                        help="send commands as text or as binary requests negotiated at LOGIN")
+    parser.add_argument("--port", type=int, default=47997)
+    parser.add_argument("--json", metavar="FILE", help="also write the results to FILE")
+    args = parser.parse_args()
+    mix = parse_mix(args.mix)
+    # UPD/DWN使用client.py的函数，按协商好的编码发送请求
+    client.SERVER_CAPS = {"bin"} if args.protocol == "binary" else set()
+
+    results = {}
+    for i, clients in enumerate(args.clients):
+        r = run(clients, args, mix, args.port + i)
+        results[clients] = r
+        print(f"clients={clients}: {r['ops_per_s']:.0f} ops/s, {r['errors']} error(s), {r['timeouts']} timeout(s), "
+              f"peak RSS {r['rss_kb']['peak'] or 0} KB", flush=True)
+
+    print(f"\n{args.engine} engine, {args.protocol} protocol, {args.duration:g}s per run, mix {args.mix}"
+          + (f", server args {args.server_args!r}" if args.server_args else ""))
+    print(f"{'clients':<9}{'op':<7}{'count':>8}{'errors':>8}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'max ms':>9}")
+    for clients, r in results.items():
+        for op, o in r["operations"].items():
+            print(f"{clients:<9}{op:<7}{o['count']:>8}{o['errors']:>8}{o['p50_ms']:>9.2f}{o['p95_ms']:>9.2f}"
+                  f"{o['p99_ms']:>9.2f}{o['max_ms']:>9.1f}")
+    print(f"\n{'clients':<9}{'ops/s':>9}{'errors':>8}{'timeouts':>10}{'RSS start KB':>14}{'RSS peak KB':>13}")
+    for clients, r in results.items():
+        print(f"{clients:<9}{r['ops_per_s']:>9.0f}{r['errors']:>8}{r['timeouts']:>10}"
+              f"{r['rss_kb']['start'] or 0:>14}{r['rss_kb']['peak'] or 0:>13}")
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"revision": git_revision(), "engine": args.engine, "protocol": args.protocol, "duration": args.duration, "mix": mix,
+                       "file_kb": args.file_kb, "server_args": args.server_args, "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,293 @@
+# 存储路径的微基准：不经过socket，直接调用ForumServer.command_process，测量每个命令的耗时和内存随数据量的变化
+#   主题长度：一个有N条消息的主题（1k ~ 1M），测 MSG / RDT（整个主题、最后一页）/ EDT / DLT，以及第一次访问时加载主题
+#   目录大小：N个主题、每个主题一个附件，测 LST / CRT / RMV / UPD（内容已存在，只加引用）/ DWN（登记传输）
+# 每个（后端, 规模）在单独的子进程中运行，RSS的增量就是这份数据常驻内存的大小；每个命令另外用tracemalloc测一次峰值分配
+# 最后按 log(耗时)/log(规模) 拟合出增长指数（1.0 表示线性），--plot 需要 matplotlib
+#
+#   python benchmarks/bench_storage.py --messages 1000 10000 100000 1000000 --threads 100 1000 10000
+#   python benchmarks/bench_storage.py --backends files --messages 1000 100000 --threads 0 --plot storage.png
+
+import os
+import sys
+import json
+import math
+import time
+import shutil
+import hashlib
+import argparse
+import tempfile
+import tracemalloc
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+from logger import log
+from thread_store import STATE_DIR
+from blob_store import MANIFEST
+from storage import BACKENDS, migrate
+from credentials import CredentialStore
+from server import ForumServer
+
+USER = "hans"                   # credentials.txt 中的第一个用户，作为所有主题和消息的作者
+BIG = "big"                     # 主题长度测试中的主题
+
+
+def read_rss():
+    try:
+        with open("/proc/self/status", "r", encoding="ascii") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+# 生成一个有n条消息的主题文件（主题文件格式见thread_store.py）
+def write_thread(path, n, creator=USER):
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(creator + "\n")
+        for i in range(1, n + 1):
+            f.write(f"{i} {creator}: synthetic message number {i} for the storage benchmark\n")
+
+
+# 生成n个主题（每个一条消息、一个附件），附件直接写成blob和引用表
+def write_directory(n):
+    refs = {}
+    for i in range(n):
+        title = f"t{i}"
+        write_thread(title, 1)
+        data = f"attachment {i}\n".encode("utf-8")
+        digest = hashlib.sha256(data).hexdigest()
+        blob = os.path.join(STATE_DIR, "blobs", digest[:2], digest)
+        os.makedirs(os.path.dirname(blob), exist_ok=True)
+        with open(blob, "wb") as f:
+            f.write(data)
+        refs[title] = {"a.txt": digest}
+    with open(os.path.join(STATE_DIR, MANIFEST), "w", encoding="utf-8") as f:
+        json.dump(refs, f)
+    return refs
+
+
+# sqlite后端先用 storage.migrate 把生成的主题文件导入数据库，再打开服务器
+def open_server(backend, fsync):
+    if backend == "sqlite":
+        credentials = CredentialStore()
+        credentials.load()
+        migrate(usernames=credentials.keys())
+    return ForumServer(0, cache_bytes=0, storage=backend, fsync=fsync)
+
+
+def start_server(server):
+    server.threads.recover()
+    server.catalog.load(server.credentials.keys())
+    server.blobs.load(list(server.catalog.entries))
+
+
+# 执行repeat次，返回 (耗时中位数秒, 峰值分配字节)；make(i)生成第i次的命令
+def measure(server, make, repeat):
+    times = []
+    for i in range(repeat):
+        msg = make(i)
+        started = time.perf_counter()
+        reply = server.command_process(msg, USER, None)
+        times.append(time.perf_counter() - started)
+        if reply.startswith("ERROR"):
+            raise SystemExit(f"{msg!r} failed: {reply}")
+
+    msg = make(repeat)
+    tracemalloc.start()
+    server.command_process(msg, USER, None)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return median(times), peak
+
+
+def run_messages(backend, n, repeat, fsync):
+    write_thread(BIG, n)
+    server = open_server(backend, fsync)
+    rss = read_rss()
+    start_server(server)
+
+    # 第一次访问时加载主题（files后端读入整个主题文件）
+    started = time.perf_counter()
+    server.threads.count(BIG)
+    results = {"load": {"seconds": time.perf_counter() - started, "peak_bytes": None}}
+    footprint = (read_rss() or 0) - (rss or 0)
+
+    middle = max(1, n // 2)
+    cases = {
+        "MSG": lambda i: f"MSG {BIG} one more message {i} {USER}",
+        "RDT page": lambda i: f"RDT {BIG} -20 20 {USER}",
+        "RDT all": lambda i: f"RDT {BIG} {USER}",
+        "EDT": lambda i: f"EDT {BIG} {middle} edited {i} {USER}",
+        "DLT": lambda i: f"DLT {BIG} {middle} {USER}",
+    }
+    for op, make in cases.items():
+        seconds, peak = measure(server, make, repeat if op != "RDT all" else max(1, repeat // 4))
+        results[op] = {"seconds": seconds, "peak_bytes": peak}
+    server.threads.close()
+    return results, footprint
+
+
+def run_directory(backend, n, repeat, fsync):
+    refs = write_directory(n)
+    server = open_server(backend, fsync)
+    rss = read_rss()
+    started = time.perf_counter()
+    start_server(server)
+    results = {"load": {"seconds": time.perf_counter() - started, "peak_bytes": None}}
+    footprint = (read_rss() or 0) - (rss or 0)
+
+    digest = refs["t0"]["a.txt"]
+    size = os.path.getsize(server.blobs.path(digest))
+    cases = {
+        "LST": lambda i: f"LST {USER}",
+        "LST recent": lambda i: f"LST sort=recent by={USER} {USER}",
+        "CRT": lambda i: f"CRT new{i} {USER}",
+        "UPD dedup": lambda i: f"UPD t{i % n} copy{i}.txt {size} {digest} 1 {USER}",
+        "DWN": lambda i: f"DWN t{i % n} a.txt resume 1 {USER}",
+        "RMV": lambda i: f"RMV new{i} {USER}",
+    }
+    for op, make in cases.items():
+        seconds, peak = measure(server, make, repeat)
+        results[op] = {"seconds": seconds, "peak_bytes": peak}
+    server.threads.close()
+    return results, footprint
+
+
+# 子进程：在临时目录里跑一个（后端, 测试, 规模），结果以JSON写到标准输出的最后一行
+def run_case(backend, sweep, n, repeat, fsync):
+    log.configure("warning")
+    tmp = tempfile.mkdtemp()
+    cwd = os.getcwd()
+    try:
+        shutil.copy(os.path.join(ROOT, "credentials.txt"), tmp)
+        os.chdir(tmp)
+        run = run_messages if sweep == "messages" else run_directory
+        results, footprint = run(backend, n, repeat, fsync)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(tmp, ignore_errors=True)
+    log.flush()
+    print(json.dumps({"results": results, "footprint_kb": footprint}))
+
+
+# log(耗时)对log(规模)的最小二乘斜率：约0为常数，约1为线性
+def growth(points):
+    points = [(math.log(n), math.log(s)) for n, s in points if s > 0]
+    if len(points) < 2:
+        return None
+    mx = sum(x for x, _ in points) / len(points)
+    my = sum(y for _, y in points) / len(points)
+    var = sum((x - mx) ** 2 for x, _ in points)
+    return sum((x - mx) * (y - my) for x, y in points) / var if var else None
+
+
+def plot(results, path):
+    try:
+        import matplotlib
+        matplotlib.use("Agg")
+        import matplotlib.pyplot as plt
+    except ImportError:
+        raise SystemExit("--plot needs matplotlib (pip install matplotlib)")
+
+    sweeps = [s for s in ("messages", "threads") if any(r["sweep"] == s for r in results)]
+    fig, axes = plt.subplots(2, len(sweeps), figsize=(7 * len(sweeps), 10), squeeze=False)
+    for col, sweep in enumerate(sweeps):
+        rows = [r for r in results if r["sweep"] == sweep]
+        for backend in sorted({r["backend"] for r in rows}):
+            runs = sorted((r for r in rows if r["backend"] == backend), key=lambda r: r["size"])
+            sizes = [r["size"] for r in runs]
+            for op in runs[0]["results"]:
+                style = "-" if backend == "files" else "--"
+                axes[0][col].plot(sizes, [r["results"][op]["seconds"] * 1000 for r in runs], style, marker="o",
+                                  label=f"{backend} {op}")
+                peaks = [r["results"][op]["peak_bytes"] for r in runs]
+                if None not in peaks:
+                    axes[1][col].plot(sizes, [p / 1024 for p in peaks], style, marker="o", label=f"{backend} {op}")
+            axes[1][col].plot(sizes, [max(r["footprint_kb"], 1) for r in runs], style, marker="s", color="black",
+                              label=f"{backend} resident (RSS growth)")
+        axes[0][col].set_title(f"time per command vs {sweep}")
+        axes[0][col].set_ylabel("ms (median)")
+        axes[1][col].set_title(f"memory vs {sweep}")
+        axes[1][col].set_ylabel("KB (peak allocation / RSS growth)")
+        for ax in (axes[0][col], axes[1][col]):
+            ax.set_xscale("log")
+            ax.set_yscale("log")
+            ax.set_xlabel(sweep)
+            ax.legend(fontsize=7)
+    fig.tight_layout()
+    fig.savefig(path)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, nargs="*", default=[1000, 10000, 100000, 1000000],
+                        help="thread lengths for MSG/RDT/EDT/DLT")
+    parser.add_argument("--threads", type=int, nargs="*", default=[100, 1000, 10000],
+                        help="thread counts (one attachment each) for LST/CRT/RMV/UPD/DWN")
+    parser.add_argument("--backends", nargs="+", choices=BACKENDS, default=list(BACKENDS))
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--fsync", default="never",
+                        help="fsync policy of the store (default never, so the numbers show CPU and I/O, not the disk)")
+    parser.add_argument("--json", metavar="FILE", help="also write the results to FILE")
+    parser.add_argument("--plot", metavar="PNG", help="chart time and memory against size (needs matplotlib)")
+    parser.add_argument("--case", nargs=3, metavar=("BACKEND", "SWEEP", "SIZE"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.case:
+        backend, sweep, size = args.case
+        run_case(backend, sweep, int(size), args.repeat, args.fsync)
+        return
+
+    results = []
+    for sweep, sizes in (("messages", args.messages), ("threads", args.threads)):
+        for backend in args.backends:
+            for size in sizes:
+                if size <= 0:
+                    continue
+                proc = subprocess.run([sys.executable, os.path.abspath(__file__), "--case", backend, sweep, str(size),
+                                       "--repeat", str(args.repeat), "--fsync", args.fsync],
+                                      capture_output=True, text=True)
+                if proc.returncode != 0:
+                    raise SystemExit(f"{backend} {sweep}={size} failed:\n{proc.stdout}{proc.stderr}")
+                case = json.loads(proc.stdout.strip().splitlines()[-1])
+                results.append({"backend": backend, "sweep": sweep, "size": size, **case})
+                summary = ", ".join(f"{op} {r['seconds'] * 1000:.2f}ms" for op, r in case["results"].items())
+                print(f"{backend} {sweep}={size}: {summary}; resident +{case['footprint_kb']} KB", flush=True)
+
+    for sweep in ("messages", "threads"):
+        rows = [r for r in results if r["sweep"] == sweep]
+        if not rows:
+            continue
+        print(f"\n{sweep} (median of {args.repeat}, fsync={args.fsync}; growth = slope of log(time) vs log(size))")
+        print(f"{'backend':<9}{'op':<12}" + "".join(f"{r['size']:>11}" for r in rows if r["backend"] == rows[0]["backend"])
+              + f"{'growth':>9}{'peak KB':>10}")
+        for backend in args.backends:
+            runs = [r for r in rows if r["backend"] == backend]
+            if not runs:
+                continue
+            for op in runs[0]["results"]:
+                times = [r["results"][op]["seconds"] for r in runs]
+                g = growth([(r["size"], t) for r, t in zip(runs, times)])
+                peak = runs[-1]["results"][op]["peak_bytes"]
+                print(f"{backend:<9}{op:<12}" + "".join(f"{t * 1000:>9.3f}ms" for t in times)
+                      + (f"{g:>9.2f}" if g is not None else f"{'-':>9}")
+                      + (f"{peak / 1024:>10.0f}" if peak is not None else f"{'-':>10}"))
+            print(f"{backend:<9}{'resident KB':<12}" + "".join(f"{r['footprint_kb']:>11}" for r in runs))
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"repeat": args.repeat, "fsync": args.fsync, "results": results}, f, indent=2)
+    if args.plot:
+        plot(results, args.plot)
+
+
+if __name__ == "__main__":
+    main()
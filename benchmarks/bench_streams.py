@@ -0,0 +1,130 @@
+# 并行多连接传输的扩展性：用1、2、4、8条TCP连接上传（每次新的随机内容）再下载同样大小的文件
+# 在临时目录里启动一个真正的服务器，通过client.py的上传/下载函数传输，报告吞吐量
+#
+#   python benchmarks/bench_streams.py --size-mb 256 --streams 1 2 4 8 --engine threads
+
+import os
+import sys
+import io
+import json
+import time
+import socket
+import shutil
+import argparse
+import tempfile
+import subprocess
+import contextlib
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+import client
+from transfer import DEFAULT_CHUNK_SIZE, DEFAULT_MAX_STREAMS
+
+
+def start_server(tmp, port, engine):
+    shutil.copy(os.path.join(ROOT, "credentials.txt"), tmp)
+    proc = subprocess.Popen([sys.executable, os.path.join(ROOT, "server.py"), str(port), "--engine", engine,
+                             "--max-streams", str(DEFAULT_MAX_STREAMS)],
+                            cwd=tmp, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    time.sleep(1)
+    return proc
+
+
+# 写一个size_mb MB的随机文件
+def write_random(path, size_mb):
+    with open(path, "wb") as f:
+        for _ in range(size_mb):
+            f.write(os.urandom(1024 * 1024))
+
+
+def first_user():
+    with open(os.path.join(ROOT, "credentials.txt"), "r", encoding="utf-8") as f:
+        return f.readline().split()
+
+
+# 执行一次上传或下载，返回耗时（不计算客户端算SHA-256的时间）
+def timed(func, *args):
+    quiet = io.StringIO()
+    with contextlib.redirect_stdout(quiet):
+        started = time.perf_counter()
+        func(*args)
+        elapsed = time.perf_counter() - started
+    return elapsed, quiet.getvalue()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size-mb", type=int, default=128)
+    parser.add_argument("--streams", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--engine", choices=["threads", "asyncio"], default="threads")
+    parser.add_argument("--port", type=int, default=47999)
+    parser.add_argument("--json", metavar="FILE", help="also write the results to FILE")
+    args = parser.parse_args()
+
+    username, password = first_user()
+    tmp = tempfile.mkdtemp()
+    workdir = os.path.join(tmp, "client")
+    os.makedirs(workdir)
+    proc = start_server(tmp, args.port, args.engine)
+    cwd = os.getcwd()
+    results = {}
+    try:
+        os.chdir(workdir)
+        udp_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        server_addr = ("127.0.0.1", args.port)
+        with contextlib.redirect_stdout(io.StringIO()):
+            if not client.login(udp_sock, server_addr, username, password):
+                raise SystemExit("login failed")
+        client.udp_msg_process(udp_sock, server_addr, f"CRT bench {username}")
+
+        src = "src.bin"
+        client.CHUNK_SIZE = DEFAULT_CHUNK_SIZE
+        for streams in args.streams:
+            client.STREAMS = streams
+            up, down = [], []
+            for i in range(args.repeat):
+                name = f"up-{streams}-{i}.bin"
+                # 每次上传新的随机内容：服务器已经有的内容会去重，根本不传输
+                write_random(name, args.size_mb)
+                # 上传时间里包含客户端计算摘要的时间，单独减去
+                digest_started = time.perf_counter()
+                client.file_digest(name)
+                digest_time = time.perf_counter() - digest_started
+                elapsed, log = timed(client.upload_command, udp_sock, server_addr, ["UPD", "bench", name], username)
+                assert f"Ready to upload {args.size_mb * 1024 * 1024} bytes" in log, log
+                assert "The file is uploaded." in log, log
+                up.append(elapsed - digest_time)
+
+                os.rename(name, src)
+                elapsed, log = timed(client.download_command, udp_sock, server_addr, ["DWN", "bench", name], username)
+                assert os.path.getsize(name) == os.path.getsize(src), log
+                os.remove(name)
+                down.append(elapsed)
+
+            results[streams] = {
+                "upload_mb_per_s": args.size_mb / min(up),
+                "download_mb_per_s": args.size_mb / min(down),
+            }
+            print(f"streams={streams}: upload {results[streams]['upload_mb_per_s']:.0f} MB/s, "
+                  f"download {results[streams]['download_mb_per_s']:.0f} MB/s", flush=True)
+
+        client.udp_msg_process(udp_sock, server_addr, f"XIT {username}")
+    finally:
+        os.chdir(cwd)
+        proc.kill()
+        shutil.rmtree(tmp, ignore_errors=True)
+
+    print(f"\n{args.size_mb} MB over loopback, {args.engine} engine, best of {args.repeat} "
+          f"(download time includes the client's SHA-256 check)")
+    print(f"{'streams':<10}{'upload MB/s':>14}{'download MB/s':>16}")
+    for streams, r in results.items():
+        print(f"{streams:<10}{r['upload_mb_per_s']:>14.0f}{r['download_mb_per_s']:>16.0f}")
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"size_mb": args.size_mb, "engine": args.engine, "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+# 文件传输吞吐量对比：原来的4KB read+sendall/recv循环 vs sendfile + recv_into
+# 在本机回环地址上传输一个生成的文件，报告吞吐量和两端的CPU时间
+#
+#   python benchmarks/bench_transfer.py --size-mb 256 --repeat 3
+
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import tempfile
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from transfer import send_file, recv_file, DEFAULT_CHUNK_SIZE
+
+
+# 原来的发送/接收循环
+def legacy_send(sock, path, chunk_size):
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(4096)
+            if not chunk:
+                break
+            sock.sendall(chunk)
+
+
+def legacy_recv(sock, path, chunk_size):
+    with open(path, "wb") as f:
+        while True:
+            chunk = sock.recv(4096)
+            if not chunk:
+                break
+            f.write(chunk)
+
+
+def zerocopy_send(sock, path, chunk_size):
+    with open(path, "rb") as f:
+        send_file(sock, f)
+
+
+def zerocopy_recv(sock, path, chunk_size):
+    with open(path, "wb", buffering=0) as f:
+        recv_file(sock, f, chunk_size)
+
+
+METHODS = {
+    "legacy-4k": (legacy_send, legacy_recv),
+    "sendfile+recv_into": (zerocopy_send, zerocopy_recv),
+}
+
+
+# 传输一次，返回 (耗时, 发送端CPU时间, 接收端CPU时间)
+def run_once(send, recv, src, dst, chunk_size):
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(1)
+    result = {}
+
+    def receiver():
+        link, _ = listener.accept()
+        start = time.thread_time()
+        recv(link, dst, chunk_size)
+        result["recv_cpu"] = time.thread_time() - start
+        link.close()
+
+    t = threading.Thread(target=receiver)
+    t.start()
+
+    started = time.perf_counter()
+    with socket.create_connection(listener.getsockname()) as s:
+        cpu = time.thread_time()
+        send(s, src, chunk_size)
+        send_cpu = time.thread_time() - cpu
+    t.join()
+    elapsed = time.perf_counter() - started
+    listener.close()
+    return elapsed, send_cpu, result["recv_cpu"]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size-mb", type=int, default=128)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE)
+    parser.add_argument("--json", metavar="FILE", help="also write the results to FILE")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        src = os.path.join(tmp, "src.bin")
+        dst = os.path.join(tmp, "dst.bin")
+        with open(src, "wb") as f:
+            for _ in range(args.size_mb):
+                f.write(os.urandom(1024 * 1024))
+
+        results = {}
+        for name, (send, recv) in METHODS.items():
+            runs = [run_once(send, recv, src, dst, args.chunk_size) for _ in range(args.repeat)]
+            assert os.path.getsize(dst) == os.path.getsize(src)
+            best = min(runs)
+            results[name] = {
+                "seconds": best[0],
+                "mb_per_s": args.size_mb / best[0],
+                "send_cpu_s": best[1],
+                "recv_cpu_s": best[2],
+            }
+
+    print(f"{args.size_mb} MB over loopback, best of {args.repeat}, chunk size {args.chunk_size}")
+    print(f"{'method':<22}{'MB/s':>10}{'send CPU s':>12}{'recv CPU s':>12}")
+    for name, r in results.items():
+        print(f"{name:<22}{r['mb_per_s']:>10.0f}{r['send_cpu_s']:>12.3f}{r['recv_cpu_s']:>12.3f}")
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"size_mb": args.size_mb, "chunk_size": args.chunk_size, "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,155 @@
+import os
+import threading
+
+from thread_store import STATE_DIR
+from transfer import file_digest
+from manifest import Manifest
+from logger import log
+
+MANIFEST = "attachments.json"
+FLUSH_INTERVAL = 5              # 引用表快照的写盘间隔（秒）
+
+
+# 附件按内容存储：每份内容只保存一次，文件名是SHA-256（.forum/blobs/<前两位>/<sha256>）
+# 每个主题的附件只记录 文件名 -> sha256 的引用，持久化为 .forum/attachments.json 快照
+# + .forum/attachments.log（每次加引用、删除主题各追加一行，见manifest.py）
+# 引用计数为0的内容会被删除
+class BlobStore:
+    def __init__(self, root="."):
+        self.root = root
+        self.refs = {}                  # {threadtitle: {filename: sha256}}
+        self.counts = {}                # {sha256: 引用数}
+        self.dirty = False
+        self.lock = threading.Lock()
+        self.save_lock = threading.Lock()
+        os.makedirs(os.path.join(root, STATE_DIR, "blobs"), exist_ok=True)
+        self.manifest = Manifest(self.manifest_path(), "refs")
+
+    def manifest_path(self):
+        return os.path.join(self.root, STATE_DIR, MANIFEST)
+
+    def path(self, digest):
+        return os.path.join(self.root, STATE_DIR, "blobs", digest[:2], digest)
+
+    # 加载引用表快照并重放之后的记录，导入旧版保存在工作目录中的 <threadtitle>-<filename>，删除没有引用的内容
+    # uploaded(threadtitle, filename)：主题中是否有这个文件的上传记录，用来区分有歧义的旧版文件名
+    def load(self, titles, uploaded=None):
+        refs, records = self.manifest.load()
+        self.refs = refs or {}
+        for r in records:
+            if r["op"] == "add":
+                self.refs.setdefault(r["title"], {})[r["filename"]] = r["sha256"]
+            else:
+                self.refs.pop(r["title"], None)
+        self.dirty = bool(records)
+        for files in self.refs.values():
+            for digest in files.values():
+                self.counts[digest] = self.counts.get(digest, 0) + 1
+
+        imported = self.import_legacy(titles, uploaded)
+        removed = self.collect_garbage()
+        log.info("Blobs", f"{sum(len(f) for f in self.refs.values())} attachment(s) in {len(self.counts)} blob(s)"
+                          f" ({imported} imported, {removed} unreferenced blob(s) removed).")
+
+    # 旧版文件名 <threadtitle>-<filename> 只和目录中完整的主题名比较；主题名本身带 "-" 时可能有多个主题符合
+    # （例如 a 和 a-b 都符合 a-b-x），这时选有这个文件上传记录的主题，都没有记录时选最长的主题名
+    def import_legacy(self, titles, uploaded=None):
+        imported = 0
+        titles = set(titles)
+        for name in os.listdir(self.root):
+            path = os.path.join(self.root, name)
+            if name in titles or not os.path.isfile(path):
+                continue
+            matches = [t for t in titles if name.startswith(t + "-") and len(name) > len(t) + 1]
+            if len(matches) > 1 and uploaded is not None:
+                matches = [t for t in matches if uploaded(t, name[len(t) + 1:])] or matches
+            if not matches:
+                continue
+            title = max(matches, key=len)
+            filename = name[len(title) + 1:]
+            if self.commit(path, file_digest(path), title, filename):
+                imported += 1
+        return imported
+
+    # 删除没有被引用的内容（上一次在写入引用表之前中断时留下的）
+    def collect_garbage(self):
+        removed = 0
+        blobs = os.path.join(self.root, STATE_DIR, "blobs")
+        for prefix in os.listdir(blobs):
+            for digest in os.listdir(os.path.join(blobs, prefix)):
+                if digest not in self.counts:
+                    os.remove(os.path.join(blobs, prefix, digest))
+                    removed += 1
+        return removed
+
+    # 写入引用表快照（先写临时文件再替换），然后丢掉快照已经包含的记录
+    def save(self):
+        with self.save_lock:
+            with self.lock:
+                data, seq = self.manifest.snapshot(self.refs)
+                self.dirty = False
+
+            self.manifest.write(data)
+            with self.lock:
+                self.manifest.trim(seq)
+
+    # 后台定期写快照
+    def start_flusher(self, interval=FLUSH_INTERVAL):
+        def loop():
+            while True:
+                threading.Event().wait(interval)
+                if self.dirty:
+                    self.save()
+
+        threading.Thread(target=loop, daemon=True).start()
+
+    # 加一个引用并追加到日志；调用者持有锁
+    def _attach(self, threadtitle, filename, digest):
+        self.refs.setdefault(threadtitle, {})[filename] = digest
+        self.counts[digest] = self.counts.get(digest, 0) + 1
+        self.manifest.append({"op": "add", "title": threadtitle, "filename": filename, "sha256": digest})
+        self.dirty = True
+
+    def _release(self, digest):
+        self.counts[digest] -= 1
+        if self.counts[digest] == 0:
+            del self.counts[digest]
+            os.remove(self.path(digest))
+
+    def lookup(self, threadtitle, filename):
+        return self.refs.get(threadtitle, {}).get(filename)
+
+    # 已经有这份内容、主题中还没有这个文件时直接加一个引用（上传时不需要再传输文件），返回是否成功
+    def attach_existing(self, threadtitle, filename, digest):
+        with self.lock:
+            if digest not in self.counts or filename in self.refs.get(threadtitle, {}):
+                return False
+            self._attach(threadtitle, filename, digest)
+            return True
+
+    # 把收完并校验过的文件src存为内容digest（已经有时丢弃src），并加上引用
+    # 主题中已经有这个文件时什么都不做，返回False：检查和加引用在同一个锁里，同时提交的同名上传只有一个成功
+    def commit(self, src, digest, threadtitle, filename):
+        with self.lock:
+            if filename in self.refs.get(threadtitle, {}):
+                return False
+            if digest in self.counts:
+                os.remove(src)
+            else:
+                os.makedirs(os.path.dirname(self.path(digest)), exist_ok=True)
+                os.replace(src, self.path(digest))
+            self._attach(threadtitle, filename, digest)
+            return True
+
+    # 删除主题的所有附件引用，释放不再被引用的内容
+    def remove_thread(self, threadtitle):
+        with self.lock:
+            files = self.refs.pop(threadtitle, None)
+            if not files:
+                return 0
+            self.manifest.append({"op": "rmv", "title": threadtitle})
+            self.dirty = True
+            for digest in files.values():
+                self._release(digest)
+            return len(files)
+
@@ -0,0 +1,147 @@
+import os
+import time
+import threading
+
+from thread_store import STATE_DIR, parse_line
+from manifest import Manifest
+from logger import log
+
+MANIFEST = "catalog.json"
+FLUSH_INTERVAL = 5              # 消息数/修改时间的变化延迟写盘（秒）
+
+# LST支持的排序方式
+SORT_KEYS = {
+    "title": (lambda e: e["title"], False),
+    "recent": (lambda e: e["modified"], True),
+    "messages": (lambda e: e["messages"], True),
+    "created": (lambda e: e["created"], False),
+}
+
+
+# 主题目录：记录每个主题的标题、创建者、消息数和最后修改时间
+# 持久化为 .forum/catalog.json 快照 + .forum/catalog.log（CRT/RMV各追加一行，见manifest.py），LST直接在内存中查询
+class ThreadCatalog:
+    def __init__(self, root="."):
+        self.root = root
+        self.entries = {}               # {threadtitle: {...}}
+        self.dirty = False
+        self.lock = threading.Lock()
+        self.save_lock = threading.Lock()   # 同一时间只有一个线程写目录文件，后写的快照不会被先写的覆盖
+        self.manifest = Manifest(self.path(), "threads")
+
+    def path(self):
+        return os.path.join(self.root, STATE_DIR, MANIFEST)
+
+    # 加载目录快照并重放之后的增删记录，没有快照时扫描一次工作目录重建
+    def load(self, usernames):
+        entries, records = self.manifest.load()
+        if entries is None:
+            self.rebuild(usernames)
+            return
+
+        for r in records:
+            if r["op"] == "add":
+                entries[r["entry"]["title"]] = r["entry"]
+            else:
+                entries.pop(r["title"], None)
+        self.entries = entries
+        self.dirty = bool(records)
+        log.info("Catalog", f"Loaded {len(self.entries)} thread(s) from {self.path()}"
+                            f" ({len(records)} change(s) replayed).")
+
+    # 旧版的做法：第一行是已注册用户名的文件就是主题
+    def rebuild(self, usernames):
+        entries = {}
+        for filename in os.listdir(self.root):
+            path = os.path.join(self.root, filename)
+            if not os.path.isfile(path):
+                continue
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    creator = f.readline().strip()
+                    if creator not in usernames:
+                        continue
+                    count = sum(1 for line in f if parse_line(line)[0] == "msg")
+            except Exception:
+                continue
+
+            mtime = os.path.getmtime(path)
+            entries[filename] = {
+                "title": filename,
+                "creator": creator,
+                "messages": count,
+                "created": mtime,
+                "modified": mtime,
+            }
+
+        with self.lock:
+            self.entries = entries
+        self.save()
+        log.info("Catalog", f"Rebuilt catalog with {len(entries)} thread(s).")
+
+    # 写入目录快照（先写临时文件再替换），然后丢掉快照已经包含的增删记录
+    def save(self):
+        with self.save_lock:
+            with self.lock:
+                data, seq = self.manifest.snapshot(self.entries)
+                self.dirty = False
+
+            self.manifest.write(data)
+            with self.lock:
+                self.manifest.trim(seq)
+
+    # 后台定期写盘
+    def start_flusher(self, interval=FLUSH_INTERVAL):
+        def loop():
+            while True:
+                threading.Event().wait(interval)
+                if self.dirty:
+                    self.save()
+
+        threading.Thread(target=loop, daemon=True).start()
+
+    def __contains__(self, title):
+        return title in self.entries
+
+    def add(self, title, creator):
+        now = time.time()
+        with self.lock:
+            self.entries[title] = {
+                "title": title,
+                "creator": creator,
+                "messages": 0,
+                "created": now,
+                "modified": now,
+            }
+            self.manifest.append({"op": "add", "entry": self.entries[title]})
+            self.dirty = True
+
+    def remove(self, title):
+        with self.lock:
+            if self.entries.pop(title, None) is None:
+                return
+            self.manifest.append({"op": "rmv", "title": title})
+            self.dirty = True
+
+    # 主题有变化：更新消息数（None表示不变）和修改时间
+    def touch(self, title, messages=None):
+        with self.lock:
+            entry = self.entries.get(title)
+            if entry is None:
+                return
+            if messages is not None:
+                entry["messages"] = messages
+            entry["modified"] = time.time()
+            self.dirty = True
+
+    # 查询主题列表，可按创建者/标题子串过滤并排序
+    def list(self, sort="title", creator=None, match=None):
+        key, reverse = SORT_KEYS.get(sort, SORT_KEYS["title"])
+        with self.lock:
+            entries = [
+                e for e in self.entries.values()
+                if (creator is None or e["creator"] == creator)
+                and (match is None or match in e["title"])
+            ]
+        entries.sort(key=key, reverse=reverse)
+        return entries
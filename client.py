@@ -1,19 +1,52 @@
 import sys
+import time
 import socket
 import os
+import argparse
+import random
+import itertools
+import threading
+from transfer import (recv_range, send_line, recv_line, send_frames, recv_frames, file_digest, load_ranges,
+                      add_range, missing_ranges, split_ranges, DEFAULT_CHUNK_SIZE)
+from protocol import (Reassembler, build_batch, parse_batch_result, MAX_DATAGRAM, format_caps, split_caps,
+                      encode_request, read_reply, split_fields, typed_fields)
 
 TIMEOUT = 3.0
 RETRY_TIMES = 3
+DEFAULT_WINDOW = 8              # 批处理模式下同时在途的请求数
+MAX_WINDOW = 32                 # 不超过服务器为每个会话缓存的回复数
+MIN_RTO = 0.05
+CHUNK_SIZE = DEFAULT_CHUNK_SIZE # 下载时每次接收的字节数（--chunk-size）
+STREAMS = 1                     # 上传/下载时并行的TCP连接数（--streams）
+COMPRESSION = True              # 登录时是否请求压缩（--no-compress关闭）
+BINARY = True                   # 登录时是否请求二进制协议（--no-binary关闭）
+SERVER_CAPS = set()             # 服务器在登录时同意使用的编码
+# 上传出现这些错误时重新申请，只补传缺少的区间
+RETRYABLE_ERRORS = ("ERROR INCOMPLETE", "ERROR BAD_CHECKSUM", "ERROR TOO_LARGE", "ERROR DIGEST_MISMATCH",
+                    "ERROR SIZE_MISMATCH", "ERROR BAD_TOKEN")
+
+# 请求编号：随机起点，避免客户端重启后与服务器缓存的旧编号冲突
+request_ids = itertools.count(random.randrange(1 << 32))
 
 # UDP向服务器发送消息并接收响应
 def udp_msg_process(udp_sock, server_addr, send_msg):
 
     udp_sock.settimeout(TIMEOUT)
+    reassembler = Reassembler()
+    req_id = f"{next(request_ids):x}"
     for _ in range(RETRY_TIMES):
         try:
-            udp_sock.sendto(send_msg.encode("utf-8"), server_addr)
-            data, _ = udp_sock.recvfrom(8192)
-            return data.decode("utf-8", errors="ignore")
+            # 重传时编号不变，服务器不会重复执行
+            udp_sock.sendto(encode_request(req_id, send_msg), server_addr)
+            # 大的回复会分成多个数据报，收齐后再返回；编号不匹配的是之前请求迟到的回复，丢弃
+            while True:
+                datagram, _ = udp_sock.recvfrom(65535)
+                data = reassembler.feed(datagram)
+                if data is None:
+                    continue
+                reply_id, reply = read_reply(data)
+                if reply_id is None or reply_id == req_id:
+                    return reply
         
         except socket.timeout:
             print("[Client] UDP timeout, retry...")
@@ -23,58 +56,528 @@ def udp_msg_process(udp_sock, server_addr, send_msg):
     print("[Client] Communication with the server failed.")
     return ""
 
-# TCP上传文件
-def tcp_upload(server_ip, server_port, local_filename, remote_threadtitle, remote_filename, username):
-
-    # 连接
-    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-        s.connect((server_ip, server_port))
-        print(f"[Client] Connected to server. Uploading {local_filename} now...")
-
+# 往返时间估计（Jacobson/Karels），超时时间随测得的RTT调整
+class RttEstimator:
+    def __init__(self):
+        self.srtt = None
+        self.rttvar = None
+        self.rto = TIMEOUT
+
+    def sample(self, rtt):
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+        self.rto = min(max(self.srtt + 4 * self.rttvar, MIN_RTO), TIMEOUT)
+
+# 流水线发送：最多window个请求同时在途，按编号匹配回复，
+# 只重传超时的请求，回复按提交顺序输出
+class Pipeline:
+    def __init__(self, udp_sock, server_addr, window=DEFAULT_WINDOW, output=print):
+        self.udp_sock = udp_sock
+        self.server_addr = server_addr
+        self.window = max(1, min(window, MAX_WINDOW))
+        self.output = output
+        self.rtt = RttEstimator()
+        self.reassembler = Reassembler()
+        self.inflight = {}          # {req_id: [序号, 消息, 发送时间, 重传次数]}
+        self.results = {}           # {序号: 回复}
+        self.submitted = 0
+        self.written = 0
+        self.retransmits = 0
+
+    def _send(self, req_id, entry):
+        entry[2] = time.monotonic()
+        self.udp_sock.sendto(encode_request(req_id, entry[1]), self.server_addr)
+
+    # 提交一个请求，窗口满时先等待回复
+    def submit(self, msg):
+        while len(self.inflight) >= self.window:
+            self.poll()
+        req_id = f"{next(request_ids):x}"
+        entry = [self.submitted, msg, 0, 0]
+        self.submitted += 1
+        self.inflight[req_id] = entry
+        self._send(req_id, entry)
+
+    # 超时时间：第n次重传等待 rto * 2^n
+    def _deadline(self, entry):
+        return entry[2] + self.rtt.rto * (2 ** entry[3])
+
+    # 接收一个数据报，或处理已经超时的请求
+    def poll(self):
+        now = time.monotonic()
+        wait = min(self._deadline(e) for e in self.inflight.values()) - now
         try:
-            with open(local_filename, "rb") as f:
-                while True:
-                    chunk = f.read(4096)
-                    if not chunk:
-                        break
-                    s.sendall(chunk)
-        except Exception as e:
-            print(f"[Client] Failed to open the file to be uploaded: {e}")
+            self.udp_sock.settimeout(max(wait, 0.001))
+            datagram, _ = self.udp_sock.recvfrom(65535)
+        except socket.timeout:
+            datagram = None
+
+        if datagram is not None:
+            data = self.reassembler.feed(datagram)
+            if data is not None:
+                reply_id, reply = read_reply(data)
+                entry = self.inflight.pop(reply_id, None)
+                if entry is not None:
+                    # 只用没有重传过的请求估计RTT（Karn算法）
+                    if entry[3] == 0:
+                        self.rtt.sample(time.monotonic() - entry[2])
+                    self.results[entry[0]] = reply
+
+        # 只重传超时的请求
+        now = time.monotonic()
+        for req_id, entry in list(self.inflight.items()):
+            if now < self._deadline(entry):
+                continue
+            if entry[3] + 1 >= RETRY_TIMES:
+                del self.inflight[req_id]
+                self.results[entry[0]] = "[Client] Communication with the server failed."
+                continue
+            entry[3] += 1
+            self.retransmits += 1
+            self._send(req_id, entry)
+
+        self._write_ready()
+
+    # 按提交顺序输出已经收到的回复
+    def _write_ready(self):
+        while self.written in self.results:
+            self.output(self.results.pop(self.written))
+            self.written += 1
+
+    # 等待所有在途的请求完成
+    def drain(self):
+        while self.inflight:
+            self.poll()
+        self._write_ready()
+
+# 到服务器的TCP连接池：一个会话中的多次上传/下载复用同一批连接，不用每个文件重新连接
+class TransferConnections:
+    def __init__(self):
+        self.idle = []
+        self.lock = threading.Lock()
+
+    # 取一条连接，返回 (socket, 是否是复用的连接)
+    def acquire(self, server_addr):
+        with self.lock:
+            if self.idle:
+                return self.idle.pop(), True
+        return socket.create_connection(server_addr), False
+
+    def release(self, sock):
+        with self.lock:
+            self.idle.append(sock)
+
+    # 出示传输令牌，返回 (socket, 服务器的回复)；复用的连接可能已经被服务器关闭，这时换一条新连接
+    def open_transfer(self, server_addr, token):
+        while True:
+            sock, reused = self.acquire(server_addr)
+            try:
+                send_line(sock, f"TRANSFER {token}")
+                reply = recv_line(sock)
+            except OSError:
+                reply = None
+            if reply is not None:
+                return sock, reply
+            sock.close()
+            if not reused:
+                return None, "ERROR INCOMPLETE"
+
+connections = TransferConnections()
+
+# TCP上传文件：在一条连接上依次发送若干区间，返回服务器对最后一个区间的回复
+# （"OK" 表示文件已提交，"RANGE_OK" 表示区间已收到，或 "ERROR <原因> ..."）
+def tcp_upload(server_ip, server_port, local_filename, token, ranges):
+    s, result = connections.open_transfer((server_ip, server_port), token)
+    if result != "READY":
+        if s is not None:
+            connections.release(s)
+        return result
+
+    result = "RANGE_OK"
+    try:
+        with open(local_filename, "rb") as f:
+            for start, end in ranges:
+                send_line(s, f"PUT {start} {end}")
+                send_frames(s, f, start, CHUNK_SIZE, end - start, compress="zlib" in SERVER_CAPS)
+                result = recv_line(s) or "ERROR INCOMPLETE"
+                if result not in ("OK", "RANGE_OK"):
+                    break
+    except OSError as e:
+        print(f"[Client] Upload interrupted: {e}")
+        result = "ERROR INCOMPLETE"
+
+    # 出错时服务器会关闭连接，正常结束的连接留给下一次传输
+    if result in ("OK", "RANGE_OK"):
+        connections.release(s)
+    else:
+        s.close()
+    return result
+
+# TCP下载文件：在一条连接上依次接收若干区间，用pwrite写到partial的对应位置，
+# 收到的区间记录在 <partial>.ranges 中，下次只下载缺少的部分
+def tcp_download(server_ip, server_port, partial, lock, token, ranges):
+    s, reply = connections.open_transfer((server_ip, server_port), token)
+    if reply != "READY":
+        if s is not None:
+            connections.release(s)
+        print(f"[Client] Download failed: {reply}")
+        return
+
+    # 协商了压缩时请服务器按帧发送，能压缩的块压缩
+    compressed = "zlib" in SERVER_CAPS
+    fd = os.open(partial, os.O_WRONLY | os.O_CREAT, 0o644)
+    try:
+        for start, end in ranges:
+            if compressed:
+                send_line(s, f"GET {start} {end} z")
+                n, status = recv_frames(s, fd, start, CHUNK_SIZE, end - start)
+            else:
+                send_line(s, f"GET {start} {end}")
+                n = recv_range(s, fd, start, end - start, CHUNK_SIZE)
+                status = "OK"
+            with lock:
+                add_range(partial, start, start + n)
+            if n < end - start or status != "OK":
+                s.close()
+                return
+    except OSError as e:
+        print(f"[Client] Download interrupted: {e}")
+        s.close()
+        return
+    finally:
+        os.close(fd)
+    send_line(s, "DONE")
+    connections.release(s)
+
+# 每条连接一个线程，并行执行，返回每条连接的结果
+def run_streams(func, assignments, *args):
+    results = [None] * len(assignments)
+
+    def worker(i):
+        results[i] = func(*args, assignments[i])
+
+    workers = [threading.Thread(target=worker, args=(i,)) for i in range(len(assignments))]
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+    return results
+
+# 只需要一次UDP往返的论坛命令
+FORUM_COMMANDS = ("CRT", "MSG", "DLT", "EDT", "LST", "RDT", "RMV", "STATS")
+
+# 发给服务器的请求：协商了二进制协议时是 (命令, 参数)，否则是末尾加上用户名的文本命令
+# BATCH中的命令总是文本（text=True）
+def make_request(cmd, fields, username, text=False):
+    if "bin" in SERVER_CAPS and not text:
+        return cmd, typed_fields(cmd, fields)
+    return " ".join([cmd] + [str(f) for f in fields] + [username])
+
+# 把用户输入的命令转换成发给服务器的请求，参数不对时打印用法并返回None
+# MSG/EDT的消息内容取输入行中剩下的全部内容，二进制请求中保留原样的空白
+def build_command(line, username, text=False):
+    parts = line.split()
+    cmd = parts[0].upper()
+    fields = split_fields(cmd, line.split(None, 1)[1]) if len(parts) > 1 else []
+
+    # CRT
+    if cmd == "CRT":
+        if len(parts) != 2:
+            print("correct usage:CRT <threadtitle>")
+            return None
+        return make_request(cmd, fields, username, text)
+
+    # MSG
+    if cmd == "MSG":
+        if len(parts) < 3:
+            print("correct usage: MSG <threadtitle> <message>")
+            return None
+        return make_request(cmd, fields, username, text)
+
+    # DLT
+    if cmd == "DLT":
+        if len(parts) != 3:
+            print("correct usage: DLT <threadtitle> <messagenumber>")
+            return None
+        return make_request(cmd, fields, username, text)
+
+    # EDT
+    if cmd == "EDT":
+        if len(parts) < 4:
+            print("correct usage: EDT <threadtitle> <messagenumber> <new_message>")
+            return None
+        return make_request(cmd, fields, username, text)
+
+    # LST：可选的 sort=/by=/match= 参数
+    if cmd == "LST":
+        return make_request(cmd, fields, username, text)
+
+    # RDT：可选的分页参数原样传给服务器
+    if cmd == "RDT":
+        if len(parts) < 2 or len(parts) > 4:
+            print("correct usage: RDT <threadtitle> [offset] [limit]")
+            return None
+        return make_request(cmd, fields, username, text)
+
+    # RMV
+    if cmd == "RMV":
+        if len(parts) != 2:
+            print("correct usage: RMV <threadtitle>")
+            return None
+        return make_request(cmd, fields, username, text)
+
+    # STATS（仅限管理员）
+    if cmd == "STATS":
+        return make_request(cmd, [], username, text)
+
+    return None
+
+# UPD：先通过UDP申请，再用TCP上传
+def upload_command(udp_sock, server_addr, parts, username):
+    server_ip, server_port = server_addr
+
+    # UPD threadtitle filename
+    if len(parts) != 3:
+        print("correct usage: UPD <threadtitle> <filename>")
+        return
+    threadtitle = parts[1]
+    filename = parts[2]
+
+    # 检查文件是否存在
+    if not os.path.exists(filename):
+        print(f"File {filename} does not exist.")
+        return
+
+    # 带上大小和摘要，服务器会告诉我们还缺少哪些区间，中断后重试只发送缺少的部分
+    size = os.path.getsize(filename)
+    to_send = make_request("UPD", [threadtitle, filename, size, file_digest(filename), STREAMS], username)
+    for _ in range(RETRY_TIMES):
+        resp = udp_msg_process(udp_sock, server_addr, to_send)
+        if resp == "UPD_DEDUP":
+            print("[Client] The server already has this content, the file is uploaded without sending it.")
+            return
+        if not resp or not resp.startswith("UPD_OK "):
+            print(resp)
             return
+        token = resp.split()[1]
+        missing = [tuple(map(int, r.split("-"))) for r in resp.split()[3:]]
+
+        # 开始上传：缺少的区间平均分给STREAMS条连接；什么都不缺时发送一个空区间让服务器提交
+        print(f"[Client] Ready to upload {sum(e - s for s, e in missing)} bytes over {STREAMS} TCP connection(s)...")
+        assignments = split_ranges(missing, STREAMS)
+        if not missing:
+            assignments[0] = [(size, size)]
+        results = run_streams(tcp_upload, assignments, server_ip, server_port, filename, token)
+
+        if "OK" in results:
+            print("[Client] The file is uploaded.")
+            return
+        errors = [r for r in results if r != "RANGE_OK"]
+        print(f"[Client] Upload failed: {errors[0] if errors else 'not committed'}")
+        if errors and not errors[0].startswith(RETRYABLE_ERRORS):
+            return
+        print("[Client] Resuming upload...")
 
-        print(f"[Client] File {local_filename} upload completed.")
+# DWN：先通过UDP申请，再用TCP下载
+def download_command(udp_sock, server_addr, parts, username):
+    server_ip, server_port = server_addr
 
-# TCP下载文件
-def tcp_download(server_ip, server_port, local_filename, remote_threadtitle, remote_filename, username):
-    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-        s.connect((server_ip, server_port))
-        print(f"[Client] Connected to the server. Starting download {remote_filename} ...")
+    if len(parts) != 3:
+        print("correct usage: DWN <threadtitle> <filename>")
+        return
+    threadtitle = parts[1]
+    filename = parts[2]
 
-        try:
-            with open(local_filename, "wb") as f:
-                while True:
-                    chunk = s.recv(4096)
-                    if not chunk:
-                        break
-                    f.write(chunk)
-        except Exception as e:
-            print(f"[Client] Unable to write to local file {local_filename}: {e}")
+    # 发请求，服务器回复文件大小和摘要
+    to_send = make_request("DWN", [threadtitle, filename, "resume", STREAMS], username)
+    lock = threading.Lock()
+    for _ in range(RETRY_TIMES):
+        resp = udp_msg_process(udp_sock, server_addr, to_send)
+        if not resp or not resp.startswith("DWN_OK "):
+            print(resp)
             return
+        _, token, size, sha256 = resp.split()
+        size = int(size)
+
+        # 未下载完的部分保存在 <filename>.<摘要前16位>.part，下次只下载缺少的区间
+        partial = f"{filename}.{sha256[:16]}.part"
+        received = load_ranges(partial)
+        if received and received[-1][1] > size:
+            discard_partial(partial)
+            received = []
+        open(partial, "ab").close()
+
+        missing = missing_ranges(received, size)
+        print(f"[Client] Downloading {sum(e - s for s, e in missing)} bytes over {STREAMS} TCP connection(s)...")
+        run_streams(tcp_download, split_ranges(missing, STREAMS), server_ip, server_port, partial, lock, token)
+
+        missing = missing_ranges(load_ranges(partial), size)
+        if missing:
+            print(f"[Client] Download stopped with {sum(e - s for s, e in missing)} bytes missing, resuming...")
+            continue
 
-        print(f"[Client] File {local_filename} download completed.")
+        if file_digest(partial) != sha256:
+            discard_partial(partial)
+            print(f"[Client] Downloaded file {filename} is corrupted (digest mismatch), retrying...")
+            continue
 
-def main():
-    if len(sys.argv) != 2:
-        print("correct usage: python client.py <server_port>")
-        sys.exit(1)
+        os.replace(partial, filename)
+        if os.path.exists(partial + ".ranges"):
+            os.remove(partial + ".ranges")
+        print(f"[Client] File {filename} download completed.")
+        return
+
+    print(f"[Client] Failed to download {filename}.")
+
+def discard_partial(partial):
+    for path in (partial, partial + ".ranges"):
+        if os.path.exists(path):
+            os.remove(path)
+
+# LOGIN请求，带上需要的编码：zlib压缩、bin二进制请求
+def login_request(username):
+    caps = {c for c, wanted in (("zlib", COMPRESSION), ("bin", BINARY)) if wanted}
+    return f"LOGIN {username}" + format_caps(caps)
+
+# 发送密码，记下服务器同意使用的编码，返回去掉编码之后的回复
+def send_password(udp_sock, server_addr, password):
+    global SERVER_CAPS
+    reply, SERVER_CAPS = split_caps(udp_msg_process(udp_sock, server_addr, f"PWD {password}"))
+    return reply
+
+# 非交互登录（批处理模式），成功返回True
+def login(udp_sock, server_addr, username, password):
+    response = udp_msg_process(udp_sock, server_addr, login_request(username))
+    if response not in ("EXISTING_USER", "NEW_USER"):
+        print(f"[Client] Login failed: {response or 'no response'}")
+        return False
+
+    resp2 = send_password(udp_sock, server_addr, password)
+    if resp2 != "LOGIN_SUCCESS":
+        print(f"[Client] Login failed: {resp2 or 'no response'}")
+        return False
+    return True
+
+# 输出BATCH回复中每条命令的结果
+def print_batch_result(reply):
+    results = parse_batch_result(reply)
+    if results is None:
+        print(reply)
+        return
+    for ok, body in results:
+        print(body)
+
+# 批处理模式：逐行执行脚本中的命令（与交互模式的格式相同，#开头的行是注释）
+# 论坛命令流水线发送，UPD/DWN/XIT 之前先等待在途的请求完成
+# batch大于1时，连续的论坛命令打包成BATCH，一个数据报最多带batch条
+def run_script(udp_sock, server_addr, lines, username, window, batch=1):
+    pipeline = Pipeline(udp_sock, server_addr, window, print_batch_result if batch > 1 else print)
+    started = time.monotonic()
+    pending = []
+
+    def submit_pending():
+        if pending:
+            pipeline.submit(build_batch(pending, username))
+            pending.clear()
+
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
 
-    server_port = int(sys.argv[1])
+        parts = line.split()
+        cmd = parts[0].upper()
+
+        if cmd in FORUM_COMMANDS:
+            to_send = build_command(line, username, text=batch > 1)
+            if to_send is None:
+                continue
+            if batch <= 1:
+                pipeline.submit(to_send)
+                continue
+
+            # 数据报放不下或者已经攒够batch条时，先发出去
+            size = len(build_batch(pending + [to_send], username).encode("utf-8"))
+            if pending and size > MAX_DATAGRAM - 64:
+                submit_pending()
+            pending.append(to_send)
+            if len(pending) >= batch:
+                submit_pending()
+            continue
+
+        submit_pending()
+        pipeline.drain()
+        if cmd == "UPD":
+            upload_command(udp_sock, server_addr, parts, username)
+        elif cmd == "DWN":
+            download_command(udp_sock, server_addr, parts, username)
+        elif cmd == "XIT":
+            break
+        else:
+            print(f"ERROR: Invalid command: {line}")
+
+    submit_pending()
+    pipeline.drain()
+    udp_msg_process(udp_sock, server_addr, "XIT")
+
+    elapsed = time.monotonic() - started
+    srtt = f"{pipeline.rtt.srtt * 1000:.1f}ms" if pipeline.rtt.srtt is not None else "n/a"
+    print(f"[Client] {pipeline.submitted} request(s) in {elapsed:.2f}s, "
+          f"{pipeline.retransmits} retransmission(s), srtt {srtt}.", file=sys.stderr)
+
+def main():
+    parser = argparse.ArgumentParser(usage="python client.py <server_port> [options]")
+    parser.add_argument("server_port", type=int)
+    parser.add_argument("--script", metavar="FILE",
+                        help="run the commands in FILE non-interactively ('-' reads stdin)")
+    parser.add_argument("--user", help="username for --script mode")
+    parser.add_argument("--password", help="password for --script mode")
+    parser.add_argument("--window", type=int, default=DEFAULT_WINDOW,
+                        help=f"requests in flight in --script mode (1-{MAX_WINDOW})")
+    parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE,
+                        help="receive buffer size in bytes for file downloads")
+    parser.add_argument("--streams", type=int, default=1,
+                        help="parallel TCP connections per file upload/download")
+    parser.add_argument("--batch", type=int, default=1,
+                        help="pack up to this many commands into one BATCH datagram in --script mode")
+    parser.add_argument("--no-compress", action="store_true",
+                        help="do not negotiate compression of replies and file transfers")
+    parser.add_argument("--no-binary", action="store_true",
+                        help="send text commands instead of negotiating the binary request encoding")
+    args = parser.parse_args()
+
+    global CHUNK_SIZE, STREAMS, COMPRESSION, BINARY
+    CHUNK_SIZE = args.chunk_size
+    STREAMS = max(1, args.streams)
+    COMPRESSION = not args.no_compress
+    BINARY = not args.no_binary
+
+    server_port = args.server_port
     server_ip = "127.0.0.1"
 
     # 创建UDP socket
     udp_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
     server_addr = (server_ip, server_port)
 
+    # 批处理模式
+    if args.script:
+        if not args.user or args.password is None:
+            parser.error("--script needs --user and --password")
+        if not login(udp_sock, server_addr, args.user, args.password):
+            sys.exit(1)
+
+        if args.script == "-":
+            run_script(udp_sock, server_addr, sys.stdin, args.user, args.window, args.batch)
+        else:
+            with open(args.script, "r", encoding="utf-8") as f:
+                run_script(udp_sock, server_addr, f, args.user, args.window, args.batch)
+        udp_sock.close()
+        return
+
     # 身份验证
     username = None
     while True:
@@ -83,17 +586,21 @@ def main():
             continue
 
         # 发送消息到服务器
-        response = udp_msg_process(udp_sock, server_addr, f"LOGIN {user_input}")
+        response = udp_msg_process(udp_sock, server_addr, login_request(user_input))
         if not response:
             continue        # 说明UDP重传3次都没成功
 
+        if response == "SERVER_BUSY":
+            print("[Client] The server is busy, please try again later.")
+            continue
+
         if response == "USER_IN_USE":
             print("[Client] This user is already logged in elsewhere, please change your username.")
             continue
 
         elif response == "EXISTING_USER":               # 用户存在，输入密码
             pwd = input("Enter password: ").strip()
-            resp2 = udp_msg_process(udp_sock, server_addr, f"PWD {pwd}")
+            resp2 = send_password(udp_sock, server_addr, pwd)
             if resp2 == "LOGIN_SUCCESS":
                 print(f"[Client] Welcome back, {user_input}!")
                 username = user_input
@@ -109,7 +616,7 @@ def main():
 
         elif response == "NEW_USER":                # 创建新用户
             pwd = input("Set a password for new user:").strip()
-            resp2 = udp_msg_process(udp_sock, server_addr, f"PWD {pwd}")
+            resp2 = send_password(udp_sock, server_addr, pwd)
 
             if resp2 == "LOGIN_SUCCESS":
                 print(f"[Client] New user {user_input} created successfully, logged in!")
@@ -127,11 +634,12 @@ def main():
     print("  MSG <threadtitle> <message>")
     print("  DLT <threadtitle> <messagenumber>")
     print("  EDT <threadtitle> <messagenumber> <message>")
-    print("  LST")
-    print("  RDT <threadtitle>")
+    print("  LST [sort=title|recent|messages|created] [by=<creator>] [match=<text>]")
+    print("  RDT <threadtitle> [offset] [limit]")
     print("  UPD <threadtitle> <filename>")
     print("  DWN <threadtitle> <filename>")
     print("  RMV <threadtitle>")
+    print("  STATS (administrators only)")
     print("  XIT")
     print("************************************************\n")
 
@@ -152,126 +660,21 @@ def main():
                 print("[Client] Exit anomaly.")
             break
         
-        # CRT
-        elif cmd == "CRT":
-            if len(parts) != 2:
-                print("correct usage:CRT <threadtitle>")
+        # CRT / MSG / DLT / EDT / LST / RDT / RMV / STATS
+        elif cmd in FORUM_COMMANDS:
+            to_send = build_command(cmd_line, username)
+            if to_send is None:
                 continue
-            threadtitle = parts[1]
-            to_send = f"CRT {threadtitle} {username}"
-            resp = udp_msg_process(udp_sock, server_addr, to_send)
-            print(resp)
-
-        # MSG
-        elif cmd == "MSG":
-            if len(parts) < 3:
-                print("correct usage: MSG <threadtitle> <message>")
-                continue
-            threadtitle = parts[1]
-            message_text = " ".join(parts[2:])                      # 后面的全都是消息内容
-            to_send = f"MSG {threadtitle} {message_text} {username}"
-            resp = udp_msg_process(udp_sock, server_addr, to_send)
-            print(resp)
-
-        # DLT
-        elif cmd == "DLT":
-            if len(parts) != 3:
-                print("correct usage: DLT <threadtitle> <messagenumber>")
-                continue
-            threadtitle = parts[1]
-            messagenumber = parts[2]
-            to_send = f"DLT {threadtitle} {messagenumber} {username}"
-            resp = udp_msg_process(udp_sock, server_addr, to_send)
-            print(resp)
-
-        # EDT
-        elif cmd == "EDT":
-            if len(parts) < 4:
-                print("correct usage: EDT <threadtitle> <messagenumber> <new_message>")
-                continue
-            threadtitle = parts[1]
-            messagenumber = parts[2]
-            new_msg = " ".join(parts[3:])
-            to_send = f"EDT {threadtitle} {messagenumber} {new_msg} {username}"
-            resp = udp_msg_process(udp_sock, server_addr, to_send)
-            print(resp)
-
-        # LST
-        elif cmd == "LST":
-            if len(parts) != 1:
-                print("Error: LST No parameters.")
-                continue
-            to_send = f"LST {username}"
-            resp = udp_msg_process(udp_sock, server_addr, to_send)
-            print(resp)
-
-        # RDT
-        elif cmd == "RDT":
-            if len(parts) != 2:
-                print("correct usage: RDT <threadtitle>")
-                continue
-            threadtitle = parts[1]
-            to_send = f"RDT {threadtitle} {username}"
             resp = udp_msg_process(udp_sock, server_addr, to_send)
             print(resp)
 
         # UPD
         elif cmd == "UPD":
-            # UPD threadtitle filename
-            if len(parts) != 3:
-                print("correct usage: UPD <threadtitle> <filename>")
-                continue
-            threadtitle = parts[1]
-            filename = parts[2]
-
-            # 检查文件是否存在
-            if not os.path.exists(filename):
-                print(f"File {filename} does not exist.")
-                continue
-
-            to_send = f"UPD {threadtitle} {filename} {username}"
-            resp = udp_msg_process(udp_sock, server_addr, to_send)
-
-            # 开始上传
-            if resp == "UPD_OK":
-                print("[Client] Ready to connect to TCP to transfer files...")
-                tcp_upload(server_ip, server_port, filename, threadtitle, filename, username)
-                record_cmd = f"{username} uploaded {filename}"
-                to_send = f"MSG_UPLOAD {threadtitle} {record_cmd} {username}"
-
-                print("[Client] The file is uploaded.")
-            else:
-                print(resp)
+            upload_command(udp_sock, server_addr, parts, username)
 
         # DWN
         elif cmd == "DWN":
-            if len(parts) != 3:
-                print("correct usage: DWN <threadtitle> <filename>")
-                continue
-            threadtitle = parts[1]
-            filename = parts[2]
-
-            # 发请求
-            to_send = f"DWN {threadtitle} {filename} {username}"
-            resp = udp_msg_process(udp_sock, server_addr, to_send)
-
-            if resp == "DWN_OK":
-                print("[Client] Preparing TCP to receive files...")         # 开始TCP下载
-                local_filename = filename
-                tcp_download(server_ip, server_port, local_filename, threadtitle, filename, username)
-            else:
-                print(resp)
-
-        # RMV
-        elif cmd == "RMV":
-            # RMV threadtitle
-            if len(parts) != 2:
-                print("correct usage: RMV <threadtitle>")
-                continue
-            threadtitle = parts[1]
-            to_send = f"RMV {threadtitle} {username}"
-            resp = udp_msg_process(udp_sock, server_addr, to_send)
-            print(resp)
+            download_command(udp_sock, server_addr, parts, username)
 
         else:
             print("ERROR: Invalid command, please enter again.")
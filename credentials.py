@@ -0,0 +1,147 @@
+import os
+import hmac
+import hashlib
+import secrets
+import threading
+from collections import OrderedDict
+
+from thread_store import STATE_DIR
+from wal import WriteAheadLog, read_records, encode_record, DEFAULT_FSYNC
+from logger import log
+
+SEED_FILE = "credentials.txt"   # 旧格式的账号文件（用户名 明文密码），只读，启动时导入
+LOG_FILE = "credentials.log"    # 账号日志 .forum/credentials.log，每行一条 {"u": 用户名, "h": 密码哈希}
+VERIFIED_CACHE_SIZE = 10000     # 记住最近验证成功的账号数
+SCRYPT_N, SCRYPT_R, SCRYPT_P = 2 ** 14, 8, 1
+PBKDF2_ITERATIONS = 200000
+
+
+# 加盐的密码哈希："scrypt$n$r$p$盐$哈希"，没有scrypt的平台用 "pbkdf2$迭代次数$盐$哈希"
+def hash_password(password, salt=None):
+    salt = salt or secrets.token_bytes(16)
+    if hasattr(hashlib, "scrypt"):
+        digest = hashlib.scrypt(password.encode("utf-8"), salt=salt, n=SCRYPT_N, r=SCRYPT_R, p=SCRYPT_P, dklen=32)
+        return f"scrypt${SCRYPT_N}${SCRYPT_R}${SCRYPT_P}${salt.hex()}${digest.hex()}"
+    digest = hashlib.pbkdf2_hmac("sha256", password.encode("utf-8"), salt, PBKDF2_ITERATIONS)
+    return f"pbkdf2${PBKDF2_ITERATIONS}${salt.hex()}${digest.hex()}"
+
+
+def check_password(password, stored):
+    p = stored.split("$")
+    try:
+        if p[0] == "scrypt" and len(p) == 6:
+            digest = hashlib.scrypt(password.encode("utf-8"), salt=bytes.fromhex(p[4]), n=int(p[1]), r=int(p[2]),
+                                    p=int(p[3]), dklen=len(p[5]) // 2)
+        elif p[0] == "pbkdf2" and len(p) == 4:
+            digest = hashlib.pbkdf2_hmac("sha256", password.encode("utf-8"), bytes.fromhex(p[2]), int(p[1]))
+        else:
+            return False
+    except ValueError:
+        return False
+    return hmac.compare_digest(digest.hex(), p[-1])
+
+
+# 旧格式的账号文件，格式为：{username: password}
+def read_seed(path):
+    accounts = {}
+    if os.path.exists(path):
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                p = line.strip().split(" ", 1)          # 只分割一次
+                if len(p) == 2:
+                    accounts[p[0]] = p[1]
+    return accounts
+
+
+# 账号存储：注册只在账号日志末尾追加一条记录（并发注册共用一次fsync），后台定期压缩日志
+# 密码只保存加盐哈希；验证成功的账号记在内存里（HMAC，密钥每次启动随机生成），再次登录不用重新计算哈希
+class CredentialStore:
+    def __init__(self, root=".", fsync=DEFAULT_FSYNC):
+        self.root = root
+        self.hashes = {}                # {username: 密码哈希}
+        self.verified = OrderedDict()   # {username: HMAC(密码)}，最近验证成功的账号
+        self.secret = secrets.token_bytes(32)
+        self.lock = threading.Lock()
+        os.makedirs(os.path.join(root, STATE_DIR), exist_ok=True)
+        self.log = WriteAheadLog(self.path(), fsync)
+
+    def path(self):
+        return os.path.join(self.root, STATE_DIR, LOG_FILE)
+
+    def __contains__(self, username):
+        return username in self.hashes
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def keys(self):
+        return self.hashes.keys()
+
+    # 重放账号日志（后面的记录覆盖前面的），再导入账号文件中还没有的账号
+    def load(self):
+        records = read_records(self.path())
+        for r in records:
+            self.hashes[r["u"]] = r["h"]
+
+        # 日志末尾有崩溃时写了一半的记录、或者有重复的记录时，先压缩，之后追加的记录才能被读到
+        # 运行中每个账号只追加一条记录，不会再产生重复，只需要在启动时压缩
+        size = sum(len(encode_record(r)) for r in records)
+        if len(records) != len(self.hashes) or size != os.path.getsize(self.path()):
+            self.compact()
+
+        seed = read_seed(os.path.join(self.root, SEED_FILE))
+        imported = 0
+        lsn = 0
+        for username, password in seed.items():
+            if username not in self.hashes:
+                self.hashes[username] = hash_password(password)
+                lsn = self.log.append({"u": username, "h": self.hashes[username]})
+                imported += 1
+        if lsn:
+            self.log.commit(lsn)
+        log.info("Credentials", f"{len(self.hashes)} account(s) ({imported} imported from {SEED_FILE}).")
+
+    def _remember(self, username, password):
+        with self.lock:
+            self.verified[username] = hmac.new(self.secret, password.encode("utf-8"), hashlib.sha256).digest()
+            self.verified.move_to_end(username)
+            if len(self.verified) > VERIFIED_CACHE_SIZE:
+                self.verified.popitem(last=False)
+
+    # 验证密码：最近验证过的账号只比较HMAC；不匹配时仍然计算一次哈希，猜密码不会因为缓存变快
+    def verify(self, username, password):
+        stored = self.hashes.get(username)
+        if stored is None:
+            return False
+        with self.lock:
+            cached = self.verified.get(username)
+        mac = hmac.new(self.secret, password.encode("utf-8"), hashlib.sha256).digest()
+        if cached is not None and hmac.compare_digest(cached, mac):
+            return True
+        if not check_password(password, stored):
+            return False
+        self._remember(username, password)
+        return True
+
+    # 注册新账号，用户名已存在返回False；哈希在锁外计算，注册高峰时互不阻塞
+    def register(self, username, password):
+        if username in self.hashes:
+            return False
+        hashed = hash_password(password)
+        with self.lock:
+            if username in self.hashes:
+                return False
+            lsn = self.log.append({"u": username, "h": hashed})
+            self.hashes[username] = hashed
+        self.log.commit(lsn)
+        self._remember(username, password)
+        return True
+
+    # 压缩：每个账号只保留一条记录
+    def compact(self):
+        with self.lock:
+            self.log.rewrite([{"u": u, "h": h} for u, h in self.hashes.items()])
+
+    # 按毫秒间隔fsync时启动账号日志的fsync线程
+    def start_syncer(self):
+        self.log.start_syncer()
@@ -0,0 +1,184 @@
+import os
+import sys
+import json
+import time
+import atexit
+import random
+import threading
+from queue import Queue, Full, Empty
+
+LEVELS = {"debug": 10, "info": 20, "warning": 30, "error": 40}
+DEFAULT_LEVEL = "info"
+DEFAULT_BODY_LIMIT = 0          # 日志中的回复正文：0 不记录（只记字节数），N 截断到N个字符，-1 完整记录
+DEFAULT_MAX_BYTES = 10 * 1024 * 1024    # JSON日志文件超过这么大时轮转
+DEFAULT_BACKUPS = 5             # 保留的旧日志文件个数 <文件>.1 ... <文件>.N
+QUEUE_SIZE = 10000              # 待写日志的上限，写不过来时丢弃并计数，不阻塞处理命令的线程
+
+
+# 解析采样率 "command=0.01,response=0"，返回 {事件: 记录的比例}
+def parse_sampling(text):
+    rates = {}
+    for part in filter(None, (text or "").split(",")):
+        event, _, rate = part.partition("=")
+        try:
+            rates[event.strip()] = min(max(float(rate), 0.0), 1.0)
+        except ValueError:
+            raise ValueError(f"sampling must look like event=rate[,event=rate...], not {part!r}")
+    return rates
+
+
+# 按大小轮转的JSON Lines文件：<path> 写满后依次改名为 <path>.1 ... <path>.N
+class RotatingFile:
+    def __init__(self, path, max_bytes=DEFAULT_MAX_BYTES, backups=DEFAULT_BACKUPS):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.f = open(path, "ab")
+
+    def write(self, data):
+        if self.max_bytes > 0 and self.f.tell() + len(data) > self.max_bytes and self.f.tell() > 0:
+            self.rotate()
+        self.f.write(data)
+
+    def rotate(self):
+        self.f.close()
+        for i in range(self.backups - 1, 0, -1):
+            if os.path.exists(f"{self.path}.{i}"):
+                os.replace(f"{self.path}.{i}", f"{self.path}.{i + 1}")
+        if self.backups > 0:
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+        self.f = open(self.path, "ab")
+
+    def flush(self):
+        self.f.flush()
+
+    def close(self):
+        self.f.close()
+
+
+# 结构化日志：调用的线程只把记录放进队列，后台线程负责格式化并写到标准输出和（可选的）JSON日志文件
+# 每条记录有级别、来源（Server、FileTransfer……）、事件名和附加字段；按事件名采样，高频事件可以只记录一部分
+class Logger:
+    def __init__(self):
+        self.level = LEVELS[DEFAULT_LEVEL]
+        self.sampling = {}
+        self.body_limit = DEFAULT_BODY_LIMIT
+        self.stdout = True
+        self.file = None
+        self.queue = Queue(QUEUE_SIZE)
+        self.dropped = 0
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def configure(self, level=DEFAULT_LEVEL, sampling=None, body_limit=DEFAULT_BODY_LIMIT, path=None,
+                  max_bytes=DEFAULT_MAX_BYTES, backups=DEFAULT_BACKUPS, stdout=True):
+        self.flush()
+        self.level = LEVELS[level]
+        self.sampling = parse_sampling(sampling) if isinstance(sampling, str) else dict(sampling or {})
+        self.body_limit = body_limit
+        self.stdout = stdout
+        if self.file is not None:
+            self.file.close()
+        self.file = RotatingFile(path, max_bytes, backups) if path else None
+
+    # 级别足够、而且这个事件没有被完全关掉（采样率为0），调用者据此决定要不要准备日志内容
+    def wants(self, level, event=None):
+        return LEVELS[level] >= self.level and self.sampling.get(event) != 0
+
+    def enabled(self, level, event=None):
+        if LEVELS[level] < self.level:
+            return False
+        rate = self.sampling.get(event)
+        return rate is None or (rate > 0 and (rate >= 1 or random.random() < rate))
+
+    # 回复正文按body_limit截断或省略
+    def body(self, text):
+        if self.body_limit < 0 or len(text) <= self.body_limit:
+            return text
+        if self.body_limit == 0:
+            return None
+        return text[:self.body_limit] + f"...({len(text)} chars)"
+
+    def log(self, level, source, text, event=None, **fields):
+        if not self.enabled(level, event):
+            return
+        self._start()
+        try:
+            self.queue.put_nowait((time.time(), level, source, event, text, fields))
+        except Full:
+            with self.lock:
+                self.dropped += 1
+
+    def debug(self, source, text, event=None, **fields):
+        self.log("debug", source, text, event, **fields)
+
+    def info(self, source, text, event=None, **fields):
+        self.log("info", source, text, event, **fields)
+
+    def warning(self, source, text, event=None, **fields):
+        self.log("warning", source, text, event, **fields)
+
+    def error(self, source, text, event=None, **fields):
+        self.log("error", source, text, event, **fields)
+
+    # 第一次写日志时启动后台线程
+    def _start(self):
+        if self.thread is not None:
+            return
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, daemon=True)
+                self.thread.start()
+
+    def _write(self, entry):
+        ts, level, source, event, text, fields = entry
+        if self.stdout:
+            prefix = "" if level in ("debug", "info") else level.upper() + ": "
+            sys.stdout.write(f"[{source}] {prefix}{text}\n")
+        if self.file is not None:
+            record = {"ts": round(ts, 6), "level": level, "source": source, "event": event, "msg": text}
+            record.update(fields)
+            self.file.write(json.dumps(record, ensure_ascii=False, default=str).encode("utf-8") + b"\n")
+
+    def _run(self):
+        while True:
+            entry = self.queue.get()
+            try:
+                self._drain(entry)
+            finally:
+                self.queue.task_done()
+
+    # 一次取出队列中所有的记录，写完再flush，繁忙时多条日志共用一次写操作
+    def _drain(self, entry):
+        count = 1
+        while entry is not None:
+            self._write(entry)
+            try:
+                entry = self.queue.get_nowait()
+                count += 1
+            except Empty:
+                entry = None
+        with self.lock:
+            dropped, self.dropped = self.dropped, 0
+        if dropped:
+            self._write((time.time(), "warning", "Log", "dropped", f"dropped {dropped} log record(s), queue full",
+                         {"dropped": dropped}))
+        if self.stdout:
+            sys.stdout.flush()
+        if self.file is not None:
+            self.file.flush()
+        for _ in range(count - 1):
+            self.queue.task_done()
+
+    # 等待队列中已有的记录写完
+    def flush(self):
+        if self.thread is not None:
+            self.queue.join()
+
+
+# 进程内共用的日志对象：from logger import log
+log = Logger()
+atexit.register(log.flush)
@@ -0,0 +1,82 @@
+import os
+import json
+
+
+# 快照 + 追加日志：<name>.json 是某个时刻的完整内容，之后的每次增删追加一行到 <name>.log，
+# 后台定期写一个新的快照，再丢掉快照已经包含的日志记录；增删不需要重写整个文件
+# 日志记录按顺序编号 {"n": 编号, ...}，快照 {"seq": 最后包含的编号, <key>: 内容}，重放时跳过快照已经包含的记录
+# 也能读取没有编号的旧版快照（整个文件就是内容）
+class Manifest:
+    def __init__(self, path, key):
+        self.path = path
+        self.log_path = os.path.splitext(path)[0] + ".log"
+        self.key = key
+        self.seq = 0                    # 最后追加的记录编号
+        self.log = None
+
+    # 返回 (快照内容, [快照之后的日志记录])；没有快照时内容为None
+    # 崩溃时写了一半的最后一行被丢掉，日志重写成只剩快照之后的完整记录
+    def load(self):
+        data, seq = None, 0
+        if os.path.exists(self.path):
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            if isinstance(data.get("seq"), int):
+                seq, data = data["seq"], data[self.key]
+
+        records = [record for record, line in self._read_log() if record["n"] > seq]
+        self.seq = max([seq] + [r["n"] for r in records])
+        self.trim(seq)
+        return data, records
+
+    # 日志中完整的记录 [(记录, 原始行)]，遇到不完整的行就停止
+    def _read_log(self):
+        records = []
+        if not os.path.exists(self.log_path):
+            return records
+        with open(self.log_path, "r", encoding="utf-8") as f:
+            for line in f:
+                if not line.endswith("\n"):
+                    break
+                try:
+                    records.append((json.loads(line), line))
+                except ValueError:
+                    break
+        return records
+
+    # 追加一条记录；调用者持有锁，编号与写入的顺序一致
+    def append(self, record):
+        if self.log is None:
+            self.log = open(self.log_path, "a", encoding="utf-8")
+        self.seq += 1
+        self.log.write(json.dumps(dict(record, n=self.seq), ensure_ascii=False) + "\n")
+        self.log.flush()
+
+    # 快照的文本和它包含的最后一个编号；调用者持有锁
+    def snapshot(self, data):
+        return json.dumps({"seq": self.seq, self.key: data}), self.seq
+
+    # 写入快照（先写临时文件再替换），不需要持有锁
+    def write(self, text):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp = self.path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write(text)
+        os.replace(tmp, self.path)
+
+    # 丢掉编号不超过seq的日志记录（快照里已经有了）；调用者持有锁
+    def trim(self, seq):
+        if self.log is not None:
+            self.log.close()
+            self.log = None
+        if not os.path.exists(self.log_path):
+            return
+
+        keep = [line for record, line in self._read_log() if record["n"] > seq]
+        if not keep:
+            os.remove(self.log_path)
+            return
+        tmp = self.log_path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.writelines(keep)
+        os.replace(tmp, self.log_path)
@@ -0,0 +1,130 @@
+import os
+import json
+import math
+import time
+import threading
+
+from logger import log
+
+OPCODES = ("CRT", "MSG", "DLT", "EDT", "LST", "RDT", "UPD", "DWN", "RMV", "XIT", "BATCH", "STATS")
+SNAPSHOT_FILE = "metrics.json"  # .forum/metrics.json，定期写入的快照
+SNAPSHOT_INTERVAL = 60          # 写快照的间隔（秒）
+BUCKETS_PER_OCTAVE = 8          # 直方图每翻一倍分8个桶，分位数的相对误差约4%
+MIN_LATENCY = 1e-6              # 直方图的下限（秒），更小的值都记在第一个桶里
+
+
+# 延迟直方图：按对数分桶计数，内存固定，分位数取桶的上界
+class Histogram:
+    def __init__(self):
+        self.buckets = {}               # {桶编号: 次数}
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, value):
+        index = max(0, math.ceil(math.log2(max(value, MIN_LATENCY) / MIN_LATENCY) * BUCKETS_PER_OCTAVE))
+        self.buckets[index] = self.buckets.get(index, 0) + 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    # 第q分位（0~1）的近似值
+    def quantile(self, q):
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen >= rank:
+                return min(MIN_LATENCY * 2 ** (index / BUCKETS_PER_OCTAVE), self.max)
+        return self.max
+
+    def summary(self):
+        return {"count": self.count, "mean": self.total / self.count if self.count else 0.0,
+                "p50": self.quantile(0.50), "p95": self.quantile(0.95), "p99": self.quantile(0.99), "max": self.max}
+
+
+# 服务器指标：每种命令的处理耗时、文件传输的字节数和耗时；
+# 会话数、队列长度这类当前值在取快照时由gauges()读取
+class Metrics:
+    def __init__(self, gauges=None):
+        self.gauges = gauges or (lambda: {})
+        self.started = time.time()
+        self.commands = {}              # {命令: Histogram}
+        self.errors = {}                # {命令: 回复以ERROR开头的次数}
+        self.transfers = {}             # {"upload"/"download": {"count", "bytes", "seconds", "latency"}}
+        self.lock = threading.Lock()
+
+    # 记录一条命令的处理耗时（秒），不认识的命令记为OTHER
+    def observe(self, opcode, seconds, error=False):
+        if opcode not in OPCODES:
+            opcode = "OTHER"
+        with self.lock:
+            histogram = self.commands.get(opcode)
+            if histogram is None:
+                histogram = self.commands[opcode] = Histogram()
+            histogram.add(seconds)
+            if error:
+                self.errors[opcode] = self.errors.get(opcode, 0) + 1
+
+    # 记录一次文件传输（一个区间或一次旧格式的传输）的字节数和耗时
+    def transfer(self, mode, nbytes, seconds):
+        with self.lock:
+            t = self.transfers.get(mode)
+            if t is None:
+                t = self.transfers[mode] = {"count": 0, "bytes": 0, "seconds": 0.0, "latency": Histogram()}
+            t["count"] += 1
+            t["bytes"] += nbytes
+            t["seconds"] += seconds
+            t["latency"].add(seconds)
+
+    def snapshot(self):
+        with self.lock:
+            commands = {op: dict(h.summary(), errors=self.errors.get(op, 0)) for op, h in self.commands.items()}
+            transfers = {mode: {"count": t["count"], "bytes": t["bytes"], "seconds": t["seconds"],
+                                "bytes_per_s": t["bytes"] / t["seconds"] if t["seconds"] else 0.0,
+                                "duration": t["latency"].summary()}
+                         for mode, t in self.transfers.items()}
+        return {"time": time.time(), "uptime": time.time() - self.started, "commands": commands,
+                "transfers": transfers, **self.gauges()}
+
+    # STATS的回复：每行一项，耗时以毫秒显示
+    def format(self, snapshot=None):
+        s = snapshot or self.snapshot()
+        lines = [f"uptime={s['uptime']:.0f}s " + " ".join(f"{k}={v}" for k, v in s.items()
+                                                          if isinstance(v, (int, float)) and k not in ("time", "uptime"))]
+        for op in sorted(s["commands"]):
+            c = s["commands"][op]
+            lines.append(f"{op} count={c['count']} errors={c['errors']} p50={c['p50'] * 1000:.2f}ms "
+                         f"p95={c['p95'] * 1000:.2f}ms p99={c['p99'] * 1000:.2f}ms max={c['max'] * 1000:.2f}ms")
+        for mode in sorted(s["transfers"]):
+            t = s["transfers"][mode]
+            lines.append(f"{mode} count={t['count']} bytes={t['bytes']} rate={t['bytes_per_s'] / 1e6:.1f}MB/s "
+                         f"p50={t['duration']['p50'] * 1000:.1f}ms p99={t['duration']['p99'] * 1000:.1f}ms")
+        for name, values in s.items():
+            if isinstance(values, list):
+                lines.append(f"{name} " + " ".join(str(v) for v in values))
+        return "\n".join(lines)
+
+    # 原子地写快照文件（先写临时文件再改名）
+    def write_snapshot(self, path):
+        tmp = path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(self.snapshot(), f, indent=1)
+        os.replace(tmp, path)
+
+    # 后台定期写快照，interval为0时不写
+    def start_snapshotter(self, path, interval=SNAPSHOT_INTERVAL):
+        if interval <= 0:
+            return
+
+        def loop():
+            while True:
+                threading.Event().wait(interval)
+                try:
+                    self.write_snapshot(path)
+                except OSError as e:
+                    log.error("Metrics", f"Writing {path} failed: {e}")
+
+        threading.Thread(target=loop, daemon=True).start()
@@ -0,0 +1,327 @@
+# 客户端和服务器共用的UDP协议工具
+
+import zlib
+import struct
+
+MAX_DATAGRAM = 8192             # 单个数据报的最大字节数（与接收缓冲区一致）
+FRAG_MARK = b"\x1e"             # 分片数据报以这个字节开头，正常文本回复不会出现
+FRAG_PAYLOAD = MAX_DATAGRAM - 64
+MAX_FRAGMENTS = 64              # 一个回复最多分成多少个数据报，更大的RDT回复要求客户端分页读取
+MAX_REPLY = MAX_FRAGMENTS * FRAG_PAYLOAD
+FRAG_BURST = 8                  # 连续发送这么多个分片后暂停FRAG_GAP秒，一次发出的分片不会超过客户端的接收缓冲区
+FRAG_GAP = 0.002
+
+
+# 把回复拆成分片数据报：\x1e<reply_id> <seq> <total>\n<payload>
+# 回复不超过一个数据报时原样返回，保持旧协议不变
+# 重传的请求用同样的reply_id重发缓存的回复，客户端把几次收到的分片拼在一起
+def fragment(data, reply_id):
+    if len(data) <= MAX_DATAGRAM and not data.startswith(FRAG_MARK):
+        return [data]
+
+    chunks = [data[i:i + FRAG_PAYLOAD] for i in range(0, len(data), FRAG_PAYLOAD)]
+    total = len(chunks)
+    return [
+        FRAG_MARK + f"{reply_id} {seq} {total}\n".encode("utf-8") + chunk
+        for seq, chunk in enumerate(chunks)
+    ]
+
+
+# 客户端重组分片，每收到一个数据报调用一次feed
+class Reassembler:
+    MAX_PENDING = 16            # 最多同时保留多少个未收齐的回复
+
+    def __init__(self):
+        self.parts = {}         # {reply_id: {seq: payload}}，按到达顺序
+
+    # 返回完整的回复字节串，还没收齐返回None
+    def feed(self, datagram):
+        if not datagram.startswith(FRAG_MARK):
+            return datagram
+
+        header, _, payload = datagram[1:].partition(b"\n")
+        try:
+            reply_id, seq, total = (int(x) for x in header.split())
+        except ValueError:
+            return None
+
+        if reply_id not in self.parts:
+            # 丢掉最早的残缺回复（例如重传前收到一半的旧回复）
+            if len(self.parts) >= self.MAX_PENDING:
+                del self.parts[next(iter(self.parts))]
+            self.parts[reply_id] = {}
+        parts = self.parts[reply_id]
+        parts[seq] = payload
+
+        if len(parts) < total:
+            return None
+
+        del self.parts[reply_id]
+        return b"".join(parts[i] for i in range(total))
+
+
+# 请求编号：客户端在命令前加 "#<id> "，服务器的回复也带上同样的前缀
+# 重传的请求编号不变，服务器据此识别重复请求；不带编号的旧客户端照常工作
+def split_request_id(msg):
+    if msg.startswith("#"):
+        req_id, _, rest = msg.partition(" ")
+        return req_id[1:], rest
+    return None, msg
+
+
+def add_request_id(req_id, text):
+    return text if req_id is None else f"#{req_id} {text}"
+
+
+# BATCH：一个数据报携带多条命令，每行一条，回复中给出每条命令的结果
+#   请求  BATCH <username>\n<命令1>\n<命令2>...
+#   回复  BATCH_RESULT <成功数>/<总数>\n#1 OK <长度>\n<回复1>\n#2 ERROR <长度>\n<回复2>...
+def build_batch(commands, username):
+    return "\n".join([f"BATCH {username}"] + commands)
+
+
+def format_batch_result(results):
+    ok = sum(1 for r in results if not r.startswith("ERROR"))
+    out = [f"BATCH_RESULT {ok}/{len(results)}"]
+    for i, r in enumerate(results, 1):
+        status = "ERROR" if r.startswith("ERROR") else "OK"
+        out.append(f"#{i} {status} {len(r)}\n{r}")
+    return "\n".join(out)
+
+
+# 解析BATCH回复，返回 [(是否成功, 回复)]，格式不对返回None
+def parse_batch_result(reply):
+    if not reply.startswith("BATCH_RESULT"):
+        return None
+
+    results = []
+    pos = reply.find("\n")
+    while pos != -1 and pos < len(reply):
+        header_end = reply.find("\n", pos + 1)
+        if header_end == -1:
+            return None
+        header = reply[pos + 1:header_end].split()
+        if len(header) != 3 or not header[2].isdigit():
+            return None
+        length = int(header[2])
+        body = reply[header_end + 1:header_end + 1 + length]
+        results.append((header[1] == "OK", body))
+        pos = header_end + 1 + length
+        if pos >= len(reply):
+            break
+    return results
+
+
+# 压缩协商：客户端在LOGIN的用户名后面带上支持的编码，服务器在LOGIN_SUCCESS后面回复同意使用的编码
+#   LOGIN <username> caps=zlib  ->  EXISTING_USER/NEW_USER  ->  PWD <password>  ->  LOGIN_SUCCESS caps=zlib
+# 协商之后超过COMPRESS_THRESHOLD字节的回复以 \x1f 开头，后面是zlib压缩的内容（压缩后再按需分片）
+# caps=bin 表示客户端之后可以发送二进制请求（见下面的 pack_request）
+# 不带caps的旧客户端收到的回复不变
+CODECS = ("zlib", "bin")
+COMPRESS_MARK = b"\x1f"
+COMPRESS_THRESHOLD = 1024
+COMPRESS_LEVEL = 6
+
+
+def parse_caps(tokens):
+    for token in tokens:
+        if token.startswith("caps="):
+            return {c for c in token[len("caps="):].split(",") if c in CODECS}
+    return set()
+
+
+def format_caps(caps):
+    return f" caps={','.join(sorted(caps))}" if caps else ""
+
+
+# 把回复末尾的 caps=... 分出来，返回 (回复, 编码集合)
+def split_caps(reply):
+    if reply:
+        head, _, last = reply.rpartition(" ")
+        if head and last.startswith("caps="):
+            return head, parse_caps([last])
+    return reply, set()
+
+
+def encode_reply(text, caps):
+    data = text.encode("utf-8") if isinstance(text, str) else text
+    if "zlib" in caps and len(data) > COMPRESS_THRESHOLD:
+        packed = zlib.compress(data, COMPRESS_LEVEL)
+        if len(packed) + len(COMPRESS_MARK) < len(data):
+            return COMPRESS_MARK + packed
+    return data
+
+
+def decode_reply(data):
+    if data.startswith(COMPRESS_MARK):
+        data = zlib.decompress(data[len(COMPRESS_MARK):])
+    return data.decode("utf-8", errors="ignore")
+
+
+# 文本命令：<命令> <参数...> <username>，参数按空白分开；MSG和EDT的最后一个参数是消息内容，可以包含空白
+# 返回 (命令, [参数])，参数中不含末尾的用户名；BATCH的参数是其后每行一条的命令
+FREE_TEXT = {"MSG": 1, "EDT": 2}               # {命令: 消息内容之前的参数个数}
+UNSIGNED = ("LOGIN", "PWD", "XIT")              # 末尾不带用户名的命令
+
+
+def split_fields(command, text):
+    n = FREE_TEXT.get(command)
+    return text.split(None, n) if n is not None else text.split()
+
+
+def parse_command(msg):
+    if msg.startswith("BATCH"):
+        return "BATCH", [line.strip() for line in msg.split("\n")[1:] if line.strip()]
+    words = msg.split(None, 1)
+    if not words:
+        return "", []
+    command, rest = words[0], words[1] if len(words) == 2 else ""
+    if command not in UNSIGNED:
+        words = rest.rsplit(None, 1)
+        rest = words[0] if len(words) == 2 else ""
+    return command, split_fields(command, rest)
+
+
+# 参数转换成整数：二进制请求中已经是整数，文本请求中是字符串，不是整数时返回None
+def to_int(value):
+    if isinstance(value, int):
+        return value
+    try:
+        return int(value)
+    except ValueError:
+        return None
+
+
+# 二进制请求中按整数发送的参数位置，其他位置都是字符串
+INT_FIELDS = {"DLT": (1,), "EDT": (1,), "RDT": (1, 2), "UPD": (2, 4), "DWN": (3,)}
+
+
+# 按命令把参数转换成对应的类型，整数位置上不是整数的参数保持字符串，由服务器回复用法错误
+def typed_fields(command, fields):
+    ints = INT_FIELDS.get(command, ())
+    typed = []
+    for i, value in enumerate(fields):
+        number = to_int(value) if i in ints else None
+        typed.append(number if number is not None else str(value))
+    return typed
+
+
+# 检查参数，返回错误回复，没有问题返回None（文本和二进制请求都在分派之前检查）
+# 消息内容原样写进主题文件和墓碑/覆盖日志，一行一条记录，所以任何参数都不能包含换行；
+# 消息内容之外的参数（主题名、文件名……）不能为空、不能包含空白，和文本命令能表达的一致
+def check_fields(command, fields):
+    free = FREE_TEXT.get(command)
+    for i, value in enumerate(fields):
+        if not isinstance(value, str):
+            continue
+        if "\n" in value or "\r" in value:
+            return "ERROR: Arguments cannot contain line breaks."
+        if i != free and (not value or any(c.isspace() for c in value)):
+            return "ERROR: Only the message text can contain spaces."
+    return None
+
+
+# 二进制请求（登录时协商了caps=bin之后可以使用，文本请求仍然照常处理）：
+#   请求  \x1d <u32 之后的长度> <u64 请求编号> <u8 操作码> <u8 参数个数> 参数...
+#         参数  \x00 <u32 长度> <UTF-8字符串>  或  \x01 <i64 整数>
+#   回复  \x1d <u32 之后的长度> <u64 请求编号> <UTF-8回复>，再按协商的编码压缩、按需分片
+# 参数按类型原样传输，不需要分词，消息内容可以包含任意空白和用户名；BATCH的每个参数是一条文本命令
+BINARY_MARK = b"\x1d"
+COMMAND_CODES = {name: code for code, name in enumerate(
+    ("XIT", "CRT", "MSG", "DLT", "EDT", "LST", "RDT", "UPD", "DWN", "RMV", "STATS", "BATCH"), 1)}
+COMMAND_NAMES = {code: name for name, code in COMMAND_CODES.items()}
+REQUEST_HEAD = struct.Struct(">IQBB")
+REPLY_HEAD = struct.Struct(">IQ")
+STR_FIELD = struct.Struct(">BI")
+INT_FIELD = struct.Struct(">Bq")
+FIELD_STR = 0
+FIELD_INT = 1
+
+
+def pack_request(req_id, command, fields):
+    parts = []
+    for value in fields:
+        if isinstance(value, int):
+            parts.append(INT_FIELD.pack(FIELD_INT, value))
+        else:
+            data = value.encode("utf-8")
+            parts.append(STR_FIELD.pack(FIELD_STR, len(data)) + data)
+    body = b"".join(parts)
+    head = REQUEST_HEAD.pack(REQUEST_HEAD.size - 4 + len(body), int(req_id, 16), COMMAND_CODES[command], len(fields))
+    return BINARY_MARK + head + body
+
+
+# 返回 (请求编号, 命令, [参数])，格式不对时抛出ValueError
+# 不在INT_FIELDS中的位置上的整数转换成字符串，和typed_fields的结果相同
+def unpack_request(data):
+    try:
+        length, req_id, code, count = REQUEST_HEAD.unpack_from(data, 1)
+        if length != len(data) - 5 or code not in COMMAND_NAMES:
+            raise ValueError("bad length or opcode")
+        command = COMMAND_NAMES[code]
+        ints = INT_FIELDS.get(command, ())
+        pos = 1 + REQUEST_HEAD.size
+        fields = []
+        for i in range(count):
+            if data[pos] == FIELD_INT:
+                value = INT_FIELD.unpack_from(data, pos)[1]
+                fields.append(value if i in ints else str(value))
+                pos += INT_FIELD.size
+            elif data[pos] == FIELD_STR:
+                size = STR_FIELD.unpack_from(data, pos)[1]
+                pos += STR_FIELD.size
+                if pos + size > len(data):
+                    raise ValueError("field past the end")
+                fields.append(data[pos:pos + size].decode("utf-8"))
+                pos += size
+            else:
+                raise ValueError(f"unknown field type {data[pos]}")
+        if pos != len(data):
+            raise ValueError("trailing bytes")
+    except (struct.error, IndexError) as e:
+        raise ValueError(f"truncated request: {e}")
+    return f"{req_id:x}", command, fields
+
+
+def pack_reply(req_id, text):
+    data = text.encode("utf-8")
+    return BINARY_MARK + REPLY_HEAD.pack(REPLY_HEAD.size - 4 + len(data), int(req_id, 16)) + data
+
+
+# 服务器解析一个请求数据报，返回 (请求编号, 是否二进制, 命令, [参数])，空的或者格式不对的返回None
+def decode_request(data):
+    if data.startswith(BINARY_MARK):
+        try:
+            req_id, command, fields = unpack_request(data)
+        except ValueError:
+            return None
+        return req_id, True, command, fields
+    req_id, msg = split_request_id(data.decode("utf-8", errors="ignore").strip())
+    if not msg:
+        return None
+    command, args = parse_command(msg)
+    return req_id, False, command, args
+
+
+# 服务器回复的数据（压缩之前）：二进制请求的回复也是二进制
+def format_reply(req_id, text, binary=False):
+    if binary and req_id is not None:
+        return pack_reply(req_id, text)
+    return add_request_id(req_id, text).encode("utf-8")
+
+
+# 客户端发送的请求：(命令, [参数]) 按二进制发送，字符串按文本发送
+def encode_request(req_id, request):
+    if isinstance(request, tuple):
+        return pack_request(req_id, *request)
+    return add_request_id(req_id, request).encode("utf-8")
+
+
+# 客户端解析收齐的回复，返回 (请求编号, 回复)
+def read_reply(data):
+    if data.startswith(COMPRESS_MARK):
+        data = zlib.decompress(data[len(COMPRESS_MARK):])
+    if data.startswith(BINARY_MARK):
+        _, req_id = REPLY_HEAD.unpack_from(data, 1)
+        return f"{req_id:x}", data[1 + REPLY_HEAD.size:].decode("utf-8", errors="ignore")
+    return split_request_id(data.decode("utf-8", errors="ignore"))
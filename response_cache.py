@@ -0,0 +1,105 @@
+import threading
+from collections import OrderedDict
+from logger import log
+
+DEFAULT_BUDGET = 16 * 1024 * 1024       # 默认16MB
+
+
+# RDT回复缓存：按字节预算做LRU淘汰，主题有写入时整体失效
+class ResponseCache:
+    def __init__(self, budget=DEFAULT_BUDGET):
+        self.budget = budget
+        self.size = 0
+        self.items = OrderedDict()      # {key: (threadtitle, response, nbytes)}
+        self.keys = {}                  # {threadtitle: set(key)}
+        self.generations = {}           # {threadtitle: 失效次数}，防止把过期的渲染结果放进缓存；删除主题时去掉
+        self.epoch = 0                  # 删除主题的次数：删除之后主题的失效次数从0重新开始
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            item = self.items.get(key)
+            if item is None:
+                self.misses += 1
+                return None
+            self.items.move_to_end(key)
+            self.hits += 1
+            return item[1]
+
+    # 渲染前先取得主题的版本号，put时版本号变了说明期间有写入或删除过主题，不再缓存
+    def generation(self, title):
+        with self.lock:
+            return self.epoch, self.generations.get(title, 0)
+
+    def put(self, key, title, response, generation):
+        nbytes = len(response.encode("utf-8"))
+        if nbytes > self.budget:
+            return
+
+        with self.lock:
+            if (self.epoch, self.generations.get(title, 0)) != generation:
+                return
+            if key in self.items:
+                self._drop(key)
+
+            self.items[key] = (title, response, nbytes)
+            self.keys.setdefault(title, set()).add(key)
+            self.size += nbytes
+
+            while self.size > self.budget:
+                self._drop(next(iter(self.items)))
+                self.evictions += 1
+
+    def _drop(self, key):
+        title, _, nbytes = self.items.pop(key)
+        self.size -= nbytes
+        keys = self.keys.get(title)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self.keys[title]
+
+    # 主题内容变化：删除该主题所有缓存的回复
+    def invalidate(self, title):
+        with self.lock:
+            self.generations[title] = self.generations.get(title, 0) + 1
+            for key in list(self.keys.get(title, ())):
+                self._drop(key)
+
+    # 主题被删除：删除缓存的回复和版本号
+    def remove(self, title):
+        with self.lock:
+            self.generations.pop(title, None)
+            self.epoch += 1
+            for key in list(self.keys.get(title, ())):
+                self._drop(key)
+
+    def stats(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+                "evictions": self.evictions,
+                "entries": len(self.items),
+                "bytes": self.size,
+                "budget": self.budget,
+            }
+
+    # 后台定期打印命中统计，方便调整预算
+    def start_reporter(self, interval=60):
+        def loop():
+            last = None
+            while True:
+                threading.Event().wait(interval)
+                s = self.stats()
+                if (s["hits"], s["misses"]) != last:
+                    last = (s["hits"], s["misses"])
+                    log.info("Cache", f"hits={s['hits']} misses={s['misses']} hit_rate={s['hit_rate']:.2%} "
+                                      f"entries={s['entries']} bytes={s['bytes']}/{s['budget']} evictions={s['evictions']}")
+
+        threading.Thread(target=loop, daemon=True).start()
@@ -1,63 +1,141 @@
-import sys
 import os
+import time
+import shutil
+import hashlib
+import secrets
+import argparse
 import socket
 import threading
 from queue import Queue
-
-credentials_file = "credentials.txt"
-
-# 读取credentials文件到一个字典中，格式为：{username: password}
-def read_credentials():
-    accounts = {}
-    if os.path.exists(credentials_file):
-        with open(credentials_file, "r", encoding="utf-8") as f:
-            for line in f:
-                line = line.strip()
-                if not line:
-                    continue
-                p = line.split(" ", 1)          # 只分割一次
-                if len(p) == 2:
-                    usrname, pwd = p
-                    accounts[usrname] = pwd
-    return accounts
-
-# 把用户的名字和密码保存到credentials文件
-def save_credentials(accounts):
-    with open(credentials_file, "w", encoding="utf-8") as f:
-        for usrname, pwd in accounts.items():
-            f.write(f"{usrname} {pwd}\n")
+from thread_store import STATE_DIR, CHECKPOINT_INTERVAL, valid_title
+from wal import DEFAULT_FSYNC, parse_fsync_policy
+from storage import open_storage, BACKENDS, DEFAULT_BACKEND
+from credentials import CredentialStore
+from blob_store import BlobStore
+from protocol import (fragment, FRAG_BURST, FRAG_GAP, MAX_REPLY, format_batch_result, parse_caps, format_caps, encode_reply, parse_command, to_int,
+                      check_fields, decode_request, format_reply)
+from response_cache import ResponseCache, DEFAULT_BUDGET
+from async_engine import AsyncEngine, DEFAULT_WORKERS
+from transfer import (send_file, recv_file, send_line, recv_line, send_frames, recv_frames, file_digest, load_ranges, add_range,
+                      missing_ranges, parse_range_request, DEFAULT_CHUNK_SIZE, DEFAULT_MAX_STREAMS,
+                      DEFAULT_TRANSFER_TTL, LEGACY_WAIT, TOKEN_PREFIX)
+from sessions import SessionTable, RecentReplies, DEFAULT_IDLE_TIMEOUT, DEFAULT_MAX_SESSIONS
+from shards import ShardedExecutor, DEFAULT_SHARDS
+from metrics import Metrics, SNAPSHOT_FILE, SNAPSHOT_INTERVAL
+from logger import (log, parse_sampling, LEVELS, DEFAULT_LEVEL, DEFAULT_BODY_LIMIT, DEFAULT_MAX_BYTES,
+                    DEFAULT_BACKUPS)
+
+# 第一个参数是主题的命令，按主题分片执行
+THREAD_COMMANDS = ("CRT", "MSG", "DLT", "EDT", "RDT", "UPD", "DWN", "RMV")
 
 # 论坛服务器对象
 class ForumServer:
-    def __init__(self, server_port):
+    def __init__(self, server_port, cache_bytes=DEFAULT_BUDGET, engine="threads", workers=DEFAULT_WORKERS,
+                 idle_timeout=DEFAULT_IDLE_TIMEOUT, max_sessions=DEFAULT_MAX_SESSIONS, chunk_size=DEFAULT_CHUNK_SIZE,
+                 max_streams=DEFAULT_MAX_STREAMS, transfer_ttl=DEFAULT_TRANSFER_TTL, shards=DEFAULT_SHARDS,
+                 fsync=DEFAULT_FSYNC, checkpoint_interval=CHECKPOINT_INTERVAL, storage=DEFAULT_BACKEND,
+                 db_path=None, admins=(), metrics_interval=SNAPSHOT_INTERVAL):
         self.server_port = server_port
+        self.engine = engine            # threads：每个client一个线程；asyncio：事件循环 + 有界线程池
+        self.workers = workers
+        self.chunk_size = chunk_size    # 上传时每次接收的字节数
+        self.max_streams = max_streams  # 一次传输最多使用的并行TCP连接数
+        self.transfer_ttl = transfer_ttl    # 传输令牌的有效期（秒）
+        self.checkpoint_interval = checkpoint_interval  # 检查点的间隔（秒）
+        self.admins = set(admins)       # 可以使用STATS的用户
+        self.metrics_interval = metrics_interval    # 写指标快照的间隔（秒）
         self.udp_sock = None
         self.tcp_sock = None
 
-        # 加载用户凭据
-        self.credentials = read_credentials()  # {username: password}
+        # 加载用户凭据（追加写的账号日志，密码只保存加盐哈希）
+        self.credentials = CredentialStore(fsync=fsync)
+        self.credentials.load()
         # 已登录用户
         self.active_users = set()
-        # 记录地址和线程的关系
-        self.client_threads = {}
+        # 登录时协商好的编码，会话登录成功后取走 {username: set(编码)}
+        self.negotiated = {}
+        # 记录地址和会话（线程）的关系，空闲超时的会话由后台线程回收
+        self.client_threads = SessionTable(idle_timeout, max_sessions)
         # 另一个TCP
         self.file_transfer_threads = []
-        # 记录client对应的文件信息
+        # 等待TCP连接的文件传输 {令牌: 文件信息}
         self.pending_transfers = {}
+        # 旧格式的UPD/DWN（客户端不出示令牌）仍按客户端IP记录 {client_ip: 文件信息}
+        self.legacy_transfers = {}
+        # 正在提交（核对摘要、存入BlobStore）的上传，partial文件路径
+        self.committing = set()
+        self.transfer_lock = threading.Lock()
+        # 主题存储和主题目录（LST直接查询）
+        # files：消息常驻内存，追加写主题文件，修改先写预写日志；sqlite：索引查询 .forum/forum.db
+        self.threads, self.catalog = open_storage(storage, fsync=fsync, db_path=db_path)
+        # RDT回复缓存（cache_bytes为0时不缓存）
+        self.rdt_cache = ResponseCache(cache_bytes)
+        # 附件按内容去重存储
+        self.blobs = BlobStore()
+        # 按主题分片执行命令：同一主题的命令依次执行，不同主题并行
+        self.shards = ShardedExecutor(shards)
+        # 每种命令的耗时、文件传输的吞吐量，以及会话数、队列长度（STATS命令和 .forum/metrics.json）
+        self.metrics = Metrics(self.gauges)
+        # 命令表：文本和二进制请求解析成 (命令, 参数) 之后都从这里分派
+        self.handlers = {
+            "XIT": self.xit_process, "STATS": self.stats_process, "BATCH": self.batch_process,
+            "CRT": self.crt_process, "MSG": self.msg_process, "DLT": self.dlt_process, "EDT": self.edt_process,
+            "LST": self.lst_process, "RDT": self.rdt_process, "UPD": self.upd_process, "DWN": self.dwn_process,
+            "RMV": self.rmv_process,
+        }
+        # 未完成的上传；旧版直接放在 partial 中的文件分不清属于哪个主题，删除（客户端会重新上传）
+        partial_root = os.path.join(STATE_DIR, "partial")
+        os.makedirs(partial_root, exist_ok=True)
+        for f in os.listdir(partial_root):
+            if os.path.isfile(os.path.join(partial_root, f)):
+                os.remove(os.path.join(partial_root, f))
 
     # 启动server以及TCP、UDP
     def start(self):
+        # 重放预写日志，恢复上次崩溃时还没有写到主题文件里的修改
+        recovered = self.threads.recover()
+
+        # 加载主题目录，恢复过的主题以主题文件为准
+        self.catalog.load(self.credentials.keys())
+        for title in recovered:
+            creator = self.threads.creator(title)
+            if creator is None:
+                self.catalog.remove(title)
+                continue
+            if title not in self.catalog:
+                self.catalog.add(title, creator)
+            self.catalog.touch(title, self.threads.count(title))
+        self.catalog.start_flusher()
+        self.credentials.start_syncer()
+        self.blobs.load(list(self.catalog.entries), self.has_upload)
+        self.blobs.start_flusher()
+        self.rdt_cache.start_reporter()
+        # 启动命令分片线程
+        self.shards.start()
+        self.shards.start_reporter()
+
+        # 后台定期检查点（压缩主题日志、清空预写日志）
+        self.threads.start_checkpointer(self.checkpoint_interval)
+        # 后台回收空闲会话
+        self.client_threads.start_reaper()
+        # 后台定期写指标快照
+        self.metrics.start_snapshotter(os.path.join(STATE_DIR, SNAPSHOT_FILE), self.metrics_interval)
+
+        if self.engine == "asyncio":
+            AsyncEngine(self, self.workers).run()
+            return
+
         # 启动UDP
         self.udp_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.udp_sock.bind(("127.0.0.1", self.server_port))
-        print(f"[Server] UDP port {self.server_port} is open, waiting for client messages...")
+        log.info("Server", f"UDP port {self.server_port} is open, waiting for client messages...")
 
         # 启动TCP
         self.tcp_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.tcp_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.tcp_sock.bind(("127.0.0.1", self.server_port))
         self.tcp_sock.listen(5)
-        print(f"[Server] TCP port {self.server_port} is open.")
+        log.info("Server", f"TCP port {self.server_port} is open.")
 
         # 创建udp线程
         udp_thread = threading.Thread(target=self.udp_msg_process, daemon=True)
@@ -68,7 +146,7 @@ class ForumServer:
         tcp_thread.start()
 
         # 主线程保持存活
-        print("[Server] The server is ready to serve multiple clients concurrently.")
+        log.info("Server", "The server is ready to serve multiple clients concurrently.")
         while True:
             threading.Event().wait(1000)
 
@@ -77,324 +155,614 @@ class ForumServer:
         while True:
             data, addr = self.udp_sock.recvfrom(8192)       # 阻塞等待UDP
 
-            if addr not in self.client_threads:             # 说明是新client，需要创建一个新的线程
-                print(f"[Server] New client address detected: {addr}, create thread...")
+            client_thread = self.client_threads.touch(addr)
+            if client_thread is None:                       # 说明是新client，需要创建一个新的线程
                 client_thread = ProcessClient(self, addr)
-                self.client_threads[addr] = client_thread
+                if not self.client_threads.add(addr, client_thread):
+                    log.warning("Server", f"Too many sessions, rejecting {addr}.", event="session")
+                    self.udp_sock.sendto("SERVER_BUSY".encode("utf-8"), addr)
+                    continue
+                log.info("Server", f"New client address detected: {addr}, create thread...", event="session")
                 client_thread.start()
 
-            self.client_threads[addr].messages.put(data)   # 分配信息给对应的线程
+            client_thread.messages.put(data)   # 分配信息给对应的线程
 
     # 处理连接和文件
     def tcp_connect_file(self):
         while True:
             link, addr = self.tcp_sock.accept()
-            print(f"[Server] Receives a TCP file transfer request from {addr}, creates FileTransfer...")
+            log.info("Server", f"Receives a TCP file transfer request from {addr}, creates FileTransfer...",
+                     event="transfer")
             file_thread = FileTransfer(self, link, addr)
             self.file_transfer_threads.append(file_thread)
             file_thread.start()
 
     # 移除线程
-    def remov_thread(self, addr):
-        if addr in self.client_threads:
-            del self.client_threads[addr]
-
-    # 命令处理
-    def command_process(self, msg, username, addr):
-        print(f"[Server] {username} issued the command: {msg}.")
-        p = msg.split()
-        command = p[0]
-
-        def end(res):
-            print(f"[Server] The server respond to {username} with: \n{res}.")
-            return res
-        
-        # XIT退出
-        if command == "XIT":
-            return end("XIT_OK")
-
-        # CRT创建线程
-        if command == "CRT":
-            if len(p) != 3:
-                return end("ERROR: correct usage: CRT <threadtitle>")
-            
-            threadtitle = p[1]
-            thread_file = threadtitle
-
-            if os.path.exists(thread_file):
-                return end("ERROR: The thread already exists.")
-            else:
-                with open(thread_file, "w", encoding="utf-8") as f:
-                    f.write(username + "\n")
-
-                print(f"[Server] Thread {threadtitle} has been created by {username}.")
-                return end(f"Thread {threadtitle} was created successfully.")
-
-        # MSG发消息
-        if command == "MSG":
-            if len(p) < 3:
-                return end("ERROR: correct usage: MSG <threadtitle> <message>")
-            
-            threadtitle = p[1]
-            message_text = " ".join(p[2:-1])        # 去掉最后的username
-            if not os.path.exists(threadtitle):
-                return end("ERROR: Thread does not exist.")
-
-            with open(threadtitle, "r", encoding="utf-8") as f:
-                lines = f.readlines()
-
-            msg_count = 0
-            for line in lines[1:]:
-                if " uploaded " not in line:
-                    msg_count += 1
-            new_num = msg_count + 1
-
-            with open(threadtitle, "a", encoding="utf-8") as f:
-                f.write(f"{new_num} {username}: {message_text}\n")
-
-            print(f"[Server] {username} posted a new message in {threadtitle}.")
-            return end(f"Successfully posted a message in {threadtitle}.")
-
-        # DLT删除消息
-        if command == "DLT":
-            if len(p) != 4:
-                return end("ERROR: correct usage: DLT <threadtitle> <messagenumber>")
-            threadtitle = p[1]
-
-            try:
-                msg_num = int(p[2])
-            except:
-                return end("ERROR: The message number should be an integer.")
-            
-            if not os.path.exists(threadtitle):
-                return end("ERROR: Thread does not exist.")
-
-            with open(threadtitle, "r", encoding="utf-8") as f:
-                lines = f.readlines()
-
-            found_line_index = -1
-            found_line_content = None
-            message_count = 0
-
-            for i in range(1, len(lines)):
-                if " uploaded " in lines[i]:
-                    continue
-                message_count += 1
-                if message_count == msg_num:
-                    found_line_index = i
-                    found_line_content = lines[i]
-                    break
+    def remov_thread(self, addr, client_thread=None):
+        self.client_threads.remove(addr, client_thread)
+
+    # 身份验证的一步：LOGIN <username> [caps=...] 之后紧跟 PWD <password>
+    # pending为上一步的状态，返回 (回复, 新的pending, 登录成功的用户名)
+    # 登录成功时协商好的编码放在 self.negotiated[username] 中
+    def identity_step(self, pending, command, args):
+        p = [command] + args
+        # 会话已经结束后收到重传的XIT
+        if p == ["XIT"]:
+            return "XIT_OK", None, None
+        # 会话已被回收的客户端继续发命令时，提示重新登录
+        if pending is None and command not in ("LOGIN", "PWD"):
+            return "ERROR: You are not logged in, please log in again.", None, None
+        if len(p) < 2:
+            return None, None, None
+
+        # 读取用户名
+        if pending is None:
+            command, username = p[0], p[1]
+            if command != "LOGIN":
+                return None, None, None
 
-            if found_line_index == -1:
-                return end("ERROR: Message number does not exist.")
-            
-            tmp = found_line_content.strip().split(" ", 2)
-            if len(tmp) < 2:
-                return end("ERROR: Message number does not exist.")
-            
-
-            user_part = tmp[1]
-            poster = user_part.split(":", 1)[0]
-            if poster != username:
-                return end("ERROR: You can only delete your own messages.")
-
-            del lines[found_line_index]
-            with open(threadtitle, "w", encoding="utf-8") as f:
-                for line_content in lines:
-                    f.write(line_content)
-
-            # 重新编号
-            with open(threadtitle, "r", encoding="utf-8") as f:
-                lines = f.readlines()
-
-            new_lines = [lines[0]]
-            real_msg_index = 0
-            for i in range(1, len(lines)):
-                if " uploaded " in lines[i]:
-                    new_lines.append(lines[i])
-                else:
-                    real_msg_index += 1
-                    parts_line = lines[i].strip().split(" ", 2)
-                    if len(parts_line) >= 3:
-                        new_lines.append(f"{real_msg_index} {parts_line[1]} {parts_line[2]}\n")
-                    else:
-                        new_lines.append(lines[i])
-
-            with open(threadtitle, "w", encoding="utf-8") as f:
-                for l in new_lines:
-                    f.write(l)
-
-            print(f"[Server] {username} deleted message {msg_num} in {threadtitle}.")
-            return end(f"Message {msg_num} in {threadtitle} has been successfully deleted.")
-
-        # EDT编辑消息
-        if command == "EDT":
-            if len(p) < 4:
-                return end("ERROR: correct usage: EDT <threadtitle> <messagenumber> <new_message>")
-            threadtitle = p[1]
-            try:
-                msg_num = int(p[2])
-            except:
-                return end("ERROR: The message number should be an integer.")
-            
-            new_msg = " ".join(p[3:-1])
-            if not os.path.exists(threadtitle):
-                return end("ERROR: Message number does not exist.")
-
-            with open(threadtitle, "r", encoding="utf-8") as f:
-                lines = f.readlines()
-
-            message_count = 0
-            found_line_index = -1
-            found_line_content = None
-
-            for i in range(1, len(lines)):
-                if " uploaded " in lines[i]:
-                    continue
-                message_count += 1
-                if message_count == msg_num:
-                    found_line_index = i
-                    found_line_content = lines[i]
-                    break
+            # 如果该用户名已经被其他client使用
+            if username in self.active_users:
+                return "USER_IN_USE", None, None
 
-            if found_line_index == -1:
-                return end("ERROR: Message number does not exist.")
-            
-            tmp = found_line_content.strip().split(" ", 2)
-            if len(tmp) < 3:
-                return end("ERROR: Message number does not exist.")
-
-            poster = tmp[1].replace(":", "")
-            if poster != username:
-                return end("ERROR: You can only delete your own messages.")
-
-            new_line = f"{tmp[0]} {tmp[1]} {new_msg}\n"
-            lines[found_line_index] = new_line
-
-            with open(threadtitle, "w", encoding="utf-8") as f:
-                for l in lines:
-                    f.write(l)
-
-            print(f"[Server] {username} edited message {msg_num} in {threadtitle}.")
-            return end(f"Message {msg_num} in {threadtitle} has been successfully edited.")
-
-        # LST列出线程
-        if command == "LST":
-            files = os.listdir(".")
-            thread_titles = []
-            
-            for filename in files:
-                if os.path.isfile(filename):
-                    try:
-                        with open(filename, "r", encoding="utf-8") as f:
-                            first_line = f.readline().strip()
-                            if first_line in self.credentials.keys():
-                                thread_titles.append(filename)
-                    except:
-                        pass
-
-            if len(thread_titles) == 0:
-                print(f"[Server] {username} requested LST, but there are no threads.")
-                return end("There are no threads.")
+            # 判断用户名是否存在，记下客户端支持的编码
+            caps = parse_caps(p[2:])
+            if username in self.credentials:
+                return "EXISTING_USER", ("existing", username, caps), None
             else:
-                print(f"[Server] {username} request LST, current thread list: {thread_titles}")
-                return end("\n".join(thread_titles))
-
-        # RDT读取线程
-        if command == "RDT":
-            threadtitle = p[1] if len(p) >= 2 else None
-            if not os.path.exists(threadtitle):
-                return end("ERROR: Message number does not exist.")
-            
-            with open(threadtitle, "r", encoding="utf-8") as f:
-                lines = f.readlines()
-
-            if len(lines) <= 1:
-                print(f"[Server] {username} read {threadtitle} but no content.")
-                return end("Thread has no content")
+                return "NEW_USER", ("new", username, caps), None
+
+        # 读取密码
+        mode, username, caps = pending
+        pwd_cmd, password = p[0], p[1]
+        if pwd_cmd != "PWD":
+            return None, None, None
+
+        if mode == "existing":
+            # 验证密码
+            if not self.credentials.verify(username, password):
+                return "WRONG_PASSWORD", None, None
+
+            self.active_users.add(username)
+            self.negotiated[username] = caps
+            log.info("Server", f"User {username} logged in successfully.", event="session")
+            return "LOGIN_SUCCESS" + format_caps(caps), None, username
+
+        # 新用户，追加到账号日志；同时有另一个会话注册了同一个用户名时按已有用户验证
+        if not self.credentials.register(username, password) and not self.credentials.verify(username, password):
+            return "WRONG_PASSWORD", None, None
+
+        self.active_users.add(username)
+        self.negotiated[username] = caps
+        log.info("Server", f"New user {username} has been created and logged in successfully.", event="session")
+        return "LOGIN_SUCCESS" + format_caps(caps), None, username
+
+    # 文件上传/下载完成后记录到主题
+    def record_transfer(self, threadtitle, username, filename, action):
+        self.threads.append_event(threadtitle, f"{username} {action} {filename}")
+        self.catalog.touch(threadtitle)
+        self.rdt_cache.invalidate(threadtitle)
+
+    # 主题中是否有上传filename的记录（导入旧版附件时区分有歧义的 <threadtitle>-<filename>）
+    def has_upload(self, threadtitle, filename):
+        lines = self.threads.read(threadtitle) or []
+        return any(line.rstrip("\n").split(" ", 1)[1:] == [f"uploaded {filename}"] for line in lines)
+
+    # 命令所属的主题，不属于某个主题的命令（LST、XIT、BATCH）返回None
+    def shard_key(self, command, args):
+        if args and command in THREAD_COMMANDS:
+            return args[0]
+        return None
+
+    # 执行一条命令：主题命令交给主题对应的分片线程，等待结果；其他命令直接在调用者线程执行
+    def execute(self, command, args, username, addr):
+        key = self.shard_key(command, args)
+        if key is None:
+            return self.request_process(command, args, username, addr)
+        return self.shards.run(key, self.request_process, command, args, username, addr)
+
+    # 在一个分片上依次执行若干条命令，推迟写盘，返回 [(序号, 回复)]
+    def run_commands(self, commands, username, addr):
+        with self.threads.deferred_flush():
+            return [(i, self.request_process(command, args, username, addr)) for i, command, args in commands]
+
+    # BATCH批量命令：主题命令按分片分组，每组在自己的分片上依次执行（同一主题的命令保持顺序），各组并行；
+    # LST等不属于主题的命令要等前面的命令都执行完再执行。最后一次回复所有结果
+    # commands是每条一行的文本命令（文本和二进制的BATCH相同）
+    def batch_process(self, commands, username, addr):
+        if not commands:
+            return "ERROR: correct usage: BATCH followed by one command per line"
+
+        results = [None] * len(commands)
+        groups = {}                     # {分片编号: (key, [(序号, 命令, 参数)])}
+
+        def run_groups():
+            futures = [self.shards.submit(key, self.run_commands, group, username, addr)
+                       for key, group in groups.values()]
+            groups.clear()
+            for future in futures:
+                for i, result in future.result():
+                    results[i] = result
+
+        for i, sub in enumerate(commands):
+            command, args = parse_command(sub)
+            if command in ("BATCH", "XIT"):
+                results[i] = f"ERROR: {command} cannot be used inside BATCH."
+                continue
+            key = self.shard_key(command, args)
+            if key is None:
+                run_groups()
+                results[i] = self.run_commands([(i, command, args)], username, addr)[0][1]
             else:
-                content = "".join(lines[1:])
-                print(f"[Server] {username} read {threadtitle}.")
-                return end(content)
-
-        # UPD上传文件
-        if command == "UPD":
-            if len(p) != 4:
-                return end("ERROR: correct usage: UPD <threadtitle> <filename>")
-            
-            threadtitle = p[1]
-            filename = p[2]
-            if not os.path.exists(threadtitle):
-                return end("ERROR: Message number does not exist.")
-            
-            server_side_file = f"{threadtitle}-{filename}"
-            if os.path.exists(server_side_file):
-                return end("ERROR: The filename has been uploaded to the thread.")
-            
-            # 记录文件信息
-            client_ip = addr[0]
-            self.pending_transfers[client_ip] = {
-                "mode": "upload",
-                "threadtitle": threadtitle,
-                "filename": filename,
-                "username": username
-            }
-
-            print(f"[Server] {username} preparing to upload a file to {threadtitle}: {filename}")
-
-            return end("UPD_OK")
-
-        # DWN下载文件
-        if command == "DWN":
-            if len(p) != 4:
-                return end("ERROR: correct usage: DWN <threadtitle> <filename>")
-            
-            threadtitle = p[1]
-            filename = p[2]
-            if not os.path.exists(threadtitle):
-                return end("ERROR: Message number does not exist.")
-            
-            server_side_file = f"{threadtitle}-{filename}"
-            if not os.path.exists(server_side_file):
-                return end("ERROR: The file does not exist in the thread.")
-            
-            # 记录文件信息
-            client_ip = addr[0]
-            self.pending_transfers[client_ip] = {
-                "mode": "download",
-                "threadtitle": threadtitle,
-                "filename": filename,
-                "username": username
-            }
-
-            print(f"[Server] {username}  preparing to download file to {threadtitle}: {filename}")
-            return end("DWN_OK")
-
-        # RMV删除线程
-        if command == "RMV":
-            if len(p) != 3:
-                return end("ERROR: correct usage: RMV <threadtitle>")
-            
-            threadtitle = p[1]
-            if not os.path.exists(threadtitle):
-                return end("ERROR: Message number does not exist.")
-            
-            with open(threadtitle, "r", encoding="utf-8") as f:
-                creator = f.readline().strip()
-
-            if creator != username:
-                return end("ERROR: Only the thread creator can delete the thread.")
-            
-            files = os.listdir(".")
-            for f in files:
-                if f == threadtitle or f.startswith(threadtitle + "-"):
-                    os.remove(f)
-
-            print(f"[Server] Thread {threadtitle} has been deleted by {username}.")
-            return end(f"Thread {threadtitle} has been deleted")
-
-        # 如果都不匹配
-        return end("ERROR: Invalid command")
+                groups.setdefault(self.shards.shard_of(key), (key, []))[1].append((i, command, args))
+        run_groups()
+
+        log.info("Server", f"{username} ran a batch of {len(commands)} command(s).", event="command")
+        return format_batch_result(results)
+
+    # 未完成的上传按主题保存在 .forum/partial/<threadtitle>/ 中，删除主题时删除整个目录
+    def partial_dir(self, threadtitle):
+        path = os.path.join(STATE_DIR, "partial", threadtitle)
+        os.makedirs(path, exist_ok=True)
+        return path
+
+    # 文件名带上摘要，内容不同的上传互不影响
+    def partial_path(self, threadtitle, filename, sha256):
+        return os.path.join(self.partial_dir(threadtitle), f"{filename}.{sha256[:16]}")
+
+    # 旧客户端上传时没有摘要，先收到这里，收完再计算摘要存入BlobStore
+    def legacy_partial_path(self, threadtitle, filename):
+        return os.path.join(self.partial_dir(threadtitle), f"{filename}.legacy")
+
+    # 返回是否提交（同名文件已经上传过时丢弃）
+    def commit_legacy_upload(self, transfer_info, partial):
+        if not self.blobs.commit(partial, file_digest(partial), transfer_info["threadtitle"],
+                                 transfer_info["filename"]):
+            os.remove(partial)
+            return False
+        self.record_transfer(transfer_info["threadtitle"], transfer_info["username"], transfer_info["filename"],
+                             "uploaded")
+        return True
+
+    # 登记一次文件传输，返回一次性的传输令牌，客户端在TCP连接上先出示令牌
+    # 令牌过期、或者已经被streams条连接出示过后作废；client_ip不为None时按旧格式登记，不返回令牌
+    def register_transfer(self, transfer_info, client_ip=None):
+        now = time.monotonic()
+        with self.transfer_lock:
+            for table in (self.pending_transfers, self.legacy_transfers):
+                for key in [k for k, info in table.items() if info["expires"] < now]:
+                    del table[key]
+
+            transfer_info["expires"] = now + self.transfer_ttl
+            if client_ip is not None:
+                self.legacy_transfers[client_ip] = transfer_info
+                return None
+            token = secrets.token_hex(16)
+            self.pending_transfers[token] = transfer_info
+            return token
+
+    # TCP连接出示令牌时取出对应的传输信息；并行传输时同一个令牌可以被streams条连接使用
+    # 返回 (传输信息, 是否是最后一条连接)，令牌无效或过期返回 (None, False)
+    def claim_transfer(self, token):
+        return self._claim(self.pending_transfers, token)
+
+    def claim_legacy_transfer(self, client_ip):
+        return self._claim(self.legacy_transfers, client_ip)
+
+    def _claim(self, table, key):
+        with self.transfer_lock:
+            transfer_info = table.get(key)
+            if transfer_info is None:
+                return None, False
+            if transfer_info["expires"] < time.monotonic():
+                del table[key]
+                return None, False
+            transfer_info["streams"] -= 1
+            if transfer_info["streams"] <= 0:
+                del table[key]
+                return transfer_info, True
+            return transfer_info, False
+
+    # 区间传输的请求解析和收尾，线程和asyncio两种引擎共用；引擎只负责在连接上收发帧
+    # "PUT <start> [end]" 解析成 (partial文件, start, end, hasher)，格式不对返回None
+    # 一条连接从0收完整个文件时边收边算摘要，否则提交时重新读一遍文件
+    def upload_request(self, transfer_info, line):
+        size = transfer_info["size"]
+        request = parse_range_request(line, "PUT", size)
+        if request is None:
+            return None
+        start, end, _ = request
+        partial = self.partial_path(transfer_info["threadtitle"], transfer_info["filename"], transfer_info["sha256"])
+        hasher = hashlib.sha256() if start == 0 and end == size else None
+        return partial, start, end, hasher
+
+    # 一个上传区间收完或中断：登记区间，收齐时提交，返回 (回复客户端的一行, 是否继续使用这条连接)
+    def upload_result(self, transfer_info, partial, start, received, status, hasher, elapsed, source):
+        self.metrics.transfer("upload", received, elapsed)
+        result = self.finish_upload_range(transfer_info, partial, start, received,
+                                          hasher if received == transfer_info["size"] else None)
+        if result is None:
+            result = "RANGE_OK" if status == "OK" else f"ERROR {status} {start + received}"
+
+        if status != "OK":
+            log.warning(source, f"Upload of {transfer_info['filename']} stopped at {start + received} bytes: {status}.",
+                        event="transfer")
+            return result, False
+        if result == "OK":
+            log.info(source, f"{transfer_info['username']} has uploaded "
+                             f"{transfer_info['threadtitle']}-{transfer_info['filename']} successfully.", event="transfer")
+        return result, True
+
+    # "GET <start> [end] [z]" 解析成 (文件路径, start, end, 是否按压缩帧发送)，格式不对返回None
+    def download_request(self, transfer_info, line):
+        path = self.blobs.path(transfer_info["sha256"])
+        request = parse_range_request(line, "GET", os.path.getsize(path))
+        return None if request is None else (path,) + request
+
+    # 记录一个上传区间 [start, start + received)，所有区间都收到后提交
+    # 返回提交结果（"OK" / "ERROR ..."），还有区间没收到时返回None
+    # hasher是接收时边收边算的摘要（一条连接从0收完整个文件时才有），否则重新读一遍文件
+    # 锁里只记录区间、认领提交；计算摘要、存入BlobStore、写主题记录（预写日志fsync）都在锁外，不挡住其他传输
+    def finish_upload_range(self, transfer_info, partial, start, received, hasher=None):
+        with self.transfer_lock:
+            if partial in self.committing:          # 另一条连接收齐了，正在提交
+                return "OK"
+            if not os.path.exists(partial):         # 已经被另一条连接提交或丢弃
+                return None
+            add_range(partial, start, start + received)
+            if missing_ranges(load_ranges(partial), transfer_info["size"]):
+                return None
+            self.committing.add(partial)
+        try:
+            return self.commit_upload(transfer_info, partial, hasher)
+        finally:
+            with self.transfer_lock:
+                self.committing.discard(partial)
+
+    # 上传收完后核对大小和摘要，通过后原子改名提交，返回 "OK" 或 "ERROR ..."
+    def commit_upload(self, transfer_info, partial, hasher=None):
+        threadtitle = transfer_info["threadtitle"]
+        filename = transfer_info["filename"]
+        username = transfer_info["username"]
+
+        def discard():
+            os.remove(partial)
+            if os.path.exists(partial + ".ranges"):
+                os.remove(partial + ".ranges")
+
+        size = os.path.getsize(partial)
+        if size != transfer_info["size"]:
+            discard()
+            return "ERROR SIZE_MISMATCH 0"
+
+        digest = hasher.hexdigest() if hasher is not None else file_digest(partial)
+        if digest != transfer_info["sha256"]:
+            discard()
+            return "ERROR DIGEST_MISMATCH 0"
+
+        if not self.blobs.commit(partial, digest, threadtitle, filename):
+            discard()
+            return "ERROR The filename has been uploaded to the thread."
+        if os.path.exists(partial + ".ranges"):
+            os.remove(partial + ".ranges")
+        self.record_transfer(threadtitle, username, filename, "uploaded")
+        return "OK"
+
+    # 指标中的当前值：会话数、每个会话待处理的消息数、等待TCP连接的传输数、每个分片的队列长度
+    def gauges(self):
+        with self.client_threads.lock:
+            sessions = list(self.client_threads.sessions.values())
+        depths = [session.messages.qsize() for session in sessions]
+        return {"sessions": len(sessions), "active_users": len(self.active_users),
+                "queued_messages": sum(depths), "max_session_queue": max(depths, default=0),
+                "pending_transfers": len(self.pending_transfers) + len(self.legacy_transfers),
+                "shard_depths": [s["depth"] for s in self.shards.stats()]}
+
+    # 执行一条文本命令（BATCH中的每一条、基准测试直接调用）
+    def command_process(self, msg, username, addr):
+        command, args = parse_command(msg)
+        return self.request_process(command, args, username, addr)
+
+    # 执行一条解析好的命令（文本和二进制请求相同），按命令记录处理耗时
+    def request_process(self, command, args, username, addr):
+        started = time.perf_counter()
+        response = None
+        try:
+            response = self.handle_command(command, args, username, addr)
+            return response
+        finally:
+            self.metrics.observe(command, time.perf_counter() - started,
+                                 response is None or response.startswith("ERROR"))
+
+    # 按命令表分派，args是命令后面的参数（不含用户名）
+    def handle_command(self, command, args, username, addr):
+        handler = self.handlers.get(command)
+        if command == "BATCH":
+            return handler(args, username, addr)
+        error = check_fields(command, args)
+        if error is not None:
+            return error
+
+        if log.wants("info", "command"):
+            text = " ".join([command] + [str(a) for a in args])
+            log.info("Server", f"{username} issued the command: {text}.", event="command", user=username,
+                     command=text)
+        res = handler(args, username, addr) if handler is not None else "ERROR: Invalid command"
+
+        # 回复正文默认不写进日志，只记录长度（--log-body）
+        if log.wants("info", "response"):
+            body = log.body(res)
+            text = f"with: \n{body}." if body is not None else f"with {len(res)} byte(s)."
+            log.info("Server", f"The server respond to {username} {text}", event="response", user=username,
+                     command=command, bytes=len(res), body=body)
+        return res
+
+    # XIT退出
+    def xit_process(self, args, username, addr):
+        return "XIT_OK"
+
+    # STATS：只有管理员（--admin）可以查看服务器指标
+    def stats_process(self, args, username, addr):
+        if username not in self.admins:
+            return "ERROR: STATS is only available to administrators."
+        return self.metrics.format()
+
+    # CRT创建线程
+    def crt_process(self, args, username, addr):
+        if len(args) != 1:
+            return "ERROR: correct usage: CRT <threadtitle>"
+
+        threadtitle = args[0]
+        if not valid_title(threadtitle):
+            return "ERROR: A thread title cannot contain '/', start with '.' or name a server file."
+
+        if not self.threads.create(threadtitle, username):
+            return "ERROR: The thread already exists."
+        self.catalog.add(threadtitle, username)
+        log.info("Server", f"Thread {threadtitle} has been created by {username}.",
+                 event="forum", user=username, thread=threadtitle)
+        return f"Thread {threadtitle} was created successfully."
+
+    # MSG发消息
+    def msg_process(self, args, username, addr):
+        if len(args) not in (1, 2):
+            return "ERROR: correct usage: MSG <threadtitle> <message>"
+
+        threadtitle = args[0]
+        message_text = args[1] if len(args) == 2 else ""
+        new_num = self.threads.append_message(threadtitle, username, message_text)
+        if new_num is None:
+            return "ERROR: Thread does not exist."
+        self.catalog.touch(threadtitle, new_num)
+        self.rdt_cache.invalidate(threadtitle)
+
+        log.info("Server", f"{username} posted a new message in {threadtitle}.",
+                 event="forum", user=username, thread=threadtitle)
+        return f"Successfully posted a message in {threadtitle}."
+
+    # DLT删除消息
+    def dlt_process(self, args, username, addr):
+        if len(args) != 2:
+            return "ERROR: correct usage: DLT <threadtitle> <messagenumber>"
+        threadtitle = args[0]
+
+        msg_num = to_int(args[1])
+        if msg_num is None:
+            return "ERROR: The message number should be an integer."
+
+        if not self.threads.exists(threadtitle):
+            return "ERROR: Thread does not exist."
+
+        status = self.threads.delete_message(threadtitle, msg_num, username)
+        if status == "NOT_FOUND":
+            return "ERROR: Message number does not exist."
+        if status == "NOT_OWNER":
+            return "ERROR: You can only delete your own messages."
+        self.catalog.touch(threadtitle, self.threads.count(threadtitle))
+        self.rdt_cache.invalidate(threadtitle)
+
+        log.info("Server", f"{username} deleted message {msg_num} in {threadtitle}.",
+                 event="forum", user=username, thread=threadtitle)
+        return f"Message {msg_num} in {threadtitle} has been successfully deleted."
+
+    # EDT编辑消息
+    def edt_process(self, args, username, addr):
+        if len(args) not in (2, 3):
+            return "ERROR: correct usage: EDT <threadtitle> <messagenumber> <new_message>"
+        threadtitle = args[0]
+        msg_num = to_int(args[1])
+        if msg_num is None:
+            return "ERROR: The message number should be an integer."
+
+        new_msg = args[2] if len(args) == 3 else ""
+        if not self.threads.exists(threadtitle):
+            return "ERROR: Message number does not exist."
+
+        status = self.threads.edit_message(threadtitle, msg_num, username, new_msg)
+        if status == "NOT_FOUND":
+            return "ERROR: Message number does not exist."
+        if status == "NOT_OWNER":
+            return "ERROR: You can only delete your own messages."
+        self.catalog.touch(threadtitle)
+        self.rdt_cache.invalidate(threadtitle)
+
+        log.info("Server", f"{username} edited message {msg_num} in {threadtitle}.",
+                 event="forum", user=username, thread=threadtitle)
+        return f"Message {msg_num} in {threadtitle} has been successfully edited."
+
+    # LST列出线程：LST [sort=title|recent|messages|created] [by=<creator>] [match=<text>]
+    def lst_process(self, args, username, addr):
+        options = {}
+        for token in args:
+            if "=" not in token:
+                return "ERROR: correct usage: LST [sort=title|recent|messages|created] [by=<creator>] [match=<text>]"
+            key, value = token.split("=", 1)
+            options[key] = value
+
+        entries = self.catalog.list(options.get("sort", "title"), options.get("by"), options.get("match"))
+        thread_titles = [e["title"] for e in entries]
+
+        if len(thread_titles) == 0:
+            log.info("Server", f"{username} requested LST, but there are no threads.", event="forum", user=username)
+            return "There are no threads."
+        log.info("Server", f"{username} request LST, {len(entries)} thread(s).", event="forum", user=username)
+        return "\n".join(thread_titles)
+
+    # RDT读取线程：RDT <threadtitle> [offset] [limit]，offset为负数时从末尾倒数
+    def rdt_process(self, args, username, addr):
+        if not 1 <= len(args) <= 3:
+            return "ERROR: correct usage: RDT <threadtitle> [offset] [limit]"
+
+        threadtitle = args[0]
+        offset = to_int(args[1]) if len(args) >= 2 else 0
+        limit = to_int(args[2]) if len(args) == 3 else None
+        if offset is None or (len(args) == 3 and limit is None):
+            return "ERROR: The offset and limit should be integers."
+
+        # 先查缓存
+        key = (threadtitle, offset, limit) if len(args) >= 2 else (threadtitle,)
+        cached = self.rdt_cache.get(key)
+        if cached is not None:
+            log.info("Server", f"{username} read {threadtitle} (cached).",
+                     event="forum", user=username, thread=threadtitle)
+            return cached
+
+        generation = self.rdt_cache.generation(threadtitle)
+        page = self.threads.page(threadtitle, offset, limit)
+        if page is None:
+            return "ERROR: Message number does not exist."
+
+        lines, start, total = page
+        if total == 0:
+            log.info("Server", f"{username} read {threadtitle} but no content.",
+                     event="forum", user=username, thread=threadtitle)
+            return "Thread has no content"
+
+        content = "".join(lines)
+        if len(args) >= 2:
+            content += f"[lines {start + 1}-{start + len(lines)} of {total}]"
+        if len(content.encode("utf-8")) > MAX_REPLY:
+            return (f"ERROR: {total} lines are too many to read at once, "
+                    f"read the thread in pages: RDT {threadtitle} <offset> <limit>")
+        self.rdt_cache.put(key, threadtitle, content, generation)
+        log.info("Server", f"{username} read {threadtitle}.", event="forum", user=username, thread=threadtitle)
+        return content
+
+    # UPD上传文件
+    # 可续传的上传带上文件大小和SHA-256：UPD <threadtitle> <filename> <size> <sha256> [streams]
+    def upd_process(self, args, username, addr):
+        if len(args) not in (2, 4, 5):
+            return "ERROR: correct usage: UPD <threadtitle> <filename>"
+
+        threadtitle = args[0]
+        filename = args[1]
+        size, sha256, streams = None, None, 1
+        if len(args) >= 4:
+            size = to_int(args[2])
+            if len(args) == 5:
+                streams = to_int(args[4])
+            if size is None or size < 0 or len(args[3]) != 64 or streams is None:
+                return "ERROR: correct usage: UPD <threadtitle> <filename> <size> <sha256> [streams]"
+            sha256 = args[3].lower()
+            if not 1 <= streams <= self.max_streams:
+                return f"ERROR: streams must be between 1 and {self.max_streams}."
+        if not self.threads.exists(threadtitle):
+            return "ERROR: Message number does not exist."
+
+        if self.blobs.lookup(threadtitle, filename) is not None:
+            return "ERROR: The filename has been uploaded to the thread."
+
+        # 服务器已经有同样的内容：直接加一个引用，不需要传输文件
+        if sha256 is not None and self.blobs.attach_existing(threadtitle, filename, sha256):
+            self.record_transfer(threadtitle, username, filename, "uploaded")
+            log.info("Server", f"{username} uploaded {filename} to {threadtitle} (already stored, no transfer).",
+                     event="forum", user=username, thread=threadtitle)
+            return "UPD_DEDUP"
+
+        # 记录文件信息
+        token = self.register_transfer({
+            "mode": "upload",
+            "threadtitle": threadtitle,
+            "filename": filename,
+            "username": username,
+            "size": size,
+            "sha256": sha256,
+            "streams": streams
+        }, addr[0] if sha256 is None else None)
+
+        log.info("Server", f"{username} preparing to upload a file to {threadtitle}: {filename}",
+                 event="forum", user=username, thread=threadtitle)
+
+        if token is None:
+            return "UPD_OK"
+
+        # 告诉客户端服务器已经有的连续字节数和还缺少的区间，只需要发送缺少的部分
+        with self.transfer_lock:
+            received = load_ranges(self.partial_path(threadtitle, filename, sha256))
+        have = received[0][1] if received and received[0][0] == 0 else 0
+        missing = " ".join(f"{s}-{e}" for s, e in missing_ranges(received, size))
+        return f"UPD_OK {token} {have} {missing}".rstrip()
+
+    # DWN下载文件
+    # 可续传的下载：DWN <threadtitle> <filename> resume [streams]，回复文件大小和SHA-256
+    def dwn_process(self, args, username, addr):
+        resume = len(args) in (3, 4) and args[2] == "resume"
+        if len(args) != 2 and not resume:
+            return "ERROR: correct usage: DWN <threadtitle> <filename>"
+        streams = 1
+        if len(args) == 4:
+            streams = to_int(args[3])
+            if streams is None or not 1 <= streams <= self.max_streams:
+                return f"ERROR: streams must be between 1 and {self.max_streams}."
+
+        threadtitle = args[0]
+        filename = args[1]
+        if not self.threads.exists(threadtitle):
+            return "ERROR: Message number does not exist."
+
+        digest = self.blobs.lookup(threadtitle, filename)
+        if digest is None:
+            return "ERROR: The file does not exist in the thread."
+
+        # 记录文件信息
+        token = self.register_transfer({
+            "mode": "download",
+            "threadtitle": threadtitle,
+            "filename": filename,
+            "username": username,
+            "sha256": digest,
+            "streams": streams
+        }, None if resume else addr[0])
+
+        log.info("Server", f"{username}  preparing to download file to {threadtitle}: {filename}",
+                 event="forum", user=username, thread=threadtitle)
+        if token is None:
+            return "DWN_OK"
+        size = os.path.getsize(self.blobs.path(digest))
+        return f"DWN_OK {token} {size} {digest}"
+
+    # RMV删除线程
+    def rmv_process(self, args, username, addr):
+        if len(args) != 1:
+            return "ERROR: correct usage: RMV <threadtitle>"
+
+        threadtitle = args[0]
+        creator = self.threads.creator(threadtitle)
+        if creator is None:
+            return "ERROR: Message number does not exist."
+
+        if creator != username:
+            return "ERROR: Only the thread creator can delete the thread."
+
+        self.threads.remove(threadtitle)
+        self.catalog.remove(threadtitle)
+        self.rdt_cache.remove(threadtitle)
+        self.blobs.remove_thread(threadtitle)
+        shutil.rmtree(os.path.join(STATE_DIR, "partial", threadtitle), ignore_errors=True)
+
+        log.info("Server", f"Thread {threadtitle} has been deleted by {username}.",
+                 event="forum", user=username, thread=threadtitle)
+        return f"Thread {threadtitle} has been deleted"
 
 # 处理各个client的UDP消息
 class ProcessClient(threading.Thread):
@@ -403,8 +771,12 @@ class ProcessClient(threading.Thread):
         self.server = server
         self.addr = addr
         self.active = True
+        self.last_active = 0           # 最后活动时间，由会话表维护
         self.messages = Queue()        # 存放udp_msg_process分配的消息
         self.current_user = None       # 记录现在的用户名
+        self.caps = set()              # 登录时协商好的编码（压缩）
+        self.reply_id = 0              # 分片回复的编号
+        self.replies = RecentReplies() # 最近的回复，用于应答重传的请求
 
     # 运行线程
     def run(self):
@@ -414,118 +786,89 @@ class ProcessClient(threading.Thread):
             while self.active:                  # 一直处理命令
                 # 阻塞等待消息
                 data = self.messages.get()
+                if not self.active:
+                    break
                 if not data:
                     continue
 
-                msg_str = data.decode("utf-8", errors="ignore").strip()
-                if not msg_str:
+                # 文本请求或者二进制请求，都解析成 (命令, 参数)
+                request = decode_request(data)
+                if request is None:
+                    continue
+                req_id, binary, command, args = request
+
+                # 重传的请求：直接返回上次的回复
+                cached = self.replies.get(req_id)
+                if cached is not None:
+                    self.send(cached[1], reply_id=cached[0])
                     continue
 
                 # 处理命令，返回结果
-                response = self.server.command_process(msg_str, self.current_user, self.addr)
-                # 用UDP发回给客户端
-                self.server.udp_sock.sendto(response.encode("utf-8"), self.addr)
+                response = self.server.execute(command, args, self.current_user, self.addr)
 
-                # 若client发XIT，结束循环
-                if msg_str.startswith("XIT"):
+                # 若client发XIT，先移除会话再回复（之后重传的XIT由新会话应答），结束循环
+                if command == "XIT":
+                    self.server.remov_thread(self.addr, self)
+                    self.send(response, req_id, binary)
                     break
 
+                self.send(response, req_id, binary)
+
         except Exception as e:
-            print(f"[Server] {self.addr} an error occurred: {e}")
+            log.error("Server", f"{self.addr} an error occurred: {e}", event="error")
 
         finally:
             if self.current_user in self.server.active_users:
                 self.server.active_users.remove(self.current_user)
 
-            self.server.remov_thread(self.addr)
+            self.server.remov_thread(self.addr, self)
             self.active = False
-            print(f"[Server] Client thread {self.addr} has finished.")
+            log.info("Server", f"Client thread {self.addr} has finished.", event="session")
+
+    # 用UDP发回给客户端，二进制请求的回复也是二进制；协商了压缩时压缩较大的回复，超过一个数据报的回复分片发送
+    # 重传的请求直接发送缓存的回复数据，分片编号不变；分片每FRAG_BURST个暂停一下，不一次全部发出
+    def send(self, reply, req_id=None, binary=False, reply_id=None):
+        if isinstance(reply, str):
+            reply = format_reply(req_id, reply, binary)
+        if reply_id is None:
+            self.reply_id += 1
+            reply_id = self.reply_id
+            self.replies.put(req_id, reply, reply_id)
+        for seq, datagram in enumerate(fragment(encode_reply(reply, self.caps), reply_id)):
+            if seq and seq % FRAG_BURST == 0:
+                time.sleep(FRAG_GAP)
+            self.server.udp_sock.sendto(datagram, self.addr)
+
+    # 会话空闲超时：唤醒阻塞的线程让它退出
+    def evict(self):
+        self.active = False
+        self.messages.put(None)
 
     # 身份验证
     def identity_confirm(self):
+        pending = None
         while True:
-            # 读取用户名
             data = self.messages.get()
+            if not self.active:
+                return
             if not data:
                 continue
 
-            msg = data.decode("utf-8", errors="ignore").strip()
-            p = msg.split()
-            if len(p) < 2:
-                continue
-
-            command, username = p[0], p[1]
-            if command != "LOGIN":
+            request = decode_request(data)
+            if request is None:
                 continue
-
-            # 如果该用户名已经被其他client使用
-            if username in self.server.active_users:
-                send_msg = "USER_IN_USE"
-                self.server.udp_sock.sendto(send_msg.encode("utf-8"), self.addr)
+            req_id, binary, command, args = request
+            cached = self.replies.get(req_id)
+            if cached is not None:
+                self.send(cached[1], reply_id=cached[0])
                 continue
 
-            # 判断用户名是否存在
-            if username in self.server.credentials:
-                # 用户已存在，输入密码
-                send_msg = "EXISTING_USER"
-                self.server.udp_sock.sendto(send_msg.encode("utf-8"), self.addr)
-
-                # 读取密码
-                data2 = self.messages.get()
-                if not data2:
-                    continue
-
-                pwd_msg = data2.decode("utf-8", errors="ignore").strip().split()
-                if len(pwd_msg) < 2:
-                    continue
-
-                pwd_cmd, password = pwd_msg[0], pwd_msg[1]
-                if pwd_cmd != "PWD":
-                    continue
-
-                # 验证密码
-                if self.server.credentials[username] == password:
-                    self.server.active_users.add(username)
-                    self.current_user = username
-                    send_msg = "LOGIN_SUCCESS"
-                    self.server.udp_sock.sendto(send_msg.encode("utf-8"), self.addr)
-
-                    print(f"[Server] User {username} logged in successfully.")
-                    return
-                
-                else:
-                    send_msg = "WRONG_PASSWORD"
-                    self.server.udp_sock.sendto(send_msg.encode("utf-8"), self.addr)
-                    continue
-
-            else:
-                # 新用户
-                send_msg = "NEW_USER"
-                self.server.udp_sock.sendto(send_msg.encode("utf-8"), self.addr)
-
-                # 读取密码
-                data2 = self.messages.get()
-                if not data2:
-                    continue
-
-                pwd_msg = data2.decode("utf-8", errors="ignore").strip().split()
-                if len(pwd_msg) < 2:
-                    continue
-
-                pwd_cmd, newpwd = pwd_msg[0], pwd_msg[1]
-                if pwd_cmd != "PWD":
-                    continue
-
-                # 写入credentials文件
-                self.server.credentials[username] = newpwd
-                save_credentials(self.server.credentials)
-
-                self.server.active_users.add(username)
+            reply, pending, username = self.server.identity_step(pending, command, args)
+            if reply is not None:
+                self.send(reply, req_id, binary)
+            if username is not None:
                 self.current_user = username
-                send_msg = "LOGIN_SUCCESS"
-                self.server.udp_sock.sendto(send_msg.encode("utf-8"), self.addr)
-
-                print(f"[Server] New user {username} has been created and logged in successfully.")
+                self.caps = self.server.negotiated.pop(username, set())
                 return
 
 # 文件传输
@@ -535,78 +878,214 @@ class FileTransfer(threading.Thread):
         self.server = server
         self.link = link
         self.addr = addr
+        self.current = None             # 当前的传输 (文件信息, 是否是最后一条连接)
 
+    # 一条TCP连接可以依次完成多个传输：每个传输先发送 "TRANSFER <令牌>"，再发送PUT/GET请求
+    # 旧客户端不出示令牌，连接建立后直接传输文件内容，按客户端IP查找
     def run(self):
-        print(f"[FileTransfer] Start processing file transfers from {self.addr}...")
+        log.info("FileTransfer", f"Start processing file transfers from {self.addr}...", event="transfer")
 
         try:
-            # 根据pending_transfers查询模式
-            client_ip = self.addr[0]
-            transfer_info = self.server.pending_transfers.get(client_ip)
-            if not transfer_info:
-                print("[FileTransfer] ERROR: No pending transfer information.")
-                self.link.close()
+            # 空闲的持久连接在会话空闲超时后关闭
+            self.link.settimeout(self.server.client_threads.idle_timeout)
+            if not self.presents_token():
+                self.legacy_transfer()
                 return
 
-            mode = transfer_info["mode"]
-            threadtitle = transfer_info["threadtitle"]
-            filename = transfer_info["filename"]
-            username = transfer_info["username"]
-
-            if mode == "upload":
-                # 将数据写入到threadtitle-filename
-                server_side_file = f"{threadtitle}-{filename}"
-                with open(server_side_file, "wb") as f:
-                    while True:
-                        chunk = self.link.recv(4096)
-                        if not chunk:
-                            break
-                        f.write(chunk)
-
-                # 上传成功后写入文件
-                with open(threadtitle, "a", encoding="utf-8") as f:
-                    f.write(f"{username} uploaded {filename}\n")
-                    
-                print(f"[FileTransfer] {username} has uploaded {server_side_file} successfully.")
-
-
-            elif mode == "download":
-                # 把threadtitle-filename文件发送给client
-                server_side_file = f"{threadtitle}-{filename}"
-                if not os.path.exists(server_side_file):
-                    print(f"[FileTransfer] ERROR: file {server_side_file} not found.")
-                    self.link.close()
-                    return
-                
-                with open(server_side_file, "rb") as f:
-                    while True:
-                        chunk = f.read(4096)
-                        if not chunk:
-                            break
-                        self.link.sendall(chunk)
-
-                with open(threadtitle, "a", encoding="utf-8") as f:
-                    f.write(f"{username} downloaded {filename}\n")
-
-                print(f"[FileTransfer] {username} has downloaded {server_side_file} successfully.")
+            while True:
+                line = recv_line(self.link)
+                if line is None:
+                    break
+                p = line.split()
+                if line == "DONE":              # 客户端在这条连接上的这个传输已经完成
+                    self.finish_current()
+                    continue
+                if len(p) == 2 and p[0] == "TRANSFER":
+                    self.finish_current()
+                    self.current = self.server.claim_transfer(p[1])
+                    if self.current[0] is None:
+                        log.warning("FileTransfer", f"invalid or expired transfer token from {self.addr}.",
+                                    event="transfer")
+                        send_line(self.link, "ERROR BAD_TOKEN")
+                    else:
+                        send_line(self.link, "READY")
+                    continue
+
+                transfer_info = self.current[0] if self.current else None
+                if transfer_info is None:
+                    send_line(self.link, "ERROR BAD_TOKEN")
+                    break
+                if transfer_info["mode"] == "upload":
+                    if not self.upload_range(transfer_info, line):
+                        break
+                elif not self.download_range(transfer_info, line):
+                    break
+
+            self.finish_current()
 
         except Exception as e:
-            print(f"[FileTransfer] Error: {e}")
+            log.error("FileTransfer", f"Transfer error: {e}", event="error")
 
         finally:
-            # 清除pending_transfers的对应信息
-            if client_ip in self.server.pending_transfers:
-                del self.server.pending_transfers[client_ip]
             self.link.close()
-            print(f"[FileTransfer] Finish file transfer with {self.addr}.")
-
+            log.info("FileTransfer", f"Finish file transfer with {self.addr}.", event="transfer")
+
+    # 有旧格式的传输在等待这个IP时，看连接上的前几个字节是不是 "TRANSFER "，
+    # 旧客户端下载时不发送任何数据，等待超时也按旧格式处理
+    def presents_token(self):
+        if self.addr[0] not in self.server.legacy_transfers:
+            return True
+        self.link.settimeout(LEGACY_WAIT)
+        try:
+            head = self.link.recv(len(TOKEN_PREFIX), socket.MSG_PEEK | socket.MSG_WAITALL)
+        except socket.timeout:
+            return False
+        finally:
+            self.link.settimeout(self.server.client_threads.idle_timeout)
+        return head == TOKEN_PREFIX
+
+    # 一个传输在这条连接上结束：并行下载由最后一条连接在主题中记录一次下载
+    def finish_current(self):
+        if self.current is None:
+            return
+        transfer_info, last = self.current
+        self.current = None
+        if transfer_info is not None and transfer_info["mode"] == "download" and last:
+            self.server.record_transfer(transfer_info["threadtitle"], transfer_info["username"],
+                                        transfer_info["filename"], "downloaded")
+            log.info("FileTransfer", f"{transfer_info['username']} has downloaded "
+                                     f"{transfer_info['threadtitle']}-{transfer_info['filename']}.", event="transfer")
+
+    # 旧格式：连接上直接是整个文件的内容
+    def legacy_transfer(self):
+        transfer_info, _ = self.server.claim_legacy_transfer(self.addr[0])
+        if not transfer_info:
+            log.warning("FileTransfer", "No pending transfer information.", event="transfer")
+            return
+
+        threadtitle = transfer_info["threadtitle"]
+        filename = transfer_info["filename"]
+        username = transfer_info["username"]
+
+        started = time.perf_counter()
+        if transfer_info["mode"] == "upload":
+            partial = self.server.legacy_partial_path(threadtitle, filename)
+            with open(partial, "wb", buffering=0) as f:
+                received = recv_file(self.link, f, self.server.chunk_size)
+            self.server.metrics.transfer("upload", received, time.perf_counter() - started)
+
+            # 上传成功后存入BlobStore并写入主题
+            if not self.server.commit_legacy_upload(transfer_info, partial):
+                log.warning("FileTransfer", f"{username} uploaded {threadtitle}-{filename}, but the filename "
+                                            f"has already been uploaded to the thread.", event="transfer")
+                return
+            log.info("FileTransfer", f"{username} has uploaded {threadtitle}-{filename} successfully.",
+                     event="transfer")
+
+        else:
+            # 零拷贝发送
+            with open(self.server.blobs.path(transfer_info["sha256"]), "rb") as f:
+                sent = send_file(self.link, f)
+            self.server.metrics.transfer("download", sent, time.perf_counter() - started)
+
+            self.server.record_transfer(threadtitle, username, filename, "downloaded")
+            log.info("FileTransfer", f"{username} has downloaded {threadtitle}-{filename} successfully.",
+                     event="transfer")
+
+    # "PUT <start> [end]" 后逐帧接收，用pwrite写到未完成文件的对应位置，返回False时关闭连接
+    def upload_range(self, transfer_info, line):
+        request = self.server.upload_request(transfer_info, line)
+        if request is None:
+            send_line(self.link, "ERROR BAD_REQUEST 0")
+            return False
+
+        partial, start, end, hasher = request
+        started = time.perf_counter()
+        fd = os.open(partial, os.O_WRONLY | os.O_CREAT, 0o644)
+        try:
+            received, status = recv_frames(self.link, fd, start, self.server.chunk_size, end - start, hasher)
+        finally:
+            os.close(fd)
+        result, keep = self.server.upload_result(transfer_info, partial, start, received, status, hasher,
+                                                 time.perf_counter() - started, "FileTransfer")
+        send_line(self.link, result)
+        return keep
+
+    # "GET <start> [end]" 用sendfile发送对应的区间
+    def download_range(self, transfer_info, line):
+        request = self.server.download_request(transfer_info, line)
+        if request is None:
+            log.warning("FileTransfer", f"bad download request {line!r}.", event="transfer")
+            return False
+
+        server_side_file, start, end, compressed = request
+        started = time.perf_counter()
+        with open(server_side_file, "rb") as f:
+            if compressed:
+                send_frames(self.link, f, start, self.server.chunk_size, end - start, compress=True)
+            elif end > start:
+                send_file(self.link, f, start, end - start)
+        self.server.metrics.transfer("download", end - start, time.perf_counter() - started)
+        return True
 
 if __name__ == "__main__":
-
-    if len(sys.argv) != 2:
-        print("correct usage: python server.py <server_port>")
-        sys.exit(1)
-
-    port = int(sys.argv[1])
-    server = ForumServer(port)
+    parser = argparse.ArgumentParser(usage="python server.py <server_port> [options]")
+    parser.add_argument("server_port", type=int)
+    parser.add_argument("--cache-bytes", type=int, default=DEFAULT_BUDGET,
+                        help="byte budget of the RDT response cache, 0 disables it")
+    parser.add_argument("--engine", choices=["threads", "asyncio"], default="threads",
+                        help="threads: one thread per client and per transfer; asyncio: one event loop")
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS,
+                        help="storage worker threads used by the asyncio engine")
+    parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE,
+                        help="receive buffer size in bytes for file uploads")
+    parser.add_argument("--idle-timeout", type=float, default=DEFAULT_IDLE_TIMEOUT,
+                        help="seconds of inactivity before a client session is evicted")
+    parser.add_argument("--max-sessions", type=int, default=DEFAULT_MAX_SESSIONS,
+                        help="maximum number of concurrent client sessions")
+    parser.add_argument("--max-streams", type=int, default=DEFAULT_MAX_STREAMS,
+                        help="maximum number of parallel TCP connections per file transfer")
+    parser.add_argument("--transfer-ttl", type=float, default=DEFAULT_TRANSFER_TTL,
+                        help="seconds a UPD/DWN transfer token stays valid")
+    parser.add_argument("--shards", type=int, default=DEFAULT_SHARDS,
+                        help="worker threads executing forum commands, partitioned by thread title")
+    parser.add_argument("--fsync", default=DEFAULT_FSYNC,
+                        help="write-ahead log fsync policy: always (before each reply), never, "
+                             "or a number of milliseconds between background fsyncs")
+    parser.add_argument("--checkpoint-interval", type=float, default=CHECKPOINT_INTERVAL,
+                        help="seconds between checkpoints that fsync thread files and drop old write-ahead log segments")
+    parser.add_argument("--storage", choices=BACKENDS, default=DEFAULT_BACKEND,
+                        help="files: thread files in the working directory; sqlite: indexed SQLite database "
+                             "(import existing threads with 'python storage.py migrate')")
+    parser.add_argument("--db", help="SQLite database path for --storage sqlite (default .forum/forum.db)")
+    parser.add_argument("--log-level", choices=list(LEVELS), default=DEFAULT_LEVEL,
+                        help="lowest level written to the log")
+    parser.add_argument("--log-sample", default="",
+                        help="per-event sampling rates, e.g. command=0.01,response=0 "
+                             "(events: command, response, forum, session, transfer)")
+    parser.add_argument("--log-body", type=int, default=DEFAULT_BODY_LIMIT,
+                        help="characters of each reply body to log: 0 omits bodies, -1 logs them in full")
+    parser.add_argument("--log-file", help="also write JSON-lines records to this file, rotated by size")
+    parser.add_argument("--log-max-bytes", type=int, default=DEFAULT_MAX_BYTES,
+                        help="rotate the --log-file when it grows past this many bytes")
+    parser.add_argument("--log-backups", type=int, default=DEFAULT_BACKUPS,
+                        help="number of rotated --log-file copies to keep")
+    parser.add_argument("--admin", action="append", default=[], metavar="USERNAME",
+                        help="user allowed to run STATS (repeat for several users)")
+    parser.add_argument("--metrics-interval", type=float, default=SNAPSHOT_INTERVAL,
+                        help="seconds between metrics snapshots written to .forum/metrics.json, 0 disables them")
+    args = parser.parse_args()
+    try:
+        parse_fsync_policy(args.fsync)
+        sampling = parse_sampling(args.log_sample)
+    except ValueError as e:
+        parser.error(str(e))
+
+    log.configure(args.log_level, sampling, args.log_body, args.log_file, args.log_max_bytes, args.log_backups)
+
+    server = ForumServer(args.server_port, cache_bytes=args.cache_bytes, engine=args.engine, workers=args.workers,
+                         idle_timeout=args.idle_timeout, max_sessions=args.max_sessions, chunk_size=args.chunk_size,
+                         max_streams=args.max_streams, transfer_ttl=args.transfer_ttl, shards=args.shards,
+                         fsync=args.fsync, checkpoint_interval=args.checkpoint_interval, storage=args.storage,
+                         db_path=args.db, admins=args.admin, metrics_interval=args.metrics_interval)
     server.start()
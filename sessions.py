@@ -0,0 +1,112 @@
+import time
+import threading
+from collections import OrderedDict
+from logger import log
+
+DEFAULT_IDLE_TIMEOUT = 1800     # 空闲多久（秒）后回收会话
+DEFAULT_MAX_SESSIONS = 1000     # 同时存在的会话上限
+REPLY_CACHE_BYTES = 256 * 1024  # 每个会话缓存的回复最多占用的字节数（最新的一条总是保留）
+
+
+# 会话表：记录每个客户端地址对应的会话和最后活动时间
+# 会话对象（ProcessClient或asyncio的Session）需要有 last_active 属性和 evict() 方法
+class SessionTable:
+    def __init__(self, idle_timeout=DEFAULT_IDLE_TIMEOUT, max_sessions=DEFAULT_MAX_SESSIONS):
+        self.idle_timeout = idle_timeout
+        self.max_sessions = max_sessions
+        self.sessions = {}              # {addr: session}
+        self.evicted = 0
+        self.rejected = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def __contains__(self, addr):
+        return addr in self.sessions
+
+    def get(self, addr):
+        return self.sessions.get(addr)
+
+    # 登记新会话，超过上限返回False
+    def add(self, addr, session):
+        with self.lock:
+            if len(self.sessions) >= self.max_sessions:
+                self.rejected += 1
+                return False
+            session.last_active = time.monotonic()
+            self.sessions[addr] = session
+            return True
+
+    # 收到客户端消息时刷新活动时间
+    def touch(self, addr):
+        session = self.sessions.get(addr)
+        if session is not None:
+            session.last_active = time.monotonic()
+        return session
+
+    # 移除会话（只移除同一个会话对象，避免误删同一地址上的新会话）
+    def remove(self, addr, session=None):
+        with self.lock:
+            if addr in self.sessions and (session is None or self.sessions[addr] is session):
+                del self.sessions[addr]
+
+    # 回收所有空闲超时的会话
+    def reap(self):
+        now = time.monotonic()
+        with self.lock:
+            idle = [(addr, s) for addr, s in self.sessions.items() if now - s.last_active > self.idle_timeout]
+            for addr, _ in idle:
+                del self.sessions[addr]
+
+        for addr, session in idle:
+            self.evicted += 1
+            log.info("Sessions", f"Session {addr} ({getattr(session, 'current_user', None)}) idle for "
+                                 f"{now - session.last_active:.0f}s, evicting...")
+            session.evict()
+        return len(idle)
+
+    # 启动后台回收线程
+    def start_reaper(self, interval=None):
+        if interval is None:
+            interval = max(1, min(self.idle_timeout / 4, 30))
+
+        def loop():
+            while True:
+                threading.Event().wait(interval)
+                self.reap()
+
+        threading.Thread(target=loop, daemon=True).start()
+
+
+# 每个会话最近的回复，按请求编号保存；重传的请求直接返回缓存的回复，不再执行命令
+# 最多保存size条、max_bytes字节，超出时丢掉最早的回复；最新的回复即使很大（整页的RDT）也保留，
+# 重传最近一条请求时总能应答
+class RecentReplies:
+    def __init__(self, size=64, max_bytes=REPLY_CACHE_BYTES):
+        self.size = size
+        self.max_bytes = max_bytes
+        self.replies = OrderedDict()    # {req_id: (分片编号reply_id, 带编号前缀的回复)}
+        self.bytes = 0
+        self.duplicates = 0
+
+    # 返回 (reply_id, 回复)，没有缓存返回None
+    def get(self, req_id):
+        if req_id is None:
+            return None
+        cached = self.replies.get(req_id)
+        if cached is not None:
+            self.duplicates += 1
+        return cached
+
+    def put(self, req_id, reply, reply_id):
+        if req_id is None:
+            return
+        old = self.replies.pop(req_id, None)
+        if old is not None:
+            self.bytes -= len(old[1])
+        self.replies[req_id] = (reply_id, reply)
+        self.bytes += len(reply)
+        while len(self.replies) > 1 and (len(self.replies) > self.size or self.bytes > self.max_bytes):
+            _, (_, evicted) = self.replies.popitem(last=False)
+            self.bytes -= len(evicted)
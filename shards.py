@@ -0,0 +1,77 @@
+import time
+import zlib
+import threading
+from queue import Queue
+from concurrent.futures import Future
+from logger import log
+
+DEFAULT_SHARDS = 8              # 执行命令的分片线程数
+
+
+# 按主题分片执行命令：同一个主题的命令总是交给同一个分片线程，按到达顺序依次执行；
+# 不同主题的命令在不同的分片上并行执行
+class ShardedExecutor:
+    def __init__(self, shards=DEFAULT_SHARDS):
+        self.queues = [Queue() for _ in range(max(1, shards))]
+        self.executed = [0] * len(self.queues)      # 每个分片执行过的命令数
+        self.busy = [0.0] * len(self.queues)        # 每个分片执行命令花费的时间（秒）
+        self.peak = [0] * len(self.queues)          # 每个分片队列出现过的最大长度
+
+    def __len__(self):
+        return len(self.queues)
+
+    # 主题对应的分片（crc32，不受PYTHONHASHSEED影响）
+    def shard_of(self, key):
+        return zlib.crc32(key.encode("utf-8")) % len(self.queues)
+
+    def start(self):
+        for i in range(len(self.queues)):
+            threading.Thread(target=self._worker, args=(i,), name=f"shard-{i}", daemon=True).start()
+
+    def _worker(self, i):
+        queue = self.queues[i]
+        while True:
+            future, func, args = queue.get()
+            if not future.set_running_or_notify_cancel():
+                continue
+            started = time.perf_counter()
+            try:
+                future.set_result(func(*args))
+            except Exception as e:
+                future.set_exception(e)
+            self.busy[i] += time.perf_counter() - started
+            self.executed[i] += 1
+
+    # 把func(*args)交给key对应的分片，返回Future
+    def submit(self, key, func, *args):
+        i = self.shard_of(key)
+        future = Future()
+        self.queues[i].put((future, func, args))
+        self.peak[i] = max(self.peak[i], self.queues[i].qsize())
+        return future
+
+    # 在key对应的分片上执行并等待结果
+    def run(self, key, func, *args):
+        return self.submit(key, func, *args).result()
+
+    # 每个分片的队列长度、最大队列长度、执行的命令数和忙碌时间
+    def stats(self):
+        return [{"shard": i, "depth": q.qsize(), "peak": self.peak[i], "executed": self.executed[i],
+                 "busy": self.busy[i]} for i, q in enumerate(self.queues)]
+
+    # 后台定期打印每个分片的队列长度，方便发现热点主题
+    def start_reporter(self, interval=60):
+        def loop():
+            last = None
+            while True:
+                threading.Event().wait(interval)
+                stats = self.stats()
+                executed = [s["executed"] for s in stats]
+                if executed != last:
+                    last = executed
+                    log.info("Shards", " ".join(f"#{s['shard']}:depth={s['depth']},peak={s['peak']},"
+                                                f"executed={s['executed']},busy={s['busy']:.2f}s" for s in stats))
+                    for s in stats:
+                        self.peak[s["shard"]] = s["depth"]
+
+        threading.Thread(target=loop, daemon=True).start()
@@ -0,0 +1,409 @@
+import os
+import time
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+from wal import parse_fsync_policy, DEFAULT_FSYNC
+from catalog import SORT_KEYS
+from thread_store import MessageIndex
+from logger import log
+
+DB_FILE = "forum.db"
+
+# 主题、消息和主题目录都放在一个SQLite数据库里（WAL模式），接口与ThreadStore/ThreadCatalog相同
+#   threads(title, creator, created, modified, messages, lines)   主题目录，LST直接查询
+#   entries(title, seq, kind, user, text)                         每个主题的消息/上传下载记录，按seq排序
+#   counts(title, tree, pos, weight)                              每个主题按seq的两棵树状数组（同MessageIndex）
+# 删除消息只把kind改成deleted，seq保持连续；消息编号在读取时计算：
+# tree 0 存活的消息、tree 1 存活的消息和上传/下载记录，按编号找消息、找分页的起点、追加、删除都只读写 O(log n) 行
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS threads (
+    title TEXT PRIMARY KEY,
+    creator TEXT NOT NULL,
+    created REAL NOT NULL,
+    modified REAL NOT NULL,
+    messages INTEGER NOT NULL DEFAULT 0,
+    lines INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS threads_creator ON threads (creator);
+CREATE INDEX IF NOT EXISTS threads_modified ON threads (modified);
+CREATE TABLE IF NOT EXISTS entries (
+    title TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    kind TEXT NOT NULL,
+    user TEXT,
+    text TEXT NOT NULL,
+    PRIMARY KEY (title, seq)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS counts (
+    title TEXT NOT NULL,
+    tree INTEGER NOT NULL,
+    pos INTEGER NOT NULL,
+    weight INTEGER NOT NULL,
+    PRIMARY KEY (title, tree, pos)
+) WITHOUT ROWID;
+"""
+SCHEMA_VERSION = 1
+MSG_TREE = 0
+LINE_TREE = 1
+
+# fsync策略对应的synchronous设置：always每次提交都写到磁盘；
+# 按间隔fsync时用NORMAL（WAL模式下只在SQLite做检查点时写盘，崩溃不会损坏数据库）
+SYNCHRONOUS = {"always": "FULL", "interval": "NORMAL", "never": "OFF"}
+
+# LST排序方式对应的ORDER BY
+ORDER_BY = {
+    "title": "title",
+    "recent": "modified DESC",
+    "messages": "messages DESC",
+    "created": "created",
+}
+
+
+def render_entry(num, kind, user, text):
+    return f"{num} {user}: {text}\n" if kind == "msg" else text + "\n"
+
+
+# SQLite主题存储：每个线程一个连接，写操作用 BEGIN IMMEDIATE 串行，读操作并行
+class SqliteThreadStore:
+    def __init__(self, path, fsync=DEFAULT_FSYNC):
+        self.path = path
+        self.synchronous = SYNCHRONOUS[parse_fsync_policy(fsync)[0]]
+        self.local = threading.local()  # 每个线程自己的连接和批量事务状态
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        conn = self._conn()
+        conn.executescript(SCHEMA)
+        self._upgrade(conn)
+
+    # 旧版本的数据库没有counts表的内容：按现有的记录建立（旧版本直接删除记录，空出来的seq权重为0）
+    def _upgrade(self, conn):
+        if conn.execute("PRAGMA user_version").fetchone()[0] >= SCHEMA_VERSION:
+            return
+        conn.execute("BEGIN IMMEDIATE")
+        conn.execute("DROP INDEX IF EXISTS entries_kind")
+        titles = [row[0] for row in conn.execute("SELECT title FROM threads")]
+        for title in titles:
+            kinds = dict(conn.execute("SELECT seq, kind FROM entries WHERE title = ?", (title,)))
+            self._insert_trees(conn, title, [kinds.get(seq) for seq in range(max(kinds, default=-1) + 1)])
+        conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+        conn.execute("COMMIT")
+        if titles:
+            log.info("SqliteStore", f"Built message indexes for {len(titles)} thread(s).")
+
+    # 按记录类型建立一个主题的两棵树
+    def _insert_trees(self, conn, title, kinds):
+        for tree, weights in ((MSG_TREE, [1 if k == "msg" else 0 for k in kinds]),
+                              (LINE_TREE, [1 if k in ("msg", "event") else 0 for k in kinds])):
+            conn.executemany("INSERT INTO counts (title, tree, pos, weight) VALUES (?, ?, ?, ?)",
+                             [(title, tree, pos, w) for pos, w in enumerate(MessageIndex(weights).tree) if pos])
+
+    # 主题的记录数（包括删除的），即树的大小
+    def _size(self, conn, title):
+        return conn.execute("SELECT COALESCE(MAX(seq), -1) + 1 FROM entries WHERE title = ?", (title,)).fetchone()[0]
+
+    def _tree_sum(self, conn, title, tree, positions):
+        if not positions:
+            return 0
+        marks = ", ".join("?" * len(positions))
+        return conn.execute(f"SELECT COALESCE(SUM(weight), 0) FROM counts WHERE title = ? AND tree = ? "
+                            f"AND pos IN ({marks})", (title, tree, *positions)).fetchone()[0]
+
+    # 前i条记录（seq 0..i-1）的权重和
+    def _tree_prefix(self, conn, title, tree, i):
+        positions = []
+        while i > 0:
+            positions.append(i)
+            i -= i & -i
+        return self._tree_sum(conn, title, tree, positions)
+
+    # 在末尾（第n条记录之后）追加权重w
+    def _tree_append(self, conn, title, tree, n, w):
+        pos = n + 1
+        stop = pos - (pos & -pos)
+        positions = []
+        j = pos - 1
+        while j > stop:
+            positions.append(j)
+            j -= j & -j
+        conn.execute("INSERT INTO counts (title, tree, pos, weight) VALUES (?, ?, ?, ?)",
+                     (title, tree, pos, w + self._tree_sum(conn, title, tree, positions)))
+
+    # 修改seq为i的记录的权重，n为树的大小
+    def _tree_add(self, conn, title, tree, i, n, delta):
+        positions = []
+        pos = i + 1
+        while pos <= n:
+            positions.append(pos)
+            pos += pos & -pos
+        marks = ", ".join("?" * len(positions))
+        conn.execute(f"UPDATE counts SET weight = weight + ? WHERE title = ? AND tree = ? AND pos IN ({marks})",
+                     (delta, title, tree, *positions))
+
+    # 第k条（从1开始）权重为1的记录的seq，调用者保证 1 <= k <= 总权重
+    def _tree_find(self, conn, title, tree, k, n):
+        pos = 0
+        bit = 1 << (n.bit_length() - 1)
+        while bit:
+            nxt = pos + bit
+            if nxt <= n:
+                w = conn.execute("SELECT weight FROM counts WHERE title = ? AND tree = ? AND pos = ?",
+                                 (title, tree, nxt)).fetchone()[0]
+                if w < k:
+                    pos = nxt
+                    k -= w
+            bit >>= 1
+        return pos
+
+    def _conn(self):
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(f"PRAGMA synchronous={self.synchronous}")
+            self.local.conn = conn
+            self.local.batch = False
+        return conn
+
+    # 写事务；在deferred_flush()中时合并到批量事务里
+    @contextmanager
+    def _write(self):
+        conn = self._conn()
+        if self.local.batch:
+            yield conn
+            return
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    # 批量命令放在一个事务里，只提交（写盘）一次
+    @contextmanager
+    def deferred_flush(self):
+        conn = self._conn()
+        if self.local.batch:
+            yield
+            return
+
+        conn.execute("BEGIN IMMEDIATE")
+        self.local.batch = True
+        try:
+            yield
+        finally:
+            self.local.batch = False
+            conn.execute("COMMIT")
+
+    # SQLite自己保证崩溃恢复，没有需要重放的主题
+    def recover(self):
+        return set()
+
+    # 检查点：把SQLite的WAL合并回数据库文件
+    def checkpoint(self):
+        self._conn().execute("PRAGMA wal_checkpoint(PASSIVE)")
+        return 0
+
+    def start_checkpointer(self, interval):
+        def loop():
+            while True:
+                threading.Event().wait(interval)
+                try:
+                    self.checkpoint()
+                except sqlite3.Error as e:
+                    log.error("SqliteStore", f"Checkpoint failed: {e}")
+
+        threading.Thread(target=loop, daemon=True).start()
+
+    def _thread(self, conn, title):
+        return conn.execute("SELECT creator, messages, lines FROM threads WHERE title = ?", (title,)).fetchone()
+
+    def exists(self, title):
+        return self._thread(self._conn(), title) is not None
+
+    def creator(self, title):
+        row = self._thread(self._conn(), title)
+        return row[0] if row else None
+
+    def count(self, title):
+        row = self._thread(self._conn(), title)
+        return row[1] if row else None
+
+    # 创建主题，已存在返回False
+    def create(self, title, creator, created=None):
+        now = time.time() if created is None else created
+        with self._write() as conn:
+            try:
+                conn.execute("INSERT INTO threads (title, creator, created, modified) VALUES (?, ?, ?, ?)",
+                             (title, creator, now, now))
+            except sqlite3.IntegrityError:
+                return False
+        return True
+
+    def _append(self, conn, title, kind, user, text):
+        seq = self._size(conn, title)
+        conn.execute("INSERT INTO entries (title, seq, kind, user, text) VALUES (?, ?, ?, ?, ?)",
+                     (title, seq, kind, user, text))
+        self._tree_append(conn, title, MSG_TREE, seq, 1 if kind == "msg" else 0)
+        self._tree_append(conn, title, LINE_TREE, seq, 1)
+        conn.execute("UPDATE threads SET messages = messages + ?, lines = lines + 1, modified = ? WHERE title = ?",
+                     (1 if kind == "msg" else 0, time.time(), title))
+
+    # 发消息，返回消息编号
+    def append_message(self, title, username, text):
+        with self._write() as conn:
+            if self._thread(conn, title) is None:
+                return None
+            self._append(conn, title, "msg", username, text)
+            return self._thread(conn, title)[1]
+
+    # 追加上传/下载记录
+    def append_event(self, title, line):
+        with self._write() as conn:
+            if self._thread(conn, title) is None:
+                return False
+            self._append(conn, title, "event", None, line)
+            return True
+
+    # 第msg_num条消息的 (seq, user, text)，不存在返回None
+    def _find(self, conn, title, msg_num):
+        row = self._thread(conn, title)
+        if row is None or not 1 <= msg_num <= row[1]:
+            return None
+        seq = self._tree_find(conn, title, MSG_TREE, msg_num, self._size(conn, title))
+        return conn.execute("SELECT seq, user, text FROM entries WHERE title = ? AND seq = ?", (title, seq)).fetchone()
+
+    # 查找消息，返回 (user, text)，不存在返回None
+    def message(self, title, msg_num):
+        row = self._find(self._conn(), title, msg_num)
+        return (row[1], row[2]) if row else None
+
+    # 删除消息，返回 "OK" / "NOT_FOUND" / "NOT_OWNER"
+    def delete_message(self, title, msg_num, username):
+        with self._write() as conn:
+            row = self._find(conn, title, msg_num)
+            if row is None:
+                return "NOT_FOUND"
+            if row[1] != username:
+                return "NOT_OWNER"
+            conn.execute("UPDATE entries SET kind = 'deleted' WHERE title = ? AND seq = ?", (title, row[0]))
+            n = self._size(conn, title)
+            self._tree_add(conn, title, MSG_TREE, row[0], n, -1)
+            self._tree_add(conn, title, LINE_TREE, row[0], n, -1)
+            conn.execute("UPDATE threads SET messages = messages - 1, lines = lines - 1, modified = ? "
+                         "WHERE title = ?", (time.time(), title))
+            return "OK"
+
+    # 编辑消息，返回 "OK" / "NOT_FOUND" / "NOT_OWNER"
+    def edit_message(self, title, msg_num, username, new_text):
+        with self._write() as conn:
+            row = self._find(conn, title, msg_num)
+            if row is None:
+                return "NOT_FOUND"
+            if row[1] != username:
+                return "NOT_OWNER"
+            conn.execute("UPDATE entries SET text = ? WHERE title = ? AND seq = ?", (new_text, title, row[0]))
+            conn.execute("UPDATE threads SET modified = ? WHERE title = ?", (time.time(), title))
+            return "OK"
+
+    # 读取主题内容（所有行）
+    def read(self, title):
+        page = self.page(title)
+        return page[0] if page else None
+
+    # 分页读取，返回 (lines, 起始行号, 总行数)，主题不存在返回None；offset为负数时从末尾倒数
+    def page(self, title, offset=0, limit=None):
+        conn = self._conn()
+        row = self._thread(conn, title)
+        if row is None:
+            return None
+
+        total = row[2]
+        if offset < 0:
+            offset = max(total + offset, 0)
+        stop = total if limit is None else min(total, offset + max(limit, 0))
+        if offset >= stop:
+            return [], offset, total
+
+        first = self._tree_find(conn, title, LINE_TREE, offset + 1, self._size(conn, title))
+        rows = conn.execute("SELECT kind, user, text FROM entries WHERE title = ? AND seq >= ? AND kind != 'deleted' "
+                            "ORDER BY seq LIMIT ?", (title, first, stop - offset)).fetchall()
+        # 这一页之前的消息数，保证编号与整页读取一致
+        num = self._tree_prefix(conn, title, MSG_TREE, first)
+        lines = []
+        for kind, user, text in rows:
+            if kind == "msg":
+                num += 1
+            lines.append(render_entry(num, kind, user, text))
+        return lines, offset, total
+
+    def remove(self, title):
+        with self._write() as conn:
+            conn.execute("DELETE FROM entries WHERE title = ?", (title,))
+            conn.execute("DELETE FROM counts WHERE title = ?", (title,))
+            conn.execute("DELETE FROM threads WHERE title = ?", (title,))
+
+    # 导入一个主题的全部记录（迁移用），entries为 [(kind, user, text)]
+    def import_thread(self, title, creator, created, modified, entries):
+        with self._write() as conn:
+            conn.execute("INSERT INTO threads (title, creator, created, modified, messages, lines) "
+                         "VALUES (?, ?, ?, ?, ?, ?)",
+                         (title, creator, created, modified, sum(1 for e in entries if e[0] == "msg"), len(entries)))
+            conn.executemany("INSERT INTO entries (title, seq, kind, user, text) VALUES (?, ?, ?, ?, ?)",
+                             [(title, seq, kind, user, text) for seq, (kind, user, text) in enumerate(entries)])
+            self._insert_trees(conn, title, [e[0] for e in entries])
+
+    def close(self):
+        conn = getattr(self.local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self.local.conn = None
+
+
+# 主题目录：直接查询threads表（消息数和修改时间由SqliteThreadStore在同一个事务里维护）
+class SqliteCatalog:
+    def __init__(self, store):
+        self.store = store
+
+    def load(self, usernames):
+        count = self.store._conn().execute("SELECT COUNT(*) FROM threads").fetchone()[0]
+        log.info("Catalog", f"{count} thread(s) in {self.store.path}.")
+
+    def start_flusher(self):
+        pass
+
+    @property
+    def entries(self):
+        return {e["title"]: e for e in self.list()}
+
+    def __contains__(self, title):
+        return self.store.exists(title)
+
+    # 主题的增删和消息数都由SqliteThreadStore维护
+    def add(self, title, creator):
+        pass
+
+    def remove(self, title):
+        pass
+
+    def touch(self, title, messages=None):
+        pass
+
+    # 查询主题列表，可按创建者/标题子串过滤并排序
+    def list(self, sort="title", creator=None, match=None):
+        if sort not in SORT_KEYS:
+            sort = "title"
+        where, params = [], []
+        if creator is not None:
+            where.append("creator = ?")
+            params.append(creator)
+        if match is not None:
+            where.append("instr(title, ?) > 0")
+            params.append(match)
+        sql = "SELECT title, creator, messages, created, modified FROM threads"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += f" ORDER BY {ORDER_BY[sort]}"
+        rows = self.store._conn().execute(sql, params).fetchall()
+        return [{"title": t, "creator": c, "messages": m, "created": cr, "modified": mo} for t, c, m, cr, mo in rows]
@@ -0,0 +1,72 @@
+import os
+import argparse
+
+from thread_store import ThreadStore, STATE_DIR
+from catalog import ThreadCatalog
+from sqlite_store import SqliteThreadStore, SqliteCatalog, DB_FILE
+from wal import DEFAULT_FSYNC
+from credentials import CredentialStore
+
+# 存储后端：论坛命令和FileTransfer只通过这两个对象访问主题数据
+#   主题存储  exists / creator / count / create / append_message / append_event / message / delete_message /
+#            edit_message / page / read / remove / deferred_flush / recover / checkpoint / start_checkpointer / close
+#   主题目录  load / start_flusher / entries / __contains__ / add / remove / touch / list
+# files：主题文件在工作目录中，预写日志和目录在 .forum/ 中（默认）
+# sqlite：所有主题和消息在 .forum/forum.db 中，用 python storage.py migrate 导入已有的主题文件
+# 附件（BlobStore）两种后端都按内容存成文件，下载时可以直接sendfile
+BACKENDS = ("files", "sqlite")
+DEFAULT_BACKEND = "files"
+
+
+def default_db_path(root="."):
+    return os.path.join(root, STATE_DIR, DB_FILE)
+
+
+# 打开存储后端，返回 (主题存储, 主题目录)
+def open_storage(backend=DEFAULT_BACKEND, root=".", fsync=DEFAULT_FSYNC, db_path=None):
+    if backend == "sqlite":
+        store = SqliteThreadStore(db_path or default_db_path(root), fsync)
+        return store, SqliteCatalog(store)
+    catalog = ThreadCatalog(root)
+    return ThreadStore(root, fsync, catalog), catalog
+
+
+# 把工作目录中的主题文件（先重放预写日志）导入SQLite数据库，已经在数据库中的主题跳过
+def migrate(root=".", db_path=None, usernames=()):
+    files, catalog = open_storage("files", root)
+    files.recover()
+    catalog.load(usernames)
+    db = SqliteThreadStore(db_path or default_db_path(root))
+
+    imported = skipped = 0
+    for title, entry in sorted(catalog.entries.items()):
+        state = files.get(title)
+        if state is None:
+            continue
+        if db.exists(title):
+            skipped += 1
+            continue
+        entries = [(kind, user, text) for kind, user, text in state.entries if kind != "deleted"]
+        db.import_thread(title, state.creator, entry["created"], entry["modified"], entries)
+        imported += 1
+        print(f"[Migrate] {title}: {sum(1 for e in entries if e[0] == 'msg')} message(s), {len(entries)} line(s).")
+
+    files.close()
+    db.close()
+    print(f"[Migrate] Imported {imported} thread(s) into {db.path} ({skipped} already there).")
+    return imported
+
+
+def main():
+    parser = argparse.ArgumentParser(usage="python storage.py migrate [--db PATH]")
+    parser.add_argument("command", choices=["migrate"])
+    parser.add_argument("--db", help=f"SQLite database to import into (default {default_db_path()})")
+    args = parser.parse_args()
+
+    credentials = CredentialStore()
+    credentials.load()
+    migrate(db_path=args.db, usernames=credentials.keys())
+
+
+if __name__ == "__main__":
+    main()
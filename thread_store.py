@@ -0,0 +1,641 @@
+import os
+import threading
+from contextlib import contextmanager
+
+from wal import WriteAheadLog, read_records, segment_paths, DEFAULT_FSYNC
+from logger import log
+
+# 主题文件格式（保持不变，RDT直接输出第一行之后的内容）：
+#   第一行          创建者用户名
+#   消息行          "<编号> <用户名>: <消息内容>"
+#   上传/下载记录   "<用户名> uploaded <文件名>"
+#
+# DLT/EDT不再重写主题文件，而是在 .forum/journal/<threadtitle> 中追加记录：
+#   BASE <inode>      日志对应的主题文件（压缩后主题文件被替换，旧日志自动失效）
+#   D <记录下标>      墓碑：删除消息
+#   E <记录下标> <新内容>   覆盖：编辑消息
+# 消息编号在读取时重新计算。
+#
+# 所有修改先追加到预写日志 .forum/wal.log（wal.py），再写主题文件和墓碑/覆盖日志（不fsync）。
+# 记录中的下标是主题文件中的行号（不算第一行），两次检查点之间主题文件只追加、不压缩，所以下标不变：
+#   CRT <creator>  /  ADD <下标> <msg|event> <user> <text>  /  D <下标>  /  E <下标> <text>  /  RMV
+# ADD/D/E还带着写入时主题文件的inode：检查点压缩了主题、但没来得及清空预写日志就崩溃时，
+# 恢复只重放inode与当前主题文件相同的记录，旧下标不会套用到压缩后的文件上；
+# 主题文件丢失、从CRT重新创建时，新文件的inode与崩溃前无关，之后的记录全部重放，
+# 遇到inode改变（崩溃前压缩过）就先在内存中回收墓碑，再按新的下标继续
+# 检查点定期fsync所有写过的文件后删除旧的预写日志段，墓碑/覆盖记录多的主题顺便压缩；
+# 启动时重放上一个检查点之后的记录。
+
+STATE_DIR = ".forum"
+WAL_FILE = "wal.log"
+CHECKPOINT_INTERVAL = 30        # 检查点（压缩主题、清空预写日志）的间隔（秒）
+COMPACT_MIN = 64                # 墓碑/覆盖记录至少这么多、
+COMPACT_RATIO = 0.25            # 并且达到主题记录数的这个比例时，检查点才压缩这个主题
+RESERVED_TITLES = ("credentials.txt",)  # 工作目录中不是主题的文件
+
+
+# 主题标题就是工作目录中的文件名：不能带路径、不能以.开头（.forum等状态文件），也不能是服务器自己的文件
+def valid_title(title):
+    if not title or title.startswith(".") or title in RESERVED_TITLES:
+        return False
+    return "/" not in title and "\0" not in title
+
+
+# 解析主题文件中的一行，返回 (kind, user, text)
+def parse_line(line):
+    line = line.rstrip("\n")
+    p = line.split(" ", 2)
+    if len(p) >= 2 and p[0].isdigit() and p[1].endswith(":"):
+        return "msg", p[1][:-1], p[2] if len(p) == 3 else ""
+    return "event", None, line
+
+
+# 消息索引：记录下标上的树状数组，存活的记录权重为1
+# 可见编号 -> 记录下标 O(log n)，追加/删除 O(log n)
+class MessageIndex:
+    def __init__(self, weights=()):
+        self.rebuild(weights)
+
+    def rebuild(self, weights):
+        self.tree = [0]
+        self.total = 0
+        for w in weights:
+            self.tree.append(w)
+            self.total += w
+        n = len(self.tree) - 1
+        for i in range(1, n + 1):
+            j = i + (i & -i)
+            if j <= n:
+                self.tree[j] += self.tree[i]
+
+    def __len__(self):
+        return len(self.tree) - 1
+
+    # 在末尾追加一条记录
+    def append(self, w):
+        i = len(self.tree)
+        stop = i - (i & -i)
+        v = w
+        j = i - 1
+        while j > stop:
+            v += self.tree[j]
+            j -= j & -j
+        self.tree.append(v)
+        self.total += w
+
+    # 修改第i条记录（从0开始）的权重
+    def add(self, i, delta):
+        pos = i + 1
+        n = len(self.tree) - 1
+        while pos <= n:
+            self.tree[pos] += delta
+            pos += pos & -pos
+        self.total += delta
+
+    # 前i条记录（下标 0..i-1）的权重和
+    def prefix(self, i):
+        s = 0
+        while i > 0:
+            s += self.tree[i]
+            i -= i & -i
+        return s
+
+    # 第k条存活记录（从1开始）所在的记录下标，不存在返回-1
+    def find(self, k):
+        if k < 1 or k > self.total:
+            return -1
+        n = len(self.tree) - 1
+        pos = 0
+        bit = 1 << (n.bit_length() - 1)
+        while bit:
+            nxt = pos + bit
+            if nxt <= n and self.tree[nxt] < k:
+                pos = nxt
+                k -= self.tree[nxt]
+            bit >>= 1
+        return pos
+
+
+# 一个主题在内存中的状态
+class ThreadState:
+    def __init__(self, title, creator):
+        self.title = title
+        self.creator = creator
+        self.entries = []               # [kind, user, text]，kind为 msg/event/deleted
+        self.index = MessageIndex()     # 存活的消息
+        self.visible = MessageIndex()   # 存活的消息 + 上传/下载记录（RDT分页用）
+        self.pending = 0                # 日志中尚未压缩的记录数
+        self.log = None                 # 追加写入的主题文件句柄
+        self.journal = None             # 墓碑/覆盖日志句柄
+        self.ino = None                 # 主题文件的inode，压缩后改变
+        self.dirty = False              # 上一个检查点之后是否写过
+        self.loaded = False             # 主题文件是否已经读到内存
+        self.closed = False
+        self.lock = threading.Lock()
+
+    @property
+    def msg_count(self):
+        return self.index.total
+
+    def add_entry(self, kind, user, text):
+        self.entries.append([kind, user, text])
+        self.index.append(1 if kind == "msg" else 0)
+        self.visible.append(1)
+
+    def rebuild_index(self):
+        self.index.rebuild(1 if e[0] == "msg" else 0 for e in self.entries)
+        self.visible.rebuild(0 if e[0] == "deleted" else 1 for e in self.entries)
+
+    # 回收墓碑：压缩后记录下标按这个顺序重新计算
+    def drop_deleted(self):
+        self.entries = [e for e in self.entries if e[0] != "deleted"]
+        self.rebuild_index()
+        self.pending = 0
+
+    def delete_entry(self, i):
+        self.entries[i][0] = "deleted"
+        self.index.add(i, -1)
+        self.visible.add(i, -1)
+
+    # 渲染成主题文件中第一行之后的各行（消息按顺序重新编号）
+    def render(self):
+        lines = []
+        num = 0
+        for kind, user, text in self.entries:
+            if kind == "msg":
+                num += 1
+                lines.append(f"{num} {user}: {text}\n")
+            elif kind == "event":
+                lines.append(text + "\n")
+        return lines
+
+    # 渲染第offset行开始的limit行，offset为负数时从末尾倒数
+    # 返回 (lines, 起始行号, 总行数)
+    def page(self, offset, limit):
+        total = self.visible.total
+        if offset < 0:
+            offset = max(total + offset, 0)
+        stop = total if limit is None else min(total, offset + max(limit, 0))
+        if offset >= stop:
+            return [], offset, total
+
+        i = self.visible.find(offset + 1)
+        num = self.index.prefix(i)          # 这一页之前的消息数，保证编号与整页读取一致
+        lines = []
+        while len(lines) < stop - offset:
+            kind, user, text = self.entries[i]
+            if kind == "msg":
+                num += 1
+                lines.append(f"{num} {user}: {text}\n")
+            elif kind == "event":
+                lines.append(text + "\n")
+            i += 1
+        return lines, offset, total
+
+    # 找到第msg_num条消息在entries中的下标，找不到返回-1
+    def find(self, msg_num):
+        return self.index.find(msg_num)
+
+
+# 主题存储：每个主题的消息常驻内存，磁盘上只做追加写
+class ThreadStore:
+    def __init__(self, root=".", fsync=DEFAULT_FSYNC, catalog=None):
+        self.root = root
+        self.catalog = catalog          # 主题目录：只有目录里的标题才到磁盘上找主题文件（恢复之后才加载）
+        self.threads = {}               # {threadtitle: ThreadState}
+        self.lock = threading.Lock()
+        self.local = threading.local()  # 每个线程自己的推迟写盘状态
+        os.makedirs(os.path.join(root, STATE_DIR, "journal"), exist_ok=True)
+        self.wal = WriteAheadLog(self.wal_path(), fsync)
+
+    def path(self, title):
+        return os.path.join(self.root, title)
+
+    def journal_path(self, title):
+        return os.path.join(self.root, STATE_DIR, "journal", title)
+
+    def wal_path(self):
+        return os.path.join(self.root, STATE_DIR, WAL_FILE)
+
+    # 从磁盘把主题读进state（只在第一次访问时读取整个文件），文件不存在返回False
+    # 恢复时丢掉崩溃时只写了一半的最后一行，这一行的内容会从预写日志重放
+    def _load(self, state, recovering=False):
+        path = self.path(state.title)
+        try:
+            f = open(path, "r", encoding="utf-8")
+        except (FileNotFoundError, IsADirectoryError):
+            return False
+
+        with f:
+            state.creator = f.readline().strip()
+            for line in f:
+                if recovering and not line.endswith("\n"):
+                    break
+                if not line.strip():
+                    continue
+                kind, user, text = parse_line(line)
+                state.entries.append([kind, user, text])
+            state.rebuild_index()
+
+        state.log = open(path, "a", encoding="utf-8")
+        state.ino = os.fstat(state.log.fileno()).st_ino
+        self._replay(state)
+        state.loaded = True
+        return True
+
+    # 重放墓碑/覆盖日志
+    def _replay(self, state):
+        jpath = self.journal_path(state.title)
+        if not os.path.exists(jpath):
+            return
+
+        with open(jpath, "r", encoding="utf-8") as f:
+            header = f.readline().split()
+            if header != ["BASE", str(state.ino)]:
+                f.close()
+                os.remove(jpath)        # 压缩时留下的旧日志，内容已经在主题文件里了
+                return
+
+            for line in f:
+                p = line.rstrip("\n").split(" ", 2)
+                if len(p) < 2 or not p[1].isdigit():
+                    continue
+                i = int(p[1])
+                if i >= len(state.entries) or state.entries[i][0] != "msg":
+                    continue
+                if p[0] == "D":
+                    state.delete_entry(i)
+                elif p[0] == "E":
+                    state.entries[i][2] = p[2] if len(p) == 3 else ""
+                state.pending += 1
+
+        state.journal = open(jpath, "a", encoding="utf-8")
+
+    # 向日志追加一条记录
+    def _journal_write(self, state, record):
+        if state.journal is None:
+            jpath = self.journal_path(state.title)
+            state.journal = open(jpath, "w", encoding="utf-8")
+            state.journal.write(f"BASE {state.ino}\n")
+        state.journal.write(record + "\n")
+        self._flush(state)
+        state.pending += 1
+
+    # 写盘：在deferred_flush()中时只记下主题，结束时统一写一次
+    def _flush(self, state):
+        state.dirty = True
+        deferred = getattr(self.local, "deferred", None)
+        if deferred is not None:
+            deferred.add(state)
+            return
+        state.log.flush()
+        if state.journal is not None:
+            state.journal.flush()
+
+    # 等待预写日志中lsn之前的记录写到磁盘；在deferred_flush()中时只记下最大的lsn，结束时等一次
+    def _commit(self, lsn):
+        if getattr(self.local, "deferred", None) is not None:
+            self.local.lsn = max(self.local.lsn, lsn)
+            return
+        self.wal.commit(lsn)
+
+    # 批量命令期间推迟写盘，同一个主题只在结束时写一次
+    @contextmanager
+    def deferred_flush(self):
+        if getattr(self.local, "deferred", None) is not None:
+            yield
+            return
+
+        self.local.deferred = set()
+        self.local.lsn = 0
+        try:
+            yield
+        finally:
+            states, self.local.deferred = self.local.deferred, None
+            for state in states:
+                with state.lock:
+                    if not state.closed:
+                        self._flush(state)
+            if self.local.lsn:
+                self.wal.commit(self.local.lsn)
+
+    # 取得主题，不存在返回None
+    # 全局锁只用来登记主题，第一次访问时在这个主题自己的锁里读取文件，加载大主题不会挡住其他主题
+    # 工作目录中的其他文件（源代码、.forum中的账号日志等）不是主题，不能读写
+    def get(self, title):
+        with self.lock:
+            state = self.threads.get(title)
+            if state is None:
+                if not self._known(title):
+                    return None
+                state = self.threads[title] = ThreadState(title, None)
+        if state.loaded:
+            return state
+
+        with state.lock:
+            if not state.loaded and not state.closed and not self._load(state):
+                state.closed = True
+        if state.closed:
+            with self.lock:
+                if self.threads.get(title) is state:
+                    del self.threads[title]
+            return None
+        return state
+
+    def _known(self, title):
+        if not valid_title(title) or (self.catalog is not None and title not in self.catalog):
+            return False
+        return os.path.isfile(self.path(title))
+
+    def exists(self, title):
+        return self.get(title) is not None
+
+    def creator(self, title):
+        state = self.get(title)
+        return state.creator if state else None
+
+    def count(self, title):
+        state = self.get(title)
+        return state.msg_count if state else None
+
+    # 创建主题，已存在或标题不能作为文件名返回False
+    def create(self, title, creator):
+        with self.lock:
+            if not valid_title(title) or title in self.threads or os.path.exists(self.path(title)):
+                return False
+
+            lsn = self.wal.append({"op": "CRT", "t": title, "creator": creator})
+            self.threads[title] = self._create_file(title, creator)
+        self._commit(lsn)
+        return True
+
+    def _create_file(self, title, creator):
+        with open(self.path(title), "w", encoding="utf-8") as f:
+            f.write(creator + "\n")
+        state = ThreadState(title, creator)
+        state.log = open(self.path(title), "a", encoding="utf-8")
+        state.ino = os.fstat(state.log.fileno()).st_ino
+        state.loaded = state.dirty = True
+        return state
+
+    # 发消息：内存追加 + 一次缓冲写，返回消息编号
+    def append_message(self, title, username, text):
+        state = self.get(title)
+        if state is None:
+            return None
+
+        with state.lock:
+            lsn = self.wal.append({"op": "ADD", "t": title, "ino": state.ino, "i": len(state.entries),
+                                   "kind": "msg", "user": username, "text": text})
+            state.add_entry("msg", username, text)
+            num = state.msg_count
+            state.log.write(f"{num} {username}: {text}\n")
+            self._flush(state)
+        self._commit(lsn)
+        return num
+
+    # 追加上传/下载记录
+    def append_event(self, title, line):
+        state = self.get(title)
+        if state is None:
+            return False
+
+        with state.lock:
+            lsn = self.wal.append({"op": "ADD", "t": title, "ino": state.ino, "i": len(state.entries),
+                                   "kind": "event", "user": None, "text": line})
+            state.add_entry("event", None, line)
+            state.log.write(line + "\n")
+            self._flush(state)
+        self._commit(lsn)
+        return True
+
+    # 查找消息，返回 (user, text)，不存在返回None
+    def message(self, title, msg_num):
+        state = self.get(title)
+        if state is None:
+            return None
+
+        with state.lock:
+            i = state.find(msg_num)
+            if i == -1:
+                return None
+            return state.entries[i][1], state.entries[i][2]
+
+    # 删除消息（写墓碑），返回 "OK" / "NOT_FOUND" / "NOT_OWNER"
+    def delete_message(self, title, msg_num, username):
+        state = self.get(title)
+        if state is None:
+            return "NOT_FOUND"
+
+        with state.lock:
+            i = state.find(msg_num)
+            if i == -1:
+                return "NOT_FOUND"
+            if state.entries[i][1] != username:
+                return "NOT_OWNER"
+
+            lsn = self.wal.append({"op": "D", "t": title, "ino": state.ino, "i": i})
+            state.delete_entry(i)
+            self._journal_write(state, f"D {i}")
+        self._commit(lsn)
+        return "OK"
+
+    # 编辑消息（写覆盖记录），返回 "OK" / "NOT_FOUND" / "NOT_OWNER"
+    def edit_message(self, title, msg_num, username, new_text):
+        state = self.get(title)
+        if state is None:
+            return "NOT_FOUND"
+
+        with state.lock:
+            i = state.find(msg_num)
+            if i == -1:
+                return "NOT_FOUND"
+            if state.entries[i][1] != username:
+                return "NOT_OWNER"
+
+            lsn = self.wal.append({"op": "E", "t": title, "ino": state.ino, "i": i, "text": new_text})
+            state.entries[i][2] = new_text
+            self._journal_write(state, f"E {i} {new_text}")
+        self._commit(lsn)
+        return "OK"
+
+    # 压缩：回收墓碑、合并覆盖记录，用内存中的内容重写主题文件（fsync之后再替换）
+    # 压缩会改变记录下标，只能在检查点中进行；调用者持有state.lock
+    # 新文件换了inode：压缩之前的预写日志记录带着旧inode，恢复时跳过（它们已经在新文件里了）
+    def _compact(self, state):
+        path = self.path(state.title)
+        tmp = path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write(state.creator + "\n")
+            f.writelines(state.render())
+            f.flush()
+            os.fsync(f.fileno())
+
+        state.log.close()
+        os.replace(tmp, path)           # 主题文件换了inode，旧日志即使没删掉也会被忽略
+        state.log = open(path, "a", encoding="utf-8")
+        state.ino = os.fstat(state.log.fileno()).st_ino
+
+        if state.journal is not None:
+            state.journal.close()
+            state.journal = None
+        if os.path.exists(self.journal_path(state.title)):
+            os.remove(self.journal_path(state.title))
+
+        state.drop_deleted()
+
+    # 把写过的主题文件和墓碑/覆盖日志写到磁盘；调用者持有state.lock
+    def _sync(self, state):
+        for f in (state.log, state.journal):
+            if f is not None:
+                f.flush()
+                os.fsync(f.fileno())
+
+    # 墓碑/覆盖记录够多时才值得重写整个主题文件，否则墓碑/覆盖日志fsync之后就足够恢复
+    def _should_compact(self, state):
+        return state.pending >= max(COMPACT_MIN, COMPACT_RATIO * len(state.entries))
+
+    # 检查点：先把预写日志换到新的日志段，再逐个处理写过的主题——墓碑/覆盖记录多的压缩，其他的只fsync，
+    # 每次只持有一个主题的锁，其他主题照常读写；都写盘之后删除旧的日志段。
+    # force中的主题一定压缩（恢复时用）。返回压缩的主题数
+    def checkpoint(self, force=()):
+        segment = self.wal.rotate()
+        with self.lock:
+            states = list(self.threads.values())
+
+        compacted = 0
+        for state in states:
+            with state.lock:
+                if state.closed or not state.loaded or not state.dirty:
+                    continue
+                if state.title in force or self._should_compact(state):
+                    self._compact(state)
+                    compacted += 1
+                else:
+                    self._sync(state)
+                state.dirty = False
+
+        # 创建、删除、替换的文件名也要写到磁盘
+        for directory in (self.root, os.path.join(self.root, STATE_DIR, "journal")):
+            fd = os.open(directory, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+        self.wal.release(segment)
+        return compacted
+
+    # 启动后台检查点线程（按毫秒间隔fsync时同时启动预写日志的fsync线程）
+    def start_checkpointer(self, interval=CHECKPOINT_INTERVAL):
+        self.wal.start_syncer()
+
+        def loop():
+            while True:
+                threading.Event().wait(interval)
+                if self.wal.lsn == self.wal.checkpointed:
+                    continue
+                try:
+                    count = self.checkpoint()
+                except Exception as e:
+                    log.error("ThreadStore", f"Checkpoint failed: {e}")
+                    continue
+                s = self.wal.stats()
+                log.info("ThreadStore", f"Checkpoint: compacted {count} thread(s); WAL {s['records']} record(s) "
+                                        f"in {s['syncs']} fsync(s), {s['records_per_sync']:.1f} per group commit.")
+
+        threading.Thread(target=loop, daemon=True).start()
+
+    # 启动时重放上一个检查点之后的预写日志：按记录下标判断主题文件里是否已经有这条修改，
+    # 没有的在内存中补上，然后立刻做一次检查点。返回涉及的主题标题
+    def recover(self):
+        records = []
+        for path in segment_paths(self.wal_path()) + [self.wal_path()]:
+            records += read_records(path)
+        touched = set()
+        current = set()                 # 已经对上当前主题文件的主题，之后inode改变的记录来自崩溃前的压缩
+        for r in records:
+            title = r["t"]
+            touched.add(title)
+            if r["op"] == "RMV":
+                self.remove(title, log=False)
+                current.discard(title)
+                continue
+            if title not in self.threads:
+                state = ThreadState(title, None)
+                if not self._load(state, recovering=True):
+                    if r["op"] != "CRT":
+                        continue
+                    state = self._create_file(title, r["creator"])
+                    state.ino = None    # 重新创建的文件：之后的记录都要重放
+                    current.add(title)
+                self.threads[title] = state
+            state = self.threads[title]
+            state.dirty = True
+            if "ino" in r and r["ino"] != state.ino:
+                if title not in current:
+                    continue            # 主题在检查点中已经压缩过，这条修改已经在主题文件里
+                if state.ino is not None:
+                    state.drop_deleted()    # 崩溃前压缩过，之后的记录按压缩后的下标
+                state.ino = r["ino"]
+            if "ino" in r:
+                current.add(title)
+
+            i = r.get("i")
+            if r["op"] == "ADD" and i == len(state.entries):
+                state.add_entry(r["kind"], r["user"], r["text"])
+            elif r["op"] in ("D", "E") and i < len(state.entries) and state.entries[i][0] == "msg":
+                if r["op"] == "D":
+                    state.delete_entry(i)
+                else:
+                    state.entries[i][2] = r["text"]
+
+        # 重写涉及的主题（包括补上的记录），之后预写日志就不再需要了
+        self.checkpoint(force=touched)
+        if records:
+            log.info("ThreadStore", f"Recovered {len(records)} WAL record(s) for {len(touched)} thread(s).")
+        return touched
+
+    # 读取主题内容（第一行之后的所有行）
+    def read(self, title):
+        state = self.get(title)
+        if state is None:
+            return None
+
+        with state.lock:
+            return state.render()
+
+    # 分页读取，返回 (lines, 起始行号, 总行数)，主题不存在返回None
+    def page(self, title, offset=0, limit=None):
+        state = self.get(title)
+        if state is None:
+            return None
+
+        with state.lock:
+            return state.page(offset, limit)
+
+    # 删除主题文件
+    def remove(self, title, log=True):
+        with self.lock:
+            lsn = self.wal.append({"op": "RMV", "t": title}) if log else 0
+            state = self.threads.pop(title, None)
+            if state is not None:
+                with state.lock:
+                    self._close(state)
+            for path in (self.path(title), self.journal_path(title)):
+                if os.path.exists(path):
+                    os.remove(path)
+        if lsn:
+            self._commit(lsn)
+
+    def _close(self, state):
+        state.closed = True
+        for f in (state.log, state.journal):
+            if f is not None:
+                f.close()
+
+    def close(self):
+        with self.lock:
+            for state in self.threads.values():
+                self._close(state)
+            self.threads.clear()
+        self.wal.close()
@@ -0,0 +1,298 @@
+import os
+import zlib
+import struct
+import hashlib
+
+# 客户端和服务器共用的TCP文件传输工具
+#
+# 可续传的传输（UDP请求中带上文件大小/摘要时使用）：
+#   上传  UPD <thread> <file> <size> <sha256> [streams] <user>
+#           ->  UPD_OK <令牌> <服务器已有的连续字节数> <缺少的区间 start-end ...>
+#         TCP: 客户端先发送 "TRANSFER <令牌>\n"，服务器回复 "READY\n" 或 "ERROR BAD_TOKEN\n"；
+#         然后发送 "PUT <start> [end]\n"，再是若干帧，最后一个长度为0的帧
+#         帧 = 4字节长度 + 4字节CRC32 + 数据；登录时协商了zlib的客户端可以发送压缩的帧
+#         （长度最高位为1，CRC32针对压缩后的数据）；服务器逐帧校验、解压后用pwrite写到对应位置，
+#         每个区间结束后回复 "RANGE_OK\n"；最后一个区间收完时核对整个文件的SHA-256，
+#         通过后原子改名提交，回复 "OK\n"；出错回复 "ERROR <原因> ...\n"
+#   下载  DWN <thread> <file> resume [streams] <user>  ->  DWN_OK <令牌> <size> <sha256>
+#         TCP: 出示令牌后发送 "GET <start> [end]\n"，服务器用sendfile发送 [start, end) 的数据；
+#         发送 "GET <start> <end> z\n" 时服务器改为按帧发送（能压缩的块压缩），以空帧结束；
+#         客户端用pwrite写到对应位置，这条连接上的区间都收完后发送 "DONE\n"，全部收完后核对SHA-256
+#   streams > 1 时客户端打开streams条TCP连接并行传输，每条连接可以依次传输多个区间。
+#   令牌只在有效期内、最多被streams条连接出示；一条连接可以一直保持，依次出示多个令牌完成多个传输。
+# 不带这些参数的旧请求仍按原来的方式直接传输文件内容。
+
+DEFAULT_CHUNK_SIZE = 256 * 1024         # 每次接收的字节数，也是上传时每帧的大小
+DEFAULT_MAX_STREAMS = 8                 # 一次传输最多使用的并行TCP连接数
+DEFAULT_TRANSFER_TTL = 60               # 传输令牌的有效期（秒）
+FRAME = struct.Struct("!II")            # 帧头：数据长度、CRC32
+FLAG_COMPRESSED = 0x80000000            # 帧头长度的最高位：数据是zlib压缩过的
+COMPRESS_LEVEL = 1                      # 传输时压缩速度优先
+MAX_LINE = 1024
+TOKEN_PREFIX = b"TRANSFER "             # 新客户端每个传输开头的令牌
+LEGACY_WAIT = 0.5                       # 判断是否是旧客户端时最多等待的时间（秒）
+
+
+# 零拷贝发送文件：socket.sendfile在支持的平台上使用os.sendfile，
+# 数据不经过用户态；不支持时自动退回read+send
+def send_file(sock, f, offset=0, count=None):
+    return sock.sendfile(f, offset, count)
+
+
+# 用预先分配的缓冲区接收数据并写入文件，直到对方关闭连接或收满limit字节
+# f应以无缓冲方式打开（buffering=0），避免再拷贝一次
+def recv_file(sock, f, chunk_size=DEFAULT_CHUNK_SIZE, limit=None, hasher=None):
+    view = memoryview(bytearray(chunk_size))
+    total = 0
+    while limit is None or total < limit:
+        want = chunk_size if limit is None else min(chunk_size, limit - total)
+        n = sock.recv_into(view[:want])
+        if n == 0:
+            break
+        f.write(view[:n])
+        if hasher is not None:
+            hasher.update(view[:n])
+        total += n
+    return total
+
+
+# 收满len(view)字节，连接提前关闭返回False
+def recv_exact(sock, view):
+    got = 0
+    while got < len(view):
+        n = sock.recv_into(view[got:])
+        if n == 0:
+            return False
+        got += n
+    return True
+
+
+def send_line(sock, line):
+    sock.sendall((line + "\n").encode("utf-8"))
+
+
+# 读取一行文本（逐字节读取，避免多读走后面的二进制数据），连接关闭返回None
+def recv_line(sock):
+    buf = bytearray()
+    while len(buf) < MAX_LINE:
+        b = sock.recv(1)
+        if not b:
+            return None
+        if b == b"\n":
+            return buf.decode("utf-8", errors="ignore")
+        buf += b
+    return None
+
+
+# 解析 "PUT/GET <start> [end] [z]"，end默认为size，返回 (start, end, 是否按压缩帧发送)，格式不对返回None
+def parse_range_request(line, verb, size):
+    p = line.split() if line else []
+    compressed = len(p) == 4 and p[3] == "z"
+    if compressed:
+        p = p[:3]
+    if len(p) not in (2, 3) or p[0] != verb or not all(x.isdigit() for x in p[1:]):
+        return None
+    start = int(p[1])
+    end = int(p[2]) if len(p) == 3 else size
+    if not start <= end <= size:
+        return None
+    return start, end, compressed
+
+
+# 压缩一块数据，压缩后没有明显变小返回None
+def deflate(data):
+    packed = zlib.compress(data, COMPRESS_LEVEL)
+    return packed if len(packed) < len(data) * 0.9 else None
+
+
+# 解压一帧，解压后超过max_size或数据损坏返回None
+def inflate(data, max_size):
+    d = zlib.decompressobj()
+    try:
+        out = d.decompress(data, max_size)
+    except zlib.error:
+        return None
+    if d.unconsumed_tail or not d.eof:
+        return None
+    return out
+
+
+# 帧的编码和解析只处理字节，不做I/O：同步的send_frames/recv_frames和asyncio引擎共用，各自只负责读写连接和文件
+END_FRAME = FRAME.pack(0, 0)
+
+
+# 一块数据编码成一帧，返回 (帧头, 数据, 之后是否继续压缩)
+# compress为True时尝试压缩；压缩不了的块（已经压缩过的格式）之后就不再尝试
+def pack_frame(chunk, compress=False):
+    if compress:
+        packed = deflate(chunk)
+        if packed is not None:
+            return FRAME.pack(len(packed) | FLAG_COMPRESSED, zlib.crc32(packed)), packed, True
+    return FRAME.pack(len(chunk), zlib.crc32(chunk)), chunk, False
+
+
+# 接收一个区间的帧：header(帧头) 返回接下来要读的数据长度，0表示结束（结果在status中）；
+# payload(数据) 校验、解压后返回 (文件中的位置, 数据)，校验失败返回None（原因在status中）
+# status为 None（还没结束）/ "OK" / "BAD_CHECKSUM" / "TOO_LARGE"，连接提前关闭由调用者判断为 "INCOMPLETE"
+class FrameReader:
+    def __init__(self, offset=0, chunk_size=DEFAULT_CHUNK_SIZE, limit=None, hasher=None):
+        self.offset = offset
+        self.chunk_size = chunk_size
+        self.limit = limit
+        self.hasher = hasher
+        self.total = 0                  # 已经通过校验的字节数
+        self.status = None
+        self.crc = 0
+        self.compressed = False
+
+    def header(self, header):
+        length, self.crc = FRAME.unpack(header)
+        self.compressed = bool(length & FLAG_COMPRESSED)
+        length &= ~FLAG_COMPRESSED
+        if length == 0:
+            self.status = "OK"
+        elif length > self.chunk_size:
+            self.status = "TOO_LARGE"
+            return 0
+        return length
+
+    def payload(self, data):
+        if zlib.crc32(data) != self.crc:
+            self.status = "BAD_CHECKSUM"
+            return None
+        if self.compressed:
+            data = inflate(data, self.chunk_size)
+            if data is None:
+                self.status = "BAD_CHECKSUM"
+                return None
+        if self.limit is not None and self.total + len(data) > self.limit:
+            self.status = "TOO_LARGE"
+            return None
+        if self.hasher is not None:
+            self.hasher.update(data)
+        pos = self.offset + self.total
+        self.total += len(data)
+        return pos, data
+
+
+# 从offset开始按帧发送文件（count为None时发送到文件末尾），最后发送一个空帧
+def send_frames(sock, f, offset=0, chunk_size=DEFAULT_CHUNK_SIZE, count=None, compress=False):
+    f.seek(offset)
+    buf = bytearray(chunk_size)
+    view = memoryview(buf)
+    total = 0
+    while count is None or total < count:
+        want = chunk_size if count is None else min(chunk_size, count - total)
+        n = f.readinto(view[:want])
+        if not n:
+            break
+        header, payload, compress = pack_frame(view[:n], compress)
+        sock.sendall(header)
+        sock.sendall(payload)
+        total += n
+    sock.sendall(END_FRAME)
+    return total
+
+
+# 逐帧接收并校验，通过校验的帧才用pwrite写入文件描述符fd的offset处
+# 返回 (写入的字节数, "OK" / "BAD_CHECKSUM" / "INCOMPLETE" / "TOO_LARGE")
+def recv_frames(sock, fd, offset=0, chunk_size=DEFAULT_CHUNK_SIZE, limit=None, hasher=None):
+    frames = FrameReader(offset, chunk_size, limit, hasher)
+    header = memoryview(bytearray(FRAME.size))
+    view = memoryview(bytearray(chunk_size))
+    while frames.status is None:
+        if not recv_exact(sock, header):
+            return frames.total, "INCOMPLETE"
+        length = frames.header(header)
+        if not length:
+            break
+        if not recv_exact(sock, view[:length]):
+            return frames.total, "INCOMPLETE"
+        write = frames.payload(view[:length])
+        if write is not None:
+            os.pwrite(fd, write[1], write[0])
+    return frames.total, frames.status
+
+
+# 计算文件的SHA-256（可以传入已经处理过前面部分的hasher）
+def file_digest(path, hasher=None, offset=0, chunk_size=DEFAULT_CHUNK_SIZE):
+    hasher = hasher or hashlib.sha256()
+    with open(path, "rb") as f:
+        f.seek(offset)
+        buf = bytearray(chunk_size)
+        view = memoryview(buf)
+        while True:
+            n = f.readinto(buf)
+            if not n:
+                break
+            hasher.update(view[:n])
+    return hasher.hexdigest()
+
+
+# 接收count字节，用pwrite写入文件描述符fd的offset处，返回收到的字节数
+def recv_range(sock, fd, offset, count, chunk_size=DEFAULT_CHUNK_SIZE):
+    view = memoryview(bytearray(chunk_size))
+    total = 0
+    while total < count:
+        n = sock.recv_into(view[:min(chunk_size, count - total)])
+        if n == 0:
+            break
+        os.pwrite(fd, view[:n], offset + total)
+        total += n
+    return total
+
+
+# 已经收到的区间记录在 <path>.ranges 中，每行 "start end"
+# 没有记录文件时认为path的全部内容都有效（顺序写入的旧格式）
+def load_ranges(path):
+    ranges = []
+    if os.path.exists(path + ".ranges"):
+        with open(path + ".ranges", "r", encoding="utf-8") as f:
+            for line in f:
+                p = line.split()
+                if len(p) == 2 and p[0].isdigit() and p[1].isdigit():
+                    ranges.append((int(p[0]), int(p[1])))
+    elif os.path.exists(path):
+        ranges.append((0, os.path.getsize(path)))
+    return merge_ranges(ranges)
+
+
+def add_range(path, start, end):
+    if end > start:
+        with open(path + ".ranges", "a", encoding="utf-8") as f:
+            f.write(f"{start} {end}\n")
+
+
+def merge_ranges(ranges):
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        elif end > start:
+            merged.append((start, end))
+    return merged
+
+
+# [0, size) 中还没有收到的区间
+def missing_ranges(ranges, size):
+    missing = []
+    pos = 0
+    for start, end in merge_ranges(ranges):
+        if start > pos:
+            missing.append((pos, min(start, size)))
+        pos = max(pos, end)
+    if pos < size:
+        missing.append((pos, size))
+    return [(s, e) for s, e in missing if e > s]
+
+
+# 把要传输的区间平均分给streams条连接，返回每条连接依次传输的区间列表
+def split_ranges(ranges, streams):
+    total = sum(e - s for s, e in ranges)
+    share = max(1, -(-total // streams))
+    pieces = []
+    for start, end in ranges:
+        while start < end:
+            pieces.append((start, min(end, start + share)))
+            start = pieces[-1][1]
+    return [pieces[i::streams] for i in range(streams)]
@@ -0,0 +1,171 @@
+import os
+import json
+import zlib
+import threading
+
+DEFAULT_FSYNC = "always"        # always：回复前fsync；<毫秒数>：后台每隔这么久fsync一次；never：交给操作系统
+
+
+# 解析fsync策略，返回 ("always", 0) / ("interval", 秒) / ("never", 0)
+def parse_fsync_policy(text):
+    text = str(text)
+    if text in ("always", "never"):
+        return text, 0
+    if text.isdigit() and int(text) > 0:
+        return "interval", int(text) / 1000
+    raise ValueError(f"fsync policy must be always, never or a positive number of milliseconds, not {text!r}")
+
+
+# 一条记录编码成一行 "<crc32> <json>\n"
+def encode_record(record):
+    data = json.dumps(record, ensure_ascii=False).encode("utf-8")
+    return f"{zlib.crc32(data):08x} ".encode("ascii") + data + b"\n"
+
+
+# 读取日志中的记录，遇到不完整或校验失败的行（崩溃时写了一半）就停止
+def read_records(path):
+    records = []
+    if not os.path.exists(path):
+        return records
+    with open(path, "rb") as f:
+        for raw in f:
+            if not raw.endswith(b"\n"):
+                break
+            crc, _, data = raw[:-1].partition(b" ")
+            try:
+                if int(crc, 16) != zlib.crc32(data):
+                    break
+                records.append(json.loads(data.decode("utf-8")))
+            except ValueError:
+                break
+    return records
+
+
+# 检查点换下来、还没有删除的日志段 <path>.<编号>，按编号排序
+def segment_paths(path):
+    directory, name = os.path.split(path)
+    numbers = sorted(int(f[len(name) + 1:]) for f in os.listdir(directory or ".")
+                     if f.startswith(name + ".") and f[len(name) + 1:].isdigit())
+    return [f"{path}.{n}" for n in numbers]
+
+
+# 整个论坛共用的预写日志：修改主题文件之前先把记录追加到 .forum/wal.log
+# 每行 "<crc32> <json记录>"；并发的命令各自追加记录，一次fsync覆盖所有已经追加的记录（组提交）
+# 检查点开始时把日志换成新的日志段（rotate），之前的记录对应的主题文件都写盘之后删除旧的日志段（release），
+# 期间的新记录写在新的日志段里，不需要暂停写入
+class WriteAheadLog:
+    def __init__(self, path, policy=DEFAULT_FSYNC):
+        self.path = path
+        self.mode, self.interval = parse_fsync_policy(policy)
+        self.cond = threading.Condition()
+        self.fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        self.segment = max([int(p.rsplit(".", 1)[1]) for p in segment_paths(path)], default=0)
+        self.lsn = 0                    # 最后追加的记录编号
+        self.durable = 0                # 已经fsync的记录编号
+        self.rotated = 0                # 最近一次换日志段时的记录编号
+        self.checkpointed = 0           # 上一个完成的检查点覆盖到的记录编号
+        self.syncing = False            # 是否有线程正在fsync
+        self.records = 0
+        self.syncs = 0
+
+    # 追加一条记录，返回记录编号（此时记录已经交给操作系统，但不一定写到磁盘）
+    def append(self, record):
+        line = encode_record(record)
+        with self.cond:
+            os.write(self.fd, line)
+            self.lsn += 1
+            self.records += 1
+            return self.lsn
+
+    # 命令回复之前调用：always策略下等到lsn之前的记录都写到磁盘
+    def commit(self, lsn):
+        if self.mode == "always":
+            self.sync(lsn)
+
+    # fsync到lsn（默认为最后一条记录）为止；已经有线程在fsync时等它完成，
+    # 完成后还不够的话由其中一个等待的线程再fsync一次，这一次覆盖期间追加的所有记录
+    def sync(self, lsn=None):
+        with self.cond:
+            if lsn is None:
+                lsn = self.lsn
+            while self.durable < lsn:
+                if self.syncing:
+                    self.cond.wait()
+                    continue
+                self.syncing = True
+                target = self.lsn
+                self.cond.release()
+                try:
+                    os.fsync(self.fd)
+                finally:
+                    self.cond.acquire()
+                    self.syncing = False
+                    self.cond.notify_all()
+                self.durable = max(self.durable, target)
+                self.syncs += 1
+
+    # 检查点开始：当前日志fsync后改名为 <path>.<编号>，之后的记录写到新的日志文件，返回编号
+    def rotate(self):
+        with self.cond:
+            while self.syncing:
+                self.cond.wait()
+            os.fsync(self.fd)
+            os.close(self.fd)
+            self.segment += 1
+            os.rename(self.path, f"{self.path}.{self.segment}")
+            self.fd = os.open(self.path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+            self._sync_dir()
+            self.durable = self.rotated = self.lsn
+            return self.segment
+
+    # 检查点完成：编号不超过segment的日志段中的修改都已经写到主题文件里，删除这些日志段
+    def release(self, segment):
+        for path in segment_paths(self.path):
+            if int(path.rsplit(".", 1)[1]) <= segment:
+                os.remove(path)
+        self._sync_dir()
+        with self.cond:
+            self.checkpointed = self.rotated
+
+    def _sync_dir(self):
+        fd = os.open(os.path.dirname(os.path.abspath(self.path)), os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    # 压缩：用records重写整个日志（先写临时文件并fsync，再替换）；调用者保证期间没有新的记录
+    def rewrite(self, records):
+        tmp = self.path + ".tmp"
+        with open(tmp, "wb") as f:
+            f.writelines(encode_record(r) for r in records)
+            f.flush()
+            os.fsync(f.fileno())
+        with self.cond:
+            while self.syncing:
+                self.cond.wait()
+            os.replace(tmp, self.path)
+            os.close(self.fd)
+            self.fd = os.open(self.path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+            self.durable = self.checkpointed = self.lsn
+
+    def stats(self):
+        with self.cond:
+            return {"records": self.records, "syncs": self.syncs,
+                    "records_per_sync": self.records / self.syncs if self.syncs else 0.0}
+
+    # 按毫秒间隔fsync时的后台线程
+    def start_syncer(self):
+        if self.mode != "interval":
+            return
+
+        def loop():
+            while True:
+                threading.Event().wait(self.interval)
+                if self.durable < self.lsn:
+                    self.sync()
+
+        threading.Thread(target=loop, daemon=True).start()
+
+    def close(self):
+        os.close(self.fd)